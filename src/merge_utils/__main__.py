@@ -212,12 +212,12 @@ def print_metadata(metadata, mode):
         return
     io_utils.log_print(f"All {ngood} input files passed validation!", logging.INFO)
     # Check the metadata for the output files
-    meta.make_names(good_files)
+    meta.make_names(good_files, metadata.files.metadata)
     if mode == 'validate':
         io_utils.log_print("All input and output metadata passed validation!")
         return
     # In metadata mode, also print the combined output metadata
-    merged_metadata = meta.merged_keys(good_files, warn = True)
+    merged_metadata = meta.merged_keys(metadata.files.metadata, warn = True)
     io_utils.log_print(f"Combined metadata:\n{json.dumps(merged_metadata, indent=2)}")
     for idx, output in enumerate(config.method.outputs):
         if not output.metadata:
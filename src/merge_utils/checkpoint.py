@@ -0,0 +1,103 @@
+"""Checkpoints of the validated state of a merge job, so it can be resumed without the network"""
+
+from __future__ import annotations
+import logging
+import os
+import gzip
+import json
+import pickle
+import hashlib
+
+from merge_utils import __version__, config
+
+logger = logging.getLogger(__name__)
+
+# Config keys that affect the result of each stage.  A checkpoint is only reused if all of these
+# are unchanged, so other settings (grouping, naming, site preferences, etc.) can be changed on
+# resume without repeating the validation.
+METADATA_KEYS = [
+    'input',
+    'metadata',
+    'output.grandparents',
+    'validation.check_fids',
+    'validation.checksums',
+    'validation.handling',
+]
+REPLICA_KEYS = METADATA_KEYS + [
+    'local',
+    'sites.rse_distances',
+    'sites.dcache',
+]
+STAGE_KEYS = {
+    'metadata': METADATA_KEYS,
+    'replicas': REPLICA_KEYS,
+    'schedule': REPLICA_KEYS,
+}
+
+def fingerprint(stage: str) -> str:
+    """
+    Get a hash of the config settings that affect a stage.
+
+    :param stage: name of the pipeline stage
+    :return: hex digest of the relevant settings
+    """
+    keys = STAGE_KEYS.get(stage, REPLICA_KEYS)
+    settings = {key: config.get_key(key) for key in keys}
+    text = json.dumps(settings, default=config.custom_serializer, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def path(stage: str) -> str:
+    """
+    Get the path of the checkpoint file for a stage.
+
+    :param stage: name of the pipeline stage
+    :return: path to the checkpoint file
+    """
+    return os.path.join(str(config.job.dir), 'checkpoint', f"{stage}.pkl.gz")
+
+def save(stage: str, state: dict) -> None:
+    """
+    Save a checkpoint for a stage of the job.
+
+    :param stage: name of the pipeline stage
+    :param state: dictionary of objects to save
+    :return: None
+    """
+    file_name = path(stage)
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    data = {
+        'version': __version__,
+        'fingerprint': fingerprint(stage),
+        'state': state,
+    }
+    tmp_name = f"{file_name}.tmp"
+    with gzip.open(tmp_name, 'wb', compresslevel=6) as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_name, file_name)
+    logger.info("Saved %s checkpoint to %s", stage, file_name)
+
+def load(stage: str) -> dict | None:
+    """
+    Load the checkpoint for a stage of the job, if it exists and is still valid.
+
+    :param stage: name of the pipeline stage
+    :return: dictionary of saved objects, or None if there is no usable checkpoint
+    """
+    file_name = path(stage)
+    if not os.path.isfile(file_name):
+        return None
+    try:
+        with gzip.open(file_name, 'rb') as f:
+            data = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as err:
+        logger.warning("Could not read %s checkpoint %s: %s", stage, file_name, err)
+        return None
+    if data.get('version') != __version__:
+        logger.info("Ignoring %s checkpoint from merge-utils version %s",
+                    stage, data.get('version'))
+        return None
+    if data.get('fingerprint') != fingerprint(stage):
+        logger.info("Configuration changed since %s checkpoint, repeating that stage", stage)
+        return None
+    logger.info("Restored %s checkpoint from %s", stage, file_name)
+    return data['state']
@@ -0,0 +1,496 @@
+"""Fast file checksums, shared by the replica checks and the merge job runners"""
+
+from __future__ import annotations
+import io
+import os
+import json
+import time
+import zlib
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 4 * 1024 * 1024  # Large reads keep the disk streaming and amortize the GIL hand-offs
+
+ADLER_BASE = 65521
+WRITE_BLOCK = 1024 * 1024  # Granularity for tracking out-of-order writes
+SIDECAR = '.checksums'  # Suffix for files recording the checksums of a newly written file
+
+# Fixed-length hashlib digests (the variable-length shake digests need an explicit length)
+HASHLIB = frozenset(algo for algo in hashlib.algorithms_guaranteed if not algo.startswith('shake'))
+ALGORITHMS = frozenset(['adler32', 'crc32']) | HASHLIB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checksums (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    value TEXT NOT NULL,
+    stored REAL NOT NULL,
+    PRIMARY KEY (device, inode, algorithm)
+);
+"""
+
+class ZlibChecksum:
+    """Incremental Adler-32 or CRC-32 checksum with the same interface as a hashlib object"""
+    __slots__ = ('func', 'value')
+
+    def __init__(self, func, value: int):
+        self.func = func
+        self.value = value
+
+    def update(self, data) -> None:
+        """Add a block of data to the checksum"""
+        self.value = self.func(data, self.value)
+
+    def hexdigest(self) -> str:
+        """Return the checksum as 8 hex digits"""
+        return f"{self.value:08x}"
+
+def new(algorithm: str):
+    """
+    Create an incremental checksum object for an algorithm.
+
+    :param algorithm: checksum name, e.g. 'adler32', 'md5', 'sha256'
+    :return: object with update() and hexdigest() methods
+    :raises ValueError: if the algorithm is not supported
+    """
+    if algorithm == 'adler32':
+        return ZlibChecksum(zlib.adler32, 1)  # Adler-32 state must be initialized to 1 (not 0)
+    if algorithm == 'crc32':
+        return ZlibChecksum(zlib.crc32, 0)
+    if algorithm in HASHLIB:
+        return hashlib.new(algorithm)
+    raise ValueError(f"Unsupported checksum algorithm '{algorithm}'")
+
+def supported(algorithms: Iterable[str]) -> list[str]:
+    """
+    Filter a collection of checksum names down to the ones this module can calculate.
+
+    :param algorithms: checksum names
+    :return: list of supported names, in the original order
+    """
+    return [algo for algo in algorithms if algo in ALGORITHMS]
+
+def file_checksums(path: str, algorithms: Iterable[str] = ('adler32',),
+                   block_size: int = BLOCK_SIZE) -> dict:
+    """
+    Calculate several checksums of a file in a single pass.
+    The file is read in large blocks into a reused buffer, with a hint to the kernel that it
+    will be read sequentially so readahead can keep up.  zlib and hashlib release the GIL while
+    working on large blocks, so several files can be checksummed at once in threads.
+
+    :param path: path to the file
+    :param algorithms: checksum names
+    :param block_size: number of bytes to read at a time
+    :return: dictionary of {algorithm: hex checksum}
+    """
+    sums = {algo: new(algo) for algo in algorithms}
+    updates = [cksum.update for cksum in sums.values()]
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        while n_bytes := f.readinto(buffer):
+            block = view[:n_bytes]
+            for update in updates:
+                update(block)
+    return {algo: cksum.hexdigest() for algo, cksum in sums.items()}
+
+def file_key(stat: os.stat_result) -> tuple[int, int, int, int]:
+    """
+    Get the identity of a version of a file from its status.
+
+    :param stat: result of os.stat
+    :return: device, inode, size, and modification time in ns
+    """
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+class ChecksumCache:
+    """
+    SQLite store of file checksums, keyed by device, inode, size, and modification time.
+
+    Any change to a file changes its size or modification time, so entries for old versions of
+    a file are never returned and are replaced the next time the file is checksummed.  Entries
+    are dropped after the configured lifetime even if the file is unchanged, so the checksums of
+    long-lived files are still occasionally verified against the disk.  The cache may be used
+    from several threads at once.
+    """
+
+    def __init__(self, path: str, lifetime: float = 720.0):
+        """
+        Initialize the cache settings.  The database is opened when it is first used.
+
+        :param path: path to the SQLite database
+        :param lifetime: hours before entries expire
+        """
+        self.path = path
+        self.lifetime = lifetime * 3600
+        self.conn = None
+        self.failed = False
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def _open(self) -> bool:
+        """Open the database if necessary, returning False if the cache is unavailable"""
+        if self.conn is not None:
+            return True
+        if self.failed:
+            return False
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+            with self.conn:
+                self.conn.execute("DELETE FROM checksums WHERE stored < ?",
+                                  (time.time() - self.lifetime,))
+        except (OSError, sqlite3.Error) as err:
+            logger.warning("Failed to open checksum cache %s, caching disabled:\n  %s",
+                           self.path, err)
+            self.conn = None
+            self.failed = True
+            return False
+        logger.debug("Opened checksum cache %s", self.path)
+        return True
+
+    def close(self) -> None:
+        """Close the cache database."""
+        with self.lock:
+            if self.conn is not None:
+                logger.debug("Checksum cache hits: %d", self.hits)
+                self.conn.close()
+                self.conn = None
+
+    def lookup(self, stat: os.stat_result, algorithms: Iterable[str]) -> dict:
+        """
+        Look up the checksums of a file.
+
+        :param stat: result of os.stat for the file
+        :param algorithms: checksum names
+        :return: dictionary of {algorithm: hex checksum} for the algorithms found in the cache
+        """
+        algorithms = set(algorithms)
+        with self.lock:
+            if not self._open():
+                return {}
+            try:
+                rows = self.conn.execute(
+                    "SELECT algorithm, value FROM checksums "
+                    "WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?",
+                    file_key(stat)).fetchall()
+            except sqlite3.Error as err:
+                logger.warning("Failed to read checksum cache:\n  %s", err)
+                return {}
+            found = {algo: value for algo, value in rows if algo in algorithms}
+            if found:
+                self.hits += 1
+        return found
+
+    def store(self, stat: os.stat_result, sums: dict) -> None:
+        """
+        Store the checksums of a file, replacing any entries for older versions of it.
+
+        :param stat: result of os.stat for the file when it was read
+        :param sums: dictionary of {algorithm: hex checksum}
+        """
+        device, inode, size, mtime_ns = file_key(stat)
+        now = time.time()
+        with self.lock:
+            if not self._open():
+                return
+            try:
+                with self.conn:
+                    self.conn.execute(
+                        "DELETE FROM checksums WHERE device = ? AND inode = ? "
+                        "AND (size != ? OR mtime_ns != ?)", (device, inode, size, mtime_ns))
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO checksums "
+                        "(device, inode, size, mtime_ns, algorithm, value, stored) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(device, inode, size, mtime_ns, algo, value, now)
+                         for algo, value in sums.items()])
+            except sqlite3.Error as err:
+                logger.warning("Failed to update checksum cache:\n  %s", err)
+
+def adler32_combine(adler1: int, adler2: int, len2: int) -> int:
+    """
+    Combine the Adler-32 checksums of two blocks of data, like zlib's adler32_combine().
+
+    :param adler1: checksum of the first block
+    :param adler2: checksum of the second block
+    :param len2: length of the second block in bytes
+    :return: checksum of the two blocks concatenated
+    """
+    rem = len2 % ADLER_BASE
+    low1, high1 = adler1 & 0xffff, adler1 >> 16
+    low2, high2 = adler2 & 0xffff, adler2 >> 16
+    low = (low1 + low2 - 1) % ADLER_BASE
+    high = (high1 + high2 + rem * (low1 - 1)) % ADLER_BASE
+    return (high << 16) | low
+
+class ChecksumWriter(io.RawIOBase):
+    """
+    Binary file that keeps an Adler-32 checksum of its contents as it is written.
+
+    The file is divided into blocks, and the checksum of each block is updated as long as it is
+    written in order.  Blocks that are overwritten or written out of order (e.g. file headers
+    that are updated when the file is closed) are marked dirty and read back when the checksum
+    is finished, so only those blocks have to be read again.  The file can still be read and
+    seeked, so this works for random-access writers like HDF5 as well as streams like tar.gz.
+    """
+
+    def __init__(self, path: str, block_size: int = WRITE_BLOCK):
+        """
+        Create a new file, replacing any existing one.
+
+        :param path: path to the file
+        :param block_size: size of the blocks checksummed separately
+        """
+        super().__init__()
+        self.path = path
+        self.name = path
+        self.file = open(path, 'w+b', buffering=0) # pylint: disable=consider-using-with
+        self.block_size = block_size
+        self.blocks = {}  # {block index: [bytes written in order, checksum]}
+        self.dirty = set()
+        self.reread = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def readinto(self, buffer) -> int:
+        return self.file.readinto(buffer)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def write(self, data) -> int:
+        pos = self.file.tell()
+        n_bytes = self.file.write(data)
+        if n_bytes:
+            self._track(pos, memoryview(data).cast('B')[:n_bytes])
+        return n_bytes
+
+    def truncate(self, size: int = None) -> int:
+        size = self.file.truncate(size)
+        last = size // self.block_size
+        for idx in [idx for idx in self.blocks if idx >= last]:
+            del self.blocks[idx]
+            self.dirty.add(idx)
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+    def _track(self, pos: int, data: memoryview) -> None:
+        """Update the checksums of the blocks covered by a write"""
+        while data:
+            idx, offset = divmod(pos, self.block_size)
+            n_bytes = min(len(data), self.block_size - offset)
+            if idx not in self.dirty:
+                state = self.blocks.get(idx)
+                if state is None and offset == 0:
+                    state = self.blocks[idx] = [0, 1]
+                if state is not None and state[0] == offset:
+                    state[1] = zlib.adler32(data[:n_bytes], state[1])
+                    state[0] += n_bytes
+                else:
+                    self.blocks.pop(idx, None)
+                    self.dirty.add(idx)
+            pos += n_bytes
+            data = data[n_bytes:]
+
+    def checksums(self) -> dict:
+        """
+        Finish the checksum, reading back any blocks that were not written in order.
+        Any buffered writes must be flushed first.
+
+        :return: dictionary of {'adler32': hex checksum}
+        """
+        size = os.fstat(self.file.fileno()).st_size if not self.closed else \
+            os.path.getsize(self.path)
+        adler = 1
+        with open(self.path, 'rb', buffering=0) as f:
+            for idx in range(-(-size // self.block_size)):
+                length = min(self.block_size, size - idx * self.block_size)
+                state = self.blocks.get(idx)
+                if state is None or state[0] != length:
+                    f.seek(idx * self.block_size)
+                    value = zlib.adler32(f.read(length))
+                    self.reread += length
+                else:
+                    value = state[1]
+                adler = adler32_combine(adler, value, length)
+        return {'adler32': f"{adler:08x}"}
+
+    def finish(self) -> dict:
+        """
+        Close the file, then record its checksums in a sidecar file next to it.
+
+        :return: dictionary of {'adler32': hex checksum}
+        """
+        self.close()
+        sums = self.checksums()
+        write_sidecar(self.path, sums)
+        return sums
+
+def open_output(path: str) -> io.BufferedRandom:
+    """
+    Open a new output file that is checksummed as it is written.
+    Call finish() on the raw attribute of the returned file after closing it to write the sidecar.
+
+    :param path: path to the file
+    :return: buffered binary file wrapping a ChecksumWriter
+    """
+    return io.BufferedRandom(ChecksumWriter(path), BLOCK_SIZE)
+
+def write_sidecar(path: str, sums: dict) -> None:
+    """
+    Record the checksums of a file that was just written, along with its size and mtime.
+
+    :param path: path to the file
+    :param sums: dictionary of {algorithm: hex checksum}
+    """
+    stat = os.stat(path)
+    data = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'checksums': sums}
+    with open(path + SIDECAR, 'w', encoding="utf-8") as f:
+        json.dump(data, f)
+
+def read_sidecar(path: str, algorithms: Iterable[str] = ('adler32',)) -> dict | None:
+    """
+    Read the checksums of a file from its sidecar, if it is still valid.
+    The sidecar is ignored if the file has changed since it was written.
+
+    :param path: path to the file
+    :param algorithms: checksum names that must be present
+    :return: dictionary of {algorithm: hex checksum}, or None if there is no usable sidecar
+    """
+    try:
+        with open(path + SIDECAR, encoding="utf-8") as f:
+            data = json.load(f)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if data.get('size') != stat.st_size or data.get('mtime_ns') != stat.st_mtime_ns:
+        logger.debug("Ignoring stale checksum sidecar for %s", path)
+        return None
+    sums = data.get('checksums', {})
+    if any(algo not in sums for algo in algorithms):
+        return None
+    return {algo: sums[algo] for algo in algorithms}
+
+def default_threads() -> int:
+    """Get a reasonable number of checksum threads for this machine"""
+    return min(8, os.cpu_count() or 1)
+
+class Hasher:
+    """
+    Checksum files on a pool of threads, either from asyncio code or in bulk.
+    """
+
+    def __init__(self, threads: int = None, cache: ChecksumCache = None):
+        """
+        Initialize the hasher.  The thread pool is only started when it is first needed.
+        Without a thread count, asyncio checksums run on the event loop's default executor.
+
+        :param threads: maximum number of files to checksum at once (default from the CPU count)
+        :param cache: optional ChecksumCache to reuse the checksums of unchanged files
+        """
+        self.threads = threads
+        self.cache = cache
+        self.executor = None
+
+    def pool(self) -> Executor:
+        """Get the thread pool, starting it if necessary"""
+        if self.executor is None:
+            threads = max(1, int(self.threads or default_threads()))
+            self.executor = ThreadPoolExecutor(threads, thread_name_prefix='checksum')
+        return self.executor
+
+    def close(self) -> None:
+        """Shut down the thread pool and close the cache"""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.cache is not None:
+            self.cache.close()
+
+    def compute(self, path: str, algorithms: Iterable[str] = ('adler32',)) -> dict:
+        """
+        Calculate the checksums of a file, using the cache if there is one.
+        Only the algorithms missing from the cache are calculated, and the results are only
+        stored if the file did not change while it was being read.
+
+        :param path: path to the file
+        :param algorithms: checksum names
+        :return: dictionary of {algorithm: hex checksum}
+        """
+        if self.cache is None:
+            return file_checksums(path, algorithms)
+        stat = os.stat(path)
+        sums = self.cache.lookup(stat, algorithms)
+        missing = [algo for algo in algorithms if algo not in sums]
+        if not missing:
+            logger.debug("Using cached checksums for %s", path)
+            return sums
+        new_sums = file_checksums(path, missing)
+        if file_key(os.stat(path)) == file_key(stat):
+            self.cache.store(stat, new_sums)
+        else:
+            logger.debug("File %s changed while it was being checksummed", path)
+        sums.update(new_sums)
+        return {algo: sums[algo] for algo in algorithms}
+
+    async def checksums(self, path: str, algorithms: Iterable[str] = ('adler32',)) -> dict:
+        """
+        Calculate the checksums of a file without blocking the event loop.
+
+        :param path: path to the file
+        :param algorithms: checksum names
+        :return: dictionary of {algorithm: hex checksum}
+        """
+        loop = asyncio.get_running_loop()
+        executor = self.pool() if self.threads else None
+        return await loop.run_in_executor(executor, self.compute, path, tuple(algorithms))
+
+    def map(self, paths: Iterable[str], algorithms: Iterable[str] = ('adler32',)) -> dict:
+        """
+        Calculate the checksums of several files at once.
+
+        :param paths: paths to the files
+        :param algorithms: checksum names
+        :return: dictionary of {path: {algorithm: hex checksum}}
+        """
+        paths = list(paths)
+        algorithms = tuple(algorithms)
+        if len(paths) <= 1:
+            return {path: self.compute(path, algorithms) for path in paths}
+        results = self.pool().map(self.compute, paths, [algorithms] * len(paths))
+        return dict(zip(paths, results))
@@ -22,6 +22,8 @@ OList = Optional[list]
 
 # Configuration dictionary
 cfg_dict = ConfigDict()
+# Incremented whenever a configuration file is applied, so derived data can be recompiled
+generation = 0
 
 def __getattr__(name: str) -> Any:
     return cfg_dict.__getattr__(name)
@@ -85,7 +87,18 @@ def update(file_name: str) -> None:
     :param file_name: Name of the configuration file.
     :return: None
     """
-    cfg = io_utils.read_config_file(file_name)
+    apply(io_utils.read_config_file(file_name), file_name)
+
+def apply(cfg: dict, file_name: str) -> None:
+    """
+    Update the global configuration with a dictionary of settings.
+
+    :param cfg: Dictionary of configuration settings.
+    :param file_name: Name of the configuration file the settings came from.
+    :return: None
+    """
+    global generation # pylint: disable=global-statement
+    generation += 1
     errors = []
     # Check version compatibility
     ver = cfg.pop('version', None)
@@ -242,13 +255,15 @@ def dump() -> None:
     :return: None
     """
     dest = cfg_dict.job.dir
-    json_dump = json.dumps(cfg_dict, default=custom_serializer, indent=2)
     if dest:
+        # Input lists can be very long, so keep the saved copy compact
+        json_dump = snapshot()
         dest = os.path.join(str(dest), 'config.json')
         logger.info("Config written to:\n  %s", dest)
         with open(dest, 'w', encoding="utf-8") as f:
             f.write(json_dump)
     else:
+        json_dump = json.dumps(cfg_dict, default=custom_serializer, indent=2)
         logger.info("Config:\n%s", json_dump)
 
 def override(args: dict, arg: str, option: ConfigKey, name: OStr = None) -> OStr:
@@ -327,22 +342,49 @@ def set_cmd_opts(args: dict) -> None:
     override(args, "namespace", cfg_dict.output.namespace, "output namespace")
     override(args, "method", cfg_dict.method.method_name, "merge method")
 
-def load(args: Optional[dict] = None) -> None:
+def load_defaults() -> None:
     """
-    Load the specified configuration files.
-    Missing keys will be filled in with the defaults in DEFAULT_CONFIG.
-    
-    :param args: List of configuration files.
+    Load the default configuration files and lock the config schema.
+
     :return: None
     """
-    io_utils.log_print("Loading configuration...")
-    # Load default configuration files first
     defaults_dir = os.path.join(io_utils.pkg_dir(), 'config', 'defaults')
     for cfg_file in os.listdir(defaults_dir):
         path = os.path.join(defaults_dir, cfg_file)
         if os.path.isfile(path):
             update(path)
     cfg_dict._lock()  # pylint: disable=protected-access
+
+def snapshot() -> str:
+    """
+    Get a picklable snapshot of the current configuration, e.g. for worker processes.
+
+    :return: JSON string of the configuration settings
+    """
+    return json.dumps(cfg_dict, default=custom_serializer, separators=(',', ':'))
+
+def restore(cfg: str) -> None:
+    """
+    Replace the current configuration with a snapshot.
+
+    :param cfg: JSON string from snapshot()
+    :return: None
+    """
+    if not cfg_dict._locked: # pylint: disable=protected-access
+        load_defaults()
+    cfg_dict._clear() # pylint: disable=protected-access
+    apply(json.loads(cfg), "config snapshot")
+
+def load(args: Optional[dict] = None) -> None:
+    """
+    Load the specified configuration files.
+    Missing keys will be filled in with the defaults in DEFAULT_CONFIG.
+    
+    :param args: List of configuration files.
+    :return: None
+    """
+    io_utils.log_print("Loading configuration...")
+    load_defaults()
     logger.info("Loaded default configuration files.")
 
     if args is None:
@@ -386,8 +428,20 @@ def resume(job_dir: str, args: dict) -> None:
     update(cfg_file)
     logger.info("Loaded old configuration file.")
 
+    # Apply any new user config files, e.g. to re-schedule with different options
+    user_cfgs = args.pop("config", [])
+    for cfg_file in user_cfgs:
+        update(cfg_file)
+        cfg_dict.job.config_files.append(cfg_file)
+    if user_cfgs:
+        logger.info("Loaded new user configuration files.")
+
     # Override output mode
     out_mode = override(args, "output_mode", cfg_dict.output.mode)
     local = override(args, "local", cfg_dict.output.local)
     if local and out_mode in ['validate', 'dids']:
         logger.warning("Option --local has no effect in output mode '%s'", out_mode)
+
+    # Save the updated settings so they also apply if the job is resumed again
+    if user_cfgs:
+        dump()
@@ -5,9 +5,11 @@ import sys
 import logging
 import logging.config
 import json
+import gzip
 import pathlib
 import math
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator
+from typing import Callable
 
 # tomllib was added to the standard library in Python 3.10, need tomli for DUNE
 try:
@@ -133,6 +135,35 @@ def read_json(path: str) -> dict:
         return None
     return cfg
 
+def write_jsonl(path: str, records: Iterable, default: Callable = None) -> None:
+    """
+    Write records to a gzip-compressed JSON-lines file, one compact record per line.
+    The file is written under a temporary name and moved into place, so readers never see a
+    partially written file.
+
+    :param path: Path to the output file
+    :param records: Iterable of JSON-serializable records
+    :param default: Optional serializer for objects that JSON cannot handle natively
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with gzip.open(tmp_path, 'wt', encoding="utf-8", compresslevel=6) as f:
+        for record in records:
+            f.write(json.dumps(record, separators=(',', ':'), default=default))
+            f.write('\n')
+    os.replace(tmp_path, path)
+
+def iter_jsonl(path: str) -> Iterator:
+    """
+    Lazily read records from a gzip-compressed JSON-lines file.
+
+    :param path: Path to the input file
+    :return: Iterator over the decoded records
+    """
+    with gzip.open(path, 'rt', encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
 def read_config_file(name: str = None) -> dict:
     """
     Read a configuration file in JSON, TOML, or YAML format
@@ -11,13 +11,11 @@ logger = logging.getLogger(__name__)
 
 SITE_STORAGE_URL = "/api/info/sites_storages.csv"
 
-async def get_site_rse_distances() -> dict:
+async def get_site_rse_rows() -> list:
     """
-    Retrieve site-RSE distances from the JustIN web API.
-    Adds site distance offsets from the config
-    Does NOT add RSE distance offsets, since those are already accounted for by the PathFinder
+    Retrieve the raw site-RSE distance table from the JustIN web API.
 
-    :return: dictionary of {rse: {site: distance}} for all reachable site-RSE pairs
+    :return: list of {site, rse, dist, site_enabled, rse_read, rse_write} rows, or [] on failure
     """
     # Query JustIN for site-RSE distances
     full_url = str(config.sites.justin_url) + SITE_STORAGE_URL
@@ -28,14 +26,24 @@ async def get_site_rse_distances() -> dict:
         logger.error("JustIN connection error: %s", err)
         connected = False
     if not connected:
-        return {}
+        return []
     # Parse the CSV response
-    distances = {}
     text = res.iter_lines(decode_unicode=True)
     fields = ['site', 'rse', 'dist', 'site_enabled', 'rse_read', 'rse_write']
-    reader = csv.DictReader(text, fields)
+    return list(csv.DictReader(text, fields))
+
+def site_rse_distances(rows: list) -> dict:
+    """
+    Convert the raw JustIN site-RSE table to distances.
+    Adds site distance offsets from the config
+    Does NOT add RSE distance offsets, since those are already accounted for by the PathFinder
+
+    :param rows: list of rows from get_site_rse_rows()
+    :return: dictionary of {rse: {site: distance}} for all reachable site-RSE pairs
+    """
+    distances = {}
     default_dist = config.sites.site_distances['default']
-    for row in reader:
+    for row in rows:
         # Skip disabled sites and RSEs with no read/write access
         if not row['site_enabled']:
             continue
@@ -54,3 +62,13 @@ async def get_site_rse_distances() -> dict:
         else:
             distances[rse] = {site: distance}
     return distances
+
+async def get_site_rse_distances() -> dict:
+    """
+    Retrieve site-RSE distances from the JustIN web API.
+    Adds site distance offsets from the config
+    Does NOT add RSE distance offsets, since those are already accounted for by the PathFinder
+
+    :return: dictionary of {rse: {site: distance}} for all reachable site-RSE pairs
+    """
+    return site_rse_distances(await get_site_rse_rows())
@@ -0,0 +1,201 @@
+"""Asynchronous measurement of network latency to RSE hosts, with a cache shared between jobs."""
+
+from __future__ import annotations
+import os
+import time
+import socket
+import sqlite3
+import logging
+import asyncio
+from typing import Iterable
+
+from merge_utils import config, naming
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS latency (
+    host TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    ms REAL,
+    measured REAL NOT NULL,
+    PRIMARY KEY (host, port)
+);
+"""
+
+async def connect_time(host: str, port: int, timeout: float) -> float:
+    """
+    Time how long it takes to open a TCP connection to a host, excluding the DNS lookup.
+
+    :param host: host name
+    :param port: port number
+    :param timeout: seconds to wait for the lookup and the connection
+    :return: connection time in ms, or infinity if the host is unreachable
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        addrs = await asyncio.wait_for(
+            loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), timeout)
+        family, _, _, _, addr = addrs[0]
+        start = time.perf_counter()
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(addr[0], port, family=family), timeout)
+        elapsed = (time.perf_counter() - start) * 1000
+    except (OSError, IndexError, asyncio.TimeoutError) as err:
+        logger.debug("Failed to connect to %s:%d: %s", host, port, err or "timed out")
+        return float('inf')
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    logger.debug("Connected to %s:%d, t = %.1f ms", host, port, elapsed)
+    return elapsed
+
+class LatencyCache:
+    """
+    Measure connection times to hosts, remembering the results in an SQLite database.
+
+    Latencies are reused for the configured lifetime, and hosts that could not be reached are
+    remembered for the shorter retry time so they don't slow down every job.  Each host is only
+    measured once per process, even if several RSEs on that host ask for it at the same time.
+    """
+
+    def __init__(self, path: str = None, lifetime: float = None, retry: float = None,
+                 timeout: float = None, port: int = None):
+        """
+        Initialize the cache settings.
+
+        :param path: path to the SQLite database (default from config, None if disabled)
+        :param lifetime: hours before measured latencies expire (default from config)
+        :param retry: hours before unreachable hosts are tried again (default from config)
+        :param timeout: seconds to wait for a connection (default from config)
+        :param port: port to connect to if a URL has none (default from config)
+        """
+        cfg = config.sites.latency
+        if path is None and cfg.cache.enabled:
+            naming.Formatter().format(cfg.cache.path)
+            path = str(cfg.cache.path)
+        self.path = path
+        if lifetime is None:
+            lifetime = float(cfg.cache.lifetime)
+        if retry is None:
+            retry = float(cfg.cache.retry)
+        self.lifetime = lifetime * 3600
+        self.retry = min(retry, lifetime) * 3600
+        self.timeout = float(timeout or cfg.timeout)
+        self.port = int(port or cfg.port)
+        self.conn = None
+        self.tasks = {}
+
+    def open(self) -> None:
+        """Open the cache database, creating it if necessary and purging expired entries."""
+        if self.conn is not None or not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=60)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+            now = time.time()
+            with self.conn:
+                self.conn.execute("DELETE FROM latency WHERE measured < ?", (now - self.lifetime,))
+                self.conn.execute("DELETE FROM latency WHERE ms IS NULL AND measured < ?",
+                                  (now - self.retry,))
+        except (OSError, sqlite3.Error) as err:
+            logger.warning("Failed to open latency cache %s, caching disabled:\n  %s",
+                           self.path, err)
+            self.conn = None
+            return
+        logger.debug("Opened latency cache %s", self.path)
+
+    def close(self) -> None:
+        """Close the cache database."""
+        if self.conn is None:
+            return
+        self.conn.close()
+        self.conn = None
+
+    def lookup(self, host: str, port: int) -> float | None:
+        """
+        Look up a host in the cache.
+
+        :param host: host name
+        :param port: port number
+        :return: latency in ms (infinity if unreachable), or None if not cached
+        """
+        if self.conn is None:
+            return None
+        try:
+            row = self.conn.execute("SELECT ms, measured FROM latency WHERE host = ? AND port = ?",
+                                    (host, port)).fetchone()
+        except sqlite3.Error as err:
+            logger.warning("Failed to read latency cache:\n  %s", err)
+            return None
+        if row is None:
+            return None
+        ms, measured = row
+        age = time.time() - measured
+        if ms is None:
+            return float('inf') if age < self.retry else None
+        return ms if age < self.lifetime else None
+
+    def store(self, host: str, port: int, ms: float) -> None:
+        """
+        Store a measured latency in the cache.
+
+        :param host: host name
+        :param port: port number
+        :param ms: latency in ms, or infinity if the host was unreachable
+        """
+        if self.conn is None:
+            return
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO latency (host, port, ms, measured) VALUES (?, ?, ?, ?)",
+                    (host, port, None if ms == float('inf') else ms, time.time()))
+        except sqlite3.Error as err:
+            logger.warning("Failed to update latency cache:\n  %s", err)
+
+    async def _measure(self, host: str, port: int) -> float:
+        """Get the latency to a host from the cache, or measure it"""
+        ms = self.lookup(host, port)
+        if ms is not None:
+            logger.debug("Using cached latency for %s:%d (%.1f ms)", host, port, ms)
+            return ms
+        ms = await connect_time(host, port, self.timeout)
+        self.store(host, port, ms)
+        return ms
+
+    async def get(self, host: str, port: int = None) -> float:
+        """
+        Get the latency to a host.
+
+        :param host: host name
+        :param port: port number (default from config)
+        :return: latency in ms, or infinity if the host is unreachable
+        """
+        key = (host, int(port or self.port))
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = asyncio.ensure_future(self._measure(*key))
+        return await task
+
+    async def best(self, hosts: Iterable[tuple[str, int]]) -> float:
+        """
+        Get the lowest latency to any of a set of hosts, measuring them all at once.
+
+        :param hosts: collection of (host, port) pairs, the port may be None for the default
+        :return: lowest latency in ms, or infinity if none of the hosts are reachable
+        """
+        results = await asyncio.gather(*[self.get(host, port) for host, port in set(hosts)])
+        return min(results, default=float('inf'))
+
+def get() -> LatencyCache:
+    """
+    Create a latency cache based on the configuration.
+
+    :return: LatencyCache object
+    """
+    return LatencyCache()
@@ -3,10 +3,12 @@
 from __future__ import annotations
 import os
 import sys
+import bisect
 import collections
 import logging
 import math
 import enum
+from collections.abc import Mapping
 from typing import Iterable, Generator, Optional
 
 from merge_utils import io_utils, config, meta, metacat_utils
@@ -76,21 +78,104 @@ ERROR_MESSAGES = {
     MergeFileError.ALREADY_DONE: "Found {n} file{s} that have already been merged by another job:"
 }
 
+def compact_fid(fid):
+    """
+    Store numeric FIDs as integers, which take much less memory than strings.
+
+    :param fid: FID from MetaCat
+    :return: integer FID if it round-trips exactly, otherwise the original value
+    """
+    if isinstance(fid, str) and fid.isdigit() and str(int(fid)) == fid:
+        return int(fid)
+    return fid
+
+def intern_value(value):
+    """
+    Intern string metadata values (and strings in lists), so repeated values share one object.
+
+    :param value: metadata value
+    :return: interned value
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return [sys.intern(v) if isinstance(v, str) else v for v in value]
+    return value
+
+class FileMetadata(Mapping):
+    """
+    Read-only view of the metadata for one file, stored as differences from a base dictionary
+    shared by all the files in a MergeSet.  Most keys have the same value for every file in a
+    dataset, so each file only needs to keep the handful of values that are unique to it.
+    """
+    __slots__ = ('_base', '_own', '_drop', '_len')
+
+    def __init__(self, base: dict, metadata: dict):
+        """
+        Initialize the view from a full metadata dictionary.
+
+        :param base: shared metadata dictionary
+        :param metadata: full metadata for this file
+        """
+        self._base = base
+        self._own = {}
+        for key, value in metadata.items():
+            if key in base:
+                shared = base[key]
+                if type(shared) is type(value) and shared == value: # pylint: disable=unidiomatic-typecheck
+                    continue
+            self._own[sys.intern(key)] = intern_value(value)
+        drop = [key for key in base if key not in metadata]
+        self._drop = frozenset(drop) if drop else None
+        self._len = len(metadata)
+
+    def __getitem__(self, key):
+        try:
+            return self._own[key]
+        except KeyError:
+            pass
+        if self._drop is not None and key in self._drop:
+            raise KeyError(key)
+        return self._base[key]
+
+    def __iter__(self):
+        for key in self._base:
+            if key in self._own or (self._drop is not None and key in self._drop):
+                continue
+            yield key
+        yield from self._own
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
 class MergeFile:
     """A generic data file with metadata"""
+    __slots__ = ('_did', 'errors', 'fid', 'parents', 'replicas', 'size', 'checksums', 'metadata')
 
-    def __init__(self, data: dict):
-        """Initialize the MergeFile with a metadata dictionary"""
+    def __init__(self, data: dict, plan: meta.ValidationPlan = None):
+        """
+        Initialize the MergeFile with a metadata dictionary
+
+        :param data: file record from MetaCat
+        :param plan: compiled validation plan (default: the plan for the current config)
+        """
         # Set name and check for errors
         self._did = f"{data['namespace']}:{data['name']}"
         self.errors = data.get('errors', MergeFileError(0))
         if isinstance(self.errors, str):
             self.errors = MergeFileError[self.errors]
+        self.fid = compact_fid(data.get('fid', None))
+        self.parents = set()
+        self.replicas = []
+        self.size = data.get('size', None)
+        self.checksums = data.get('checksums') or {}
+        self.metadata = data.get('metadata') or {}
         if self.errors:
             return
-        # Set FIDs and check for undeclared files
-        self.fid = data.get('fid', None)
-        self.parents = set()
+        # Check for undeclared files
         if config.output.grandparents:
             self.set_parents(data.get('parents', []))
         elif self.fid is None:
@@ -102,11 +187,39 @@ class MergeFile:
             self.errors |= MergeFileError.RETIRED
             return
         # Set other metadata and validate
-        self.replicas = []
-        self.size = data.get('size', None)
         self.checksums = data['checksums']
         self.metadata = data['metadata']
-        self.validate()
+        self.validate(plan)
+
+    @classmethod
+    def from_batch(cls, files: Iterable[dict]) -> list[MergeFile]:
+        """
+        Create and validate MergeFile objects for a whole batch of file records at once.
+
+        :param files: collection of file records from MetaCat, e.g. an InputBatch
+        :return: list of MergeFile objects, in the same order as the records
+        """
+        plan = meta.validation_plan()
+        return [cls(data, plan) for data in files]
+
+    def summary(self) -> tuple:
+        """Compact, picklable form of the file, e.g. for returning from a worker process"""
+        return (self._did, self.errors, self.fid, tuple(self.parents), self.size, self.checksums,
+                self.metadata)
+
+    @classmethod
+    def from_summary(cls, summary: tuple) -> MergeFile:
+        """
+        Recreate an already validated file from its summary.
+
+        :param summary: tuple from MergeFile.summary()
+        :return: MergeFile object
+        """
+        file = cls.__new__(cls)
+        file._did, file.errors, file.fid, parents, file.size, file.checksums, file.metadata = summary
+        file.parents = set(parents)
+        file.replicas = []
+        return file
 
     def set_parents(self, parents: Iterable) -> None:
         """Set the parent FIDs for the file, checking for any missing FIDs"""
@@ -115,7 +228,7 @@ class MergeFile:
         for parent in parents:
             fid = parent.get('fid')
             if fid:
-                self.parents.add(fid)
+                self.parents.add(compact_fid(fid))
                 continue
             if 'did' in parent:
                 missing.add(parent['did'])
@@ -128,8 +241,14 @@ class MergeFile:
             io_utils.log_list("File %s has {n} parent{s} without an FID:" % self.did,
                               list(missing), logging.ERROR)
 
-    def validate(self) -> None:
-        """Check for errors or invalid metadata"""
+    def validate(self, plan: meta.ValidationPlan = None) -> None:
+        """
+        Check for errors or invalid metadata
+
+        :param plan: compiled validation plan (default: the plan for the current config)
+        """
+        if plan is None:
+            plan = meta.validation_plan()
         if not self.size:
             logger.error("No size for %s", self)
             self.errors |= MergeFileError.INVALID
@@ -138,13 +257,13 @@ class MergeFile:
             logger.error("No checksums for %s", self)
             self.errors |= MergeFileError.INVALID
             return
-        algos = set(str(algo) for algo in config.validation.checksums)
-        self.checksums = {algo: csum for algo, csum in self.checksums.items() if algo in algos}
+        self.checksums = {sys.intern(algo): csum for algo, csum in self.checksums.items()
+                          if algo in plan.checksums}
         if len(self.checksums) == 0:
             logger.warning("No valid checksum for %s", self)
             self.errors |= MergeFileError.INVALID
             return
-        if not meta.validate(self.did, self.metadata):
+        if not plan.validate(self.did, self.metadata):
             self.errors |= MergeFileError.INVALID
 
     @property
@@ -205,8 +324,14 @@ class MergeSet:
     """Class to keep track of a set of files for merging"""
 
     def __init__(self):
-        self._files = []
+        self._files = {}        # Sparse map of input index to MergeFile
+        self._order = []        # Sorted input indices, rebuilt lazily when set to None
+        self._bad = {}          # Files with any errors, by input index
+        self._by_error = {}     # Files with errors, grouped by their first error
+        self._shared = None     # Metadata shared by the files, see FileMetadata
+        self._meta = meta.MetaAccumulator() # Merged metadata of the good files
         self.start_idx = config.input.skip or 0
+        self._end_idx = self.start_idx
         self.dids = {}
         self.errors = MergeFileError(0)
         self.consistent_fields = None
@@ -215,11 +340,23 @@ class MergeSet:
     @property
     def end_idx(self) -> int:
         """Get the index of the end of the set (one past the last file)"""
-        return self.start_idx + len(self._files)
+        return self._end_idx
+
+    @property
+    def indices(self) -> list[int]:
+        """Sorted list of the input indices of all files in the set"""
+        if self._order is None:
+            self._order = sorted(self._files)
+        return self._order
 
     def __len__(self) -> int:
         """Get the number of files in the set"""
-        return len([f for f in self._files if f is not None])
+        return len(self._files)
+
+    @property
+    def good_count(self) -> int:
+        """Get the number of good files in the set"""
+        return len(self._files) - sum(1 for file in self._bad.values() if not file.good)
 
     def get_by_idx(self, idx: int) -> MergeFile | None:
         """
@@ -230,10 +367,7 @@ class MergeSet:
         """
         if idx < 0:
             raise IndexError("MergeSet indices must be non-negative")
-        idx -= self.start_idx
-        if idx < 0 or idx >= len(self._files):
-            return None
-        return self._files[idx]
+        return self._files.get(idx)
 
     def at(self, idx: int) -> MergeFile:
         """
@@ -257,10 +391,7 @@ class MergeSet:
         idx = self.dids.get(did, None)
         if idx is None:
             raise KeyError(f"Unknown file DID: {did}")
-        out = self._files[idx - self.start_idx]
-        if out is None:
-            raise KeyError(f"File DID {did} at index {idx} is None")
-        return out
+        return self._files[idx]
 
     def get_slice(self, start: int = 0, end: int = 0, step: int = 1) -> list[MergeFile]:
         """
@@ -276,12 +407,33 @@ class MergeSet:
         step = step or 1
         if start < 0 or end < 0:
             raise IndexError("MergeSet indices must be non-negative")
-        files = []
-        for idx in range(start, end, step):
-            file = self.get_by_idx(idx)
-            if file is not None:
-                files.append(file)
-        return files
+        order = self.indices
+        selected = order[bisect.bisect_left(order, start):bisect.bisect_left(order, end)]
+        if step != 1:
+            selected = [idx for idx in selected if (idx - start) % step == 0]
+        return [self._files[idx] for idx in selected]
+
+    def _flag(self, idx: int, file: MergeFile, error: MergeFileError) -> None:
+        """
+        Add errors to a file in the set and update the error indexes.
+
+        :param idx: index of the file
+        :param file: MergeFile object at the index
+        :param error: MergeFileError to add
+        """
+        old_first = file.errors.first if idx in self._bad else None
+        file.errors |= error
+        if not file.errors:
+            return
+        if error:
+            self._meta = None
+        self._bad[idx] = file
+        first = file.errors.first
+        if first != old_first:
+            if old_first is not None:
+                del self._by_error[old_first][idx]
+            self._by_error.setdefault(first, {})[idx] = file
+        self.errors |= file.errors
 
     def insert(self, idx: int, file: MergeFile) -> None:
         """
@@ -293,36 +445,38 @@ class MergeSet:
         # Index must be non-negative
         if idx < 0:
             raise IndexError(f"Index {idx} is out of bounds for setting file")
-        # If the index is before the start index, shift the existing files and pad with None
-        if idx < self.start_idx:
-            pad = self.start_idx - idx - 1
-            logger.debug("Shifting MergeSet start by %d to add file at index %d", pad + 1, idx)
-            self._files = [file] + [None]*pad + self._files
-            self.start_idx = idx
-        # If the index is beyond the current list, extend the list and pad with None
-        elif idx >= self.end_idx:
-            pad = idx - self.end_idx
-            logger.debug("Extending MergeSet end by %d to add file at index %d", pad + 1, idx)
-            self._files.extend([None]*pad + [file])
-        # Otherwise, just set the file at the index
-        else:
-            old_file = self._files[idx - self.start_idx]
-            if old_file is not None:
-                raise IndexError(f"MergeSet index {idx} already contains file {old_file.did}")
-            logger.debug("Inserting file into MergeSet at index %d", idx)
-            self._files[idx - self.start_idx] = file
-        # Add to the DID index if the file is not None and not a duplicate
         if file is None:
             return
+        old_file = self._files.get(idx)
+        if old_file is not None:
+            raise IndexError(f"MergeSet index {idx} already contains file {old_file.did}")
+        logger.debug("Inserting file into MergeSet at index %d", idx)
+        self._files[idx] = file
+        # Files normally arrive in order, so only re-sort if this one doesn't
+        if self._order is not None:
+            if self._order and idx < self._order[-1]:
+                self._order = None
+            else:
+                self._order.append(idx)
+        self.start_idx = min(self.start_idx, idx)
+        self._end_idx = max(self._end_idx, idx + 1)
+        # Add to the DID index if the file is not a duplicate
         did = file.did
         if did in self.dids:
             file.errors |= MergeFileError.DUPLICATE
         else:
             self.dids[did] = idx
         # Check for errors
-        self.errors |= file.errors
+        self._flag(idx, file, MergeFileError(0))
         if not file.good:
             return
+        # Store metadata as differences from the first good file
+        if isinstance(file.metadata, dict):
+            if self._shared is None:
+                self._shared = {sys.intern(k): intern_value(v) for k, v in file.metadata.items()}
+            file.metadata = FileMetadata(self._shared, file.metadata)
+        if self._meta is not None:
+            self._meta.add(file.metadata)
         # Check for consistency
         if self.consistent_fields is None:
             self.consistent_fields = file.get_fields(config.metadata.consistent)
@@ -330,16 +484,21 @@ class MergeSet:
             if file.get_fields(config.metadata.consistent) != self.consistent_fields:
                 self.errors |= MergeFileError.INCONSISTENT
 
-    def add(self, skip: int, files: Iterable) -> list:
+    def add(self, skip: int, files: Iterable, validated: list[MergeFile] = None) -> list:
         """
         Add a batch of files to the set.
 
+        :param skip: index of the first file in the batch
         :param files: collection of dictionaries with file metadata
+        :param validated: MergeFile objects already made from the dictionaries, e.g. by worker
+            processes (default: validate the files here)
         :return: list of good MergeFile objects that were added
         """
         new_files = []
-        for idx, file in enumerate(files, start=skip):
-            new_file = MergeFile(file)
+        files = list(files)
+        if validated is None:
+            validated = MergeFile.from_batch(files)
+        for idx, (file, new_file) in enumerate(zip(files, validated), start=skip):
             for child in file.get('children', []):
                 if child['fid'] in self.children:
                     new_file.errors |= MergeFileError.ALREADY_DONE
@@ -350,30 +509,48 @@ class MergeSet:
         logger.info("Added %d valid files from batch %d", len(new_files), skip)
         return new_files
 
+    @property
+    def metadata(self) -> meta.MetaAccumulator:
+        """Accumulated metadata of the good files in the set"""
+        if self._meta is None or self._meta.count != self.good_count:
+            self._meta = meta.MetaAccumulator(self.good_files)
+        return self._meta
+
     @property
     def all_files(self) -> list[MergeFile]:
         """List of all MergeFile objects in the set, including bad files"""
-        return [f for f in self._files if f]
+        return [self._files[idx] for idx in self.indices]
 
     @property
     def good_files(self) -> list[MergeFile]:
         """List of good MergeFile objects in the set"""
-        return [f for f in self._files if f and f.good]
+        return [file for _, file in self.enum_good]
 
     @property
     def enum(self) -> Generator[tuple[int, MergeFile], None, None]:
         """Generator of (index, MergeFile) for all files in the set"""
-        for idx, file in enumerate(self._files, start=self.start_idx):
-            if file:
-                yield idx, file
+        for idx in self.indices:
+            yield idx, self._files[idx]
 
     @property
     def enum_good(self) -> Generator[tuple[int, MergeFile], None, None]:
         """Generator of (index, MergeFile) for good files in the set"""
-        for idx, file in self.enum:
-            if file.good:
+        bad = self._bad
+        for idx in self.indices:
+            file = self._files[idx]
+            if idx not in bad or file.good:
                 yield idx, file
 
+    def error_files(self, error: MergeFileError) -> list[MergeFile]:
+        """
+        List the files whose first error is a specific error, in index order.
+
+        :param error: MergeFileError to look up
+        :return: list of MergeFile objects
+        """
+        files = self._by_error.get(error, {})
+        return [files[idx] for idx in sorted(files)]
+
     def set_error(self, dids: Iterable[str], error: MergeFileError) -> None:
         """
         Mark files as having a specific error.
@@ -385,8 +562,10 @@ class MergeSet:
             raise ValueError("Cannot set empty error on files")
         err_count = 0
         for did in dids:
-            file = self.get_by_did(did)
-            file.errors |= error
+            idx = self.dids.get(did, None)
+            if idx is None:
+                raise KeyError(f"Unknown file DID: {did}")
+            self._flag(idx, self._files[idx], error)
             err_count += 1
         if err_count > 0:
             err_name = str(error).rsplit('.', 1)[-1]
@@ -427,7 +606,7 @@ class MergeSet:
             msg.append(f"Group {gid} ({len(group)} file{'s' if len(group) > 1 else ''}):")
             for did, idx in group:
                 msg.append(f"  {did}")
-                self.at(idx).errors |= MergeFileError.INCONSISTENT
+                self._flag(idx, self.at(idx), MergeFileError.INCONSISTENT)
             msg.append(f"Group {gid} metadata inconsistencies:")
             for field, good_val, bad_val in zip(field_names, self.consistent_fields, fields):
                 if good_val == bad_val:
@@ -466,18 +645,18 @@ class MergeSet:
             if err == MergeFileError.INCONSISTENT:
                 logger.log(lvl, '\n  '.join(inconsistencies))
                 continue
-            err_dids = [file.did for file in self._files if file and file.errors.first == err]
+            err_dids = [file.did for file in self.error_files(err)]
             io_utils.log_list(ERROR_MESSAGES[err], err_dids, lvl)
         # Quit if needed
         if abort:
             io_utils.log_nonzero(
                 "Found {n} total file{s} with critical errors!",
-                sum(1 for file in self._files if file and file.errors.first in critical_errors),
+                sum(len(files) for err, files in self._by_error.items() if err in critical_errors),
                 logging.CRITICAL
             )
             sys.exit(1)
         # Check for empty set after errors
-        if final and len(self.good_files) == 0:
+        if final and self.good_count == 0:
             logger.critical("No valid files remain after error checking!")
             sys.exit(1)
 
@@ -577,14 +756,14 @@ class MergeSet:
     def groups(self) -> Generator[MergeChunk, None, None]:
         """Split the files into groups for merging"""
         # Finish expanding all names before making groups
-        meta.make_names(self.good_files)
+        meta.make_names(self.good_files, self.metadata)
         # Get indices of files that should count towards grouping
         start = int(config.input.skip or self.start_idx)
         end = int(start + config.input.limit if config.input.limit else self.end_idx)
+        order = self.indices
         indices = []
-        for i in range(start, end):
-            file = self.get_by_idx(i)
-            if file and file.errors.group:
+        for i in order[bisect.bisect_left(order, start):bisect.bisect_left(order, end)]:
+            if i not in self._bad or self._files[i].errors.group:
                 indices.append(i)
         # Get the group divisions
         if len(indices) == 0:
@@ -654,6 +833,7 @@ class MergeChunk:
         self.parent = None
         self.children = []
         self.site = None
+        self._meta = None
 
     @property
     def namespace(self) -> str:
@@ -712,6 +892,19 @@ class MergeChunk:
         output_dir = str(config.output.out_dir)
         return [os.path.join(output_dir, name) for name in inputs]
 
+    def input_sizes(self, output_id = None) -> list[int]:
+        """
+        Get the (estimated) sizes of the input files
+
+        :param output_id: individual output stream for pass 2+
+        :return: list of input file sizes in bytes, in the same order as inputs()
+        """
+        if output_id is None:
+            return [file.size or 0 for file in self.files]
+        # Estimate the sizes of the outputs from the previous pass
+        spec = config.method.outputs[output_id].size
+        return [int(spec([f.size or 0 for f in child.files])) for child in self.children]
+
     def outputs(self, output_id = None) -> list[dict]:
         """
         Get the list of output file specifications for the chunk
@@ -752,10 +945,23 @@ class MergeChunk:
             outputs.append(output)
         return outputs
 
+    @property
+    def accumulator(self) -> meta.MetaAccumulator:
+        """Get the accumulated metadata for the files in the chunk"""
+        if self._meta is None:
+            # Parent chunks reuse the metadata already accumulated by their children
+            if self.children and sum(len(c) for c in self.children) == len(self.files):
+                self._meta = meta.MetaAccumulator()
+                for child in self.children:
+                    self._meta.combine(child.accumulator)
+            else:
+                self._meta = meta.MetaAccumulator(self.files)
+        return self._meta
+
     @property
     def metadata(self) -> dict:
         """Get the metadata for the chunk"""
-        md = meta.merged_keys(self.files, warn = False)
+        md = meta.merged_keys(self.accumulator, warn = False)
         md['merge.pass'] = self.tier + 1
         if self.skip is not None:
             md['merge.skip'] = self.skip
@@ -789,9 +995,24 @@ class MergeChunk:
             if spec is None:
                 logger.critical("Unknown merging method: %s", method)
                 sys.exit(1)
+        # Estimate the disk space needed, so the job can decide how many inputs to copy
+        sizes = self.input_sizes(output_id)
+        if output_id is None:
+            out_specs = config.method.outputs
+        else:
+            out_specs = [config.method.outputs[output_id]]
         # Build the settings dictionary from the spec
         settings = {
             'streaming': config.input.streaming.value,
+            'staging': {
+                'parallel': int(config.input.staging.parallel),
+                'per_host': int(config.input.staging.per_host),
+                'bandwidth': config.input.staging.bandwidth.value,
+                'prefetch': int(config.input.staging.prefetch),
+                'budget': int(config.method.chunks.max_size * 1024**3),
+                'sizes': sizes,
+                'output_size': int(sum(out.size(sizes) for out in out_specs)),
+            },
             'method': spec.method_name.value
         }
         for key in ['cfg', 'script', 'cmd']:
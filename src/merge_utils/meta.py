@@ -1,15 +1,202 @@
 """Utility functions for merging metadata for multiple files."""
 
+from __future__ import annotations
 import os
 import sys
 import logging
-import collections
 import copy
+from collections.abc import Iterable, Mapping
 
 from merge_utils import config, io_utils, naming, config_keys
 
 logger = logging.getLogger(__name__)
 
+def _raw(value):
+    """Get the plain value of a config key"""
+    return value._value if isinstance(value, config_keys.ConfigKey) else value # pylint: disable=protected-access
+
+def _option_set(options) -> frozenset | tuple:
+    """Collect the allowed values of a restricted key, as a set if they are hashable"""
+    values = [_raw(option) for option in options]
+    try:
+        return frozenset(values)
+    except TypeError:
+        return tuple(values)
+
+class ValidationPlan:
+    """
+    Flat form of the metadata fixes and validation rules in the configuration.
+
+    The plan is compiled once from the active configuration, so checking each file only needs
+    plain dictionary and set lookups rather than walking the config tree.
+    """
+
+    def __init__(self):
+        """Compile the plan from the current configuration"""
+        rules = config.metadata
+        fixes = rules.fixes
+        self.bad_keys = {str(key): str(value) for key, value in fixes.bad_keys.items()}
+        self.missing_keys = {str(key): _raw(value) for key, value in fixes.missing_keys.items()}
+        self.bad_values = {}
+        for key, replacements in fixes.bad_values.items():
+            values = {old: _raw(new) for old, new in replacements.items() if _raw(new) is not None}
+            if values:
+                self.bad_values[str(key)] = values
+        # Optional keys are never reported as missing, so drop them from the required keys here
+        self.optional = frozenset(str(key) for key in rules.optional)
+        required = list(dict.fromkeys(str(key) for key in rules.required))
+        self.required = tuple(key for key in required if key not in self.optional)
+        self.conditional = []
+        for spec in rules.conditional:
+            keys = tuple(key for key in dict.fromkeys(str(k) for k in spec.required)
+                         if key not in required and key not in self.optional)
+            self.conditional.append((naming.get_condition(spec.cond), str(spec.cond), keys))
+        self.restricted = {str(key): _option_set(options)
+                           for key, options in rules.restricted.items()}
+        # Restricted keys are only checked against their options, integers are valid floats
+        self.types = {}
+        for key, expected in rules.types.items():
+            key, expected = str(key), str(expected)
+            if key in self.restricted:
+                continue
+            self.types[key] = (expected, frozenset([expected, 'int'] if expected == 'float'
+                                                   else [expected]))
+        self.checksums = frozenset(str(algo) for algo in config.validation.checksums)
+        self.quit = config.validation.handling.invalid == 'quit'
+
+    def fix(self, name: str, metadata: dict) -> None:
+        """
+        Fix the metadata dictionary.
+
+        :param name: name of the file (for logging)
+        :param metadata: metadata dictionary
+        """
+        fixes = []
+        # Fix misspelled keys
+        for key, replacement in self.bad_keys.items():
+            if key in metadata:
+                fixes.append(f"Key '{key}' -> '{replacement}'")
+                metadata[replacement] = metadata.pop(key)
+
+        # Fix missing keys
+        for key, value in self.missing_keys.items():
+            if key not in metadata:
+                fixes.append(f"Key '{key}' value None -> '{value}'")
+                metadata[key] = value
+
+        # Fix misspelled values
+        for key, replacements in self.bad_values.items():
+            value = metadata.get(key, None)
+            try:
+                replacement = replacements.get(value, None)
+            except TypeError:
+                continue
+            if replacement is not None:
+                fixes.append(f"Key '{key}' value '{value}' -> '{replacement}'")
+                metadata[key] = replacement
+
+        if fixes:
+            io_utils.log_list("Applying {n} metadata fix{es} to file %s:" % name, fixes,
+                              logging.DEBUG)
+
+    def check_required(self, metadata: dict) -> list:
+        """
+        Check if the metadata dictionary contains all required keys.
+
+        :param metadata: metadata dictionary
+        :return: List of any missing required keys
+        """
+        errs = [f"Missing required key: {key}" for key in self.required if key not in metadata]
+        if not self.conditional:
+            return errs
+
+        # Check for conditionally required keys
+        name_dict = naming.Formatter(metadata)
+        seen = set()
+        for condition, text, keys in self.conditional:
+            if not condition.evaluate(name_dict):
+                continue
+            logger.debug("Matched condition: %s", text)
+            for key in keys:
+                if key in seen:
+                    continue
+                seen.add(key)
+                if key not in metadata:
+                    errs.append(f"Missing conditionally required key: {key} (from {text})")
+        return errs
+
+    def check_values(self, metadata: dict) -> list:
+        """
+        Check the values of restricted keys and the types of other keys.
+
+        :param metadata: metadata dictionary
+        :return: List of any invalid values
+        """
+        errs = []
+        for key, options in self.restricted.items():
+            if key not in metadata:
+                continue
+            value = metadata[key]
+            try:
+                valid = value in options
+            except TypeError:
+                valid = False
+            if not valid:
+                errs.append(f"Invalid value for {key}: {value}")
+
+        for key, (expected, names) in self.types.items():
+            if key not in metadata:
+                continue
+            value = metadata[key]
+            if type(value).__name__ not in names:
+                errs.append(f"Invalid type for {key}: {value} (expected {expected})")
+        return errs
+
+    def validate(self, name: str, metadata: dict, requirements: bool = True) -> bool:
+        """
+        Fix and validate the metadata dictionary.
+
+        :param name: name of the file (for logging)
+        :param metadata: metadata dictionary
+        :param requirements: whether to check for required keys
+        :return: True if metadata is valid, False otherwise
+        """
+        self.fix(name, metadata)
+        errs = self.check_required(metadata) if requirements else []
+        errs.extend(self.check_values(metadata))
+        if errs:
+            lvl = logging.CRITICAL if self.quit else logging.ERROR
+            io_utils.log_list("File %s has {n} invalid metadata key{s}:" % name, errs, lvl)
+            return False
+        return True
+
+    def validate_batch(self, files: Iterable[tuple[str, dict]],
+                       requirements: bool = True) -> list[bool]:
+        """
+        Fix and validate the metadata of several files.
+
+        :param files: collection of (name, metadata dictionary) pairs
+        :param requirements: whether to check for required keys
+        :return: list of validation results, in the same order as the files
+        """
+        return [self.validate(name, metadata, requirements) for name, metadata in files]
+
+# Compiled plan, keyed by the configuration generation it was compiled from
+_plans = {}
+
+def validation_plan() -> ValidationPlan:
+    """
+    Get the validation plan for the current configuration, compiling it if the configuration
+    has changed since it was last used.
+
+    :return: ValidationPlan object
+    """
+    plan = _plans.get(config.generation)
+    if plan is None:
+        _plans.clear()
+        plan = _plans[config.generation] = ValidationPlan()
+    return plan
+
 def fix(name: str, metadata: dict) -> None:
     """
     Fix the metadata dictionary.
@@ -17,29 +204,7 @@ def fix(name: str, metadata: dict) -> None:
     :param name: name of the file (for logging)
     :param metadata: metadata dictionary
     """
-    fixes = []
-    # Fix misspelled keys
-    for key, replacement in config.metadata.fixes.bad_keys.items():
-        if key in metadata:
-            fixes.append(f"Key '{key}' -> '{replacement}'")
-            metadata[str(replacement)] = metadata.pop(key)
-
-    # Fix missing keys
-    for key, value in config.metadata.fixes.missing_keys.items():
-        if key not in metadata:
-            fixes.append(f"Key '{key}' value None -> '{value}'")
-            metadata[key] = value._value # pylint: disable=protected-access
-
-    # Fix misspelled values
-    for key, replacements in config.metadata.fixes.bad_values.items():
-        value = metadata.get(key, None)
-        replacement = replacements.get(value, None)
-        if replacement is not None:
-            fixes.append(f"Key '{key}' value '{value}' -> '{replacement}'")
-            metadata[key] = replacement._value # pylint: disable=protected-access
-
-    if fixes:
-        io_utils.log_list("Applying {n} metadata fix{es} to file %s:" % name, fixes, logging.DEBUG)
+    validation_plan().fix(name, metadata)
 
 def check_required(metadata: dict) -> list:
     """
@@ -48,32 +213,7 @@ def check_required(metadata: dict) -> list:
     :param metadata: metadata dictionary
     :return: List of any missing required keys
     """
-    errs = []
-    # Check for required keys
-    required = set()
-    for key in [str(k) for k in config.metadata.required]:
-        required.add(key)
-        if key not in metadata:
-            if key in config.metadata.optional:
-                continue
-            errs.append(f"Missing required key: {key}")
-
-    # Check for conditionally required keys
-    name_dict = naming.Formatter(metadata)
-    for spec in config.metadata.conditional:
-        condition = spec.cond
-        if not name_dict.eval(condition):
-            #logger.debug("Skipping condition: %s", condition)
-            continue
-        logger.debug("Matched condition: %s", condition)
-        for key in [str(k) for k in spec.required]:
-            if key in required:
-                continue
-            required.add(key)
-            if key not in metadata and key not in config.metadata.optional:
-                errs.append(f"Missing conditionally required key: {key} (from {condition})")
-
-    return errs
+    return validation_plan().check_required(metadata)
 
 def validate(name: str, metadata: dict, requirements: bool = True) -> bool:
     """
@@ -84,38 +224,7 @@ def validate(name: str, metadata: dict, requirements: bool = True) -> bool:
     :param requirements: whether to check for required keys
     :return: True if metadata is valid, False otherwise
     """
-    # Fix metadata
-    fix(name, metadata)
-    errs = []
-    # Check for required keys
-    if requirements:
-        errs.extend(check_required(metadata))
-
-    # Check for restricted keys
-    for key, options in config.metadata.restricted.items():
-        if key not in metadata:
-            continue
-        value = metadata[key]
-        if value not in options:
-            errs.append(f"Invalid value for {key}: {value}")
-
-    # Check value types
-    for key, expected_type in config.metadata.types.items():
-        if key not in metadata or key in config.metadata.restricted:
-            continue
-        value = metadata[key]
-        type_name = type(value).__name__
-        if (type_name == expected_type) or (expected_type == 'float' and type_name == 'int'):
-            continue
-        errs.append(f"Invalid type for {key}: {value} (expected {expected_type})")
-
-    if errs:
-        crit = config.validation.handling.invalid == 'quit'
-        lvl = logging.CRITICAL if crit else logging.ERROR
-        io_utils.log_list("File %s has {n} invalid metadata key{s}:" % name, errs, lvl)
-        return False
-
-    return True
+    return validation_plan().validate(name, metadata, requirements)
 
 class MergeMetaMin:
     """Merge metadata by taking the minimum value."""
@@ -128,6 +237,10 @@ class MergeMetaMin:
         """Add a new value to the metadata."""
         self.value = min(self.value, value)
 
+    def combine(self, other: MergeMetaMin) -> None:
+        """Combine with another accumulator for the same key."""
+        self.add(other.value)
+
     @property
     def valid(self):
         """Check if the value is valid."""
@@ -144,6 +257,10 @@ class MergeMetaMax:
         """Add a new value to the metadata."""
         self.value = max(self.value, value)
 
+    def combine(self, other: MergeMetaMax) -> None:
+        """Combine with another accumulator for the same key."""
+        self.add(other.value)
+
     @property
     def valid(self):
         """Check if the value is valid."""
@@ -160,6 +277,10 @@ class MergeMetaSum:
         """Add a new value to the metadata."""
         self.value += value
 
+    def combine(self, other: MergeMetaSum) -> None:
+        """Combine with another accumulator for the same key."""
+        self.add(other.value)
+
     @property
     def valid(self):
         """Check if the value is valid."""
@@ -176,6 +297,10 @@ class MergeMetaUnion:
         """Add a new value to the metadata."""
         self._value.update(value)
 
+    def combine(self, other) -> None:
+        """Combine with another accumulator for the same key."""
+        self._value.update(other._value) # pylint: disable=protected-access
+
     @property
     def value(self):
         """Get the merged value."""
@@ -201,6 +326,14 @@ class MergeMetaUnique:
             self._valid = False
             self.warn = True
 
+    def combine(self, other: MergeMetaUnique) -> None:
+        """Combine with another accumulator for the same key."""
+        if not other._valid: # pylint: disable=protected-access
+            self._valid = False
+            self.warn = self.warn or other.warn
+        if other.value is not None:
+            self.add(other.value)
+
     @property
     def valid(self):
         """Check if the value is valid."""
@@ -217,6 +350,10 @@ class MergeMetaAll:
         """Add a new value to the metadata."""
         self._value.update(value)
 
+    def combine(self, other) -> None:
+        """Combine with another accumulator for the same key."""
+        self._value.update(other._value) # pylint: disable=protected-access
+
     @property
     def value(self):
         """Get the merged value."""
@@ -233,16 +370,45 @@ class MergeMetaSubset:
     """Merge metadata by taking the subset of consistent values."""
     def __init__(self, value=None):
         self.value = copy.deepcopy(value)
+        self.removed = set()  # Keys dropped as inconsistent, which can't come back
+        self.seen = {}        # Keys missing from the first value, with the value they were seen with
 
     def add(self, value):
         """Add a new value to the metadata."""
         if self.value is None:
             self.value = copy.deepcopy(value)
-        else:
-            for k, v in value.items():
-                if k in self.value and self.value[k] != v:
+            return
+        for k, v in value.items():
+            if k in self.removed:
+                continue
+            if k in self.value:
+                if self.value[k] != v:
                     logger.debug("Removing inconsistent key '%s': %s != %s", k, self.value[k], v)
                     del self.value[k]
+                    self.removed.add(k)
+            elif k in self.seen:
+                if self.seen[k] != v:
+                    del self.seen[k]
+                    self.removed.add(k)
+            else:
+                self.seen[k] = copy.deepcopy(v)
+
+    def combine(self, other: MergeMetaSubset) -> None:
+        """Combine with another accumulator for the same key."""
+        if other.value is None:
+            return
+        if self.value is None:
+            self.value = copy.deepcopy(other.value)
+            self.removed = set(other.removed)
+            self.seen = copy.deepcopy(other.seen)
+            return
+        for k in other.removed:
+            if k in self.value:
+                logger.debug("Removing inconsistent key '%s'", k)
+                del self.value[k]
+            self.seen.pop(k, None)
+        self.removed.update(other.removed)
+        self.add({**other.seen, **other.value})
 
     @property
     def valid(self):
@@ -264,6 +430,9 @@ class MergeMetaOverride:
     def add(self, value):
         """Add a new value to the metadata."""
 
+    def combine(self, other: MergeMetaOverride) -> None:
+        """Combine with another accumulator for the same key."""
+
     @property
     def valid(self):
         """Check if the value is valid."""
@@ -280,6 +449,98 @@ MERGE_META_CLASSES = {
     #'skip': MergeMetaOverride,
 }
 
+class MetaAccumulator:
+    """
+    Running merge of the metadata for a collection of files.
+
+    Files are added once as they arrive, and accumulators for different collections can be
+    combined (e.g. the chunks of a multi-pass merge), so the merged metadata can be produced
+    repeatedly without walking every file again.  Config overrides are only applied when the
+    merged metadata is requested.
+    """
+
+    def __init__(self, files: Iterable = ()):
+        """
+        Initialize the accumulator, optionally adding some files.
+
+        :param files: iterable of files with a metadata attribute
+        """
+        self.default = MERGE_META_CLASSES[str(config.metadata.merging['default'])]
+        self.classes = {}
+        for key, mode in config.metadata.merging.items():
+            if key == 'default':
+                continue
+            self.classes[key] = MERGE_META_CLASSES.get(str(mode), MergeMetaOverride)
+        self.keys = {}
+        self.count = 0
+        for file in files:
+            self.add(file.metadata)
+
+    def add(self, metadata: Mapping) -> None:
+        """
+        Add the metadata for one file.
+
+        :param metadata: metadata dictionary
+        """
+        keys = self.keys
+        for key, value in metadata.items():
+            acc = keys.get(key)
+            if acc is None:
+                acc = keys[key] = self.classes.get(key, self.default)()
+            acc.add(value)
+        self.count += 1
+
+    def combine(self, other: MetaAccumulator) -> None:
+        """
+        Add all the files from another accumulator.
+
+        :param other: accumulator to combine with this one
+        """
+        for key, acc in other.keys.items():
+            mine = self.keys.get(key)
+            if mine is None:
+                self.keys[key] = copy.deepcopy(acc)
+            else:
+                mine.combine(acc)
+        self.count += other.count
+
+    def merged(self, transform: bool = True, warn: bool = True) -> dict:
+        """
+        Get the merged metadata dictionary.
+
+        :param transform: whether to apply transform and user overrides
+        :param warn: whether to warn about inconsistent metadata
+        :return: merged metadata
+        """
+        # Start from every configured key, like merging from scratch, even if no file has it
+        metadata = {key: self.keys[key] if key in self.keys else cls()
+                    for key, cls in self.classes.items()}
+        # Set user metadata overrides
+        if transform:
+            for key, value in config.metadata.overrides.items():
+                metadata[key] = MergeMetaOverride(value._value)  # pylint: disable=protected-access
+            for key, value in merge_cfg_keys().items():
+                metadata[f"merge.{key}"] = MergeMetaOverride(str(value))
+            if config.input.campaign:
+                metadata['dune.campaign'] = MergeMetaOverride(str(config.input.campaign))
+        for key, acc in self.keys.items():
+            metadata.setdefault(key, acc)
+        # Warn about inconsistencies during merging
+        if warn:
+            io_utils.log_list("Omitting {n} inconsistent metadata key{s} from output:",
+                [k for k, v in metadata.items() if v.warn]
+            )
+        # Copy the values, since callers may modify them
+        metadata = {k: copy.deepcopy(v.value) for k, v in metadata.items() if v.valid}
+        # Update application and origin info for transform jobs
+        if transform and config.method.transform:
+            add_origin(metadata, str(config.method.transform))
+        # Make sure merged metadata is still valid
+        if not validate("output", metadata, requirements=False):
+            logger.critical("Merged metadata is invalid, cannot continue!")
+            raise ValueError("Merged metadata is invalid")
+        return metadata
+
 def merge_cfg_keys() -> dict:
     """
     Get special merging configuration keys from the global config.
@@ -381,50 +642,19 @@ def add_origin(metadata: dict, app: str) -> None:
     else:
         metadata[key] = {name: cfg}
 
-def merged_keys(files: list, transform: bool = True, warn: bool = True) -> dict:
+def merged_keys(files: list | MetaAccumulator, transform: bool = True,
+                warn: bool = True) -> dict:
     """
     Merge metadata from multiple files into a single dictionary.
 
-    :param files: list of files to merge
+    :param files: list of files to merge, or a MetaAccumulator already fed with them
     :param transform: whether to apply transform and user overrides
     :param warn: whether to warn about inconsistent metadata
     :return: merged metadata
     """
-    metadata = collections.defaultdict(
-        MERGE_META_CLASSES[str(config.metadata.merging['default'])]
-    )
-    # Set standard merging behavior
-    for key, mode in config.metadata.merging.items():
-        if key == 'default':
-            continue
-        merge_class = MERGE_META_CLASSES.get(str(mode), MergeMetaOverride)
-        metadata[key] = merge_class()
-    # Set user metadata overrides
-    if transform:
-        for key, value in config.metadata.overrides.items():
-            metadata[key] = MergeMetaOverride(value._value)  # pylint: disable=protected-access
-        for key, value in merge_cfg_keys().items():
-            metadata[f"merge.{key}"] = MergeMetaOverride(str(value))
-        if config.input.campaign:
-            metadata['dune.campaign'] = MergeMetaOverride(str(config.input.campaign))
-    # Merge input file metadata
-    for file in files:
-        for key, value in file.metadata.items():
-            metadata[key].add(value)
-    # Warn about inconsistencies during merging
-    if warn:
-        io_utils.log_list("Omitting {n} inconsistent metadata key{s} from output:",
-            [k for k, v in metadata.items() if v.warn]
-        )
-    metadata = {k: v.value for k, v in metadata.items() if v.valid}
-    # Update application and origin info for transform jobs
-    if transform and config.method.transform:
-        add_origin(metadata, str(config.method.transform))
-    # Make sure merged metadata is still valid
-    if not validate("output", metadata, requirements=False):
-        logger.critical("Merged metadata is invalid, cannot continue!")
-        raise ValueError("Merged metadata is invalid")
-    return metadata
+    if not isinstance(files, MetaAccumulator):
+        files = MetaAccumulator(files)
+    return files.merged(transform, warn)
 
 def parents(files: list) -> list:
     """
@@ -441,7 +671,7 @@ def parents(files: list) -> list:
         fids = set()
         for file in files:
             fids.update(file.parents)
-    return [{"fid": fid} for fid in fids]
+    return [{"fid": str(fid)} for fid in fids]
 
 def match_method(name: str = None, metadata: dict = None) -> config.ConfigDict:
     """
@@ -571,16 +801,17 @@ def log_method() -> None:
             msg.append(f"    pass2 method: {output.pass2}")
     logger.info("\n  ".join(msg))
 
-def check_method(files: list) -> None:
+def check_method(files: list, acc: MetaAccumulator = None) -> None:
     """
     Check and set the merging method based on the input file metadata.
 
     :param files: list of files to merge
+    :param acc: optional MetaAccumulator already fed with the files
     """
     # Figure out merging method
     name = config.method.method_name
     if name == 'auto':
-        set_method_auto(merged_keys(files, warn=False))
+        set_method_auto(merged_keys(acc or files, warn=False))
     else:
         # Check if we're using a built-in merging method
         method = match_method(name=name)
@@ -657,20 +888,23 @@ def check_method(files: list) -> None:
     # Log final merging method configuration
     log_method()
 
-def make_names(files: list):
+def make_names(files: list, acc: MetaAccumulator = None):
     """
     Update merging method and create a name for the merged files.
 
     :param files: list of files to merge
+    :param acc: optional MetaAccumulator already fed with the files
     """
-    check_method(files)
+    if acc is None:
+        acc = MetaAccumulator(files)
+    check_method(files, acc)
     # Set output namespaces if they are not given
     if not config.output.namespace:
         config.output.namespace = files[0].namespace
     if not config.output.scratch.namespace:
         config.output.scratch.namespace = config.output.namespace
     # Format output file names
-    formatter = naming.Formatter(merged_keys(files, transform=False, warn=False))
+    formatter = naming.Formatter(merged_keys(acc, transform=False, warn=False))
     if '{UUID}' in config.output.name:
         logger.critical("File {UUID} should go in merging.method.outputs, not output.name")
         sys.exit(1)
@@ -705,7 +939,7 @@ def make_names(files: list):
             continue
         formatter.format(key)
     # Check output file metadata for validity
-    metadata = merged_keys(files, transform=True, warn=False) # base output metadata
+    metadata = merged_keys(acc, transform=True, warn=False) # base output metadata
     for idx, output in enumerate(config.method.outputs):
         if not output.metadata:
             logger.debug("Skipping output %d metadata validation (no metadata)", idx)
@@ -0,0 +1,322 @@
+"""Persistent host-level cache of MetaCat file records, shared between jobs."""
+
+from __future__ import annotations
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+
+from merge_utils import config, naming
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    did TEXT PRIMARY KEY,
+    fid TEXT,
+    metadata INTEGER NOT NULL,
+    provenance INTEGER NOT NULL,
+    fetched REAL NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_fid ON files (fid);
+CREATE TABLE IF NOT EXISTS queries (
+    fingerprint TEXT PRIMARY KEY,
+    fetched REAL NOT NULL,
+    dids TEXT NOT NULL
+);
+"""
+
+# SQLite limits the number of bound parameters in a single statement
+MAX_PARAMS = 500
+# Skip and limit clauses at the end of an ordered query
+PAGING = re.compile(r"\sordered(?P<paging>(?:\s+(?:skip|limit)\s+\d+)+)\s*$", re.IGNORECASE)
+
+def record_did(record: dict) -> str:
+    """Get the DID of a MetaCat file record"""
+    return f"{record['namespace']}:{record['name']}"
+
+def fingerprint(query: str, metadata: bool, provenance: bool) -> str:
+    """
+    Get a unique key for a MetaCat query and its options.
+
+    :param query: MQL query string
+    :param metadata: whether metadata was requested
+    :param provenance: whether provenance was requested
+    :return: hex digest identifying the query
+    """
+    key = json.dumps([' '.join(query.split()), bool(metadata), bool(provenance)])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def split_paging(query: str) -> tuple[str, int | None, int | None]:
+    """
+    Split the skip and limit clauses off the end of an ordered MQL query.
+
+    :param query: MQL query string
+    :return: query without paging, number of files to skip, and maximum number of files
+        (None if the query has no such clause)
+    """
+    match = PAGING.search(query)
+    if match is None:
+        return query, None, None
+    skip = re.search(r'skip\s+(\d+)', match['paging'], re.IGNORECASE)
+    limit = re.search(r'limit\s+(\d+)', match['paging'], re.IGNORECASE)
+    return (query[:match.start('paging')].rstrip(), int(skip.group(1)) if skip else None,
+            int(limit.group(1)) if limit else None)
+
+class MetaCatCache:
+    """
+    SQLite store of MetaCat file records, keyed by DID and FID.
+
+    File metadata rarely changes once declared, so records are kept for the configured lifetime.
+    Query results and provenance (which gains children as files are merged) are only reused for
+    the shorter volatile lifetime.  Retired files are never served from the cache, and records
+    for re-declared files are replaced as soon as MetaCat returns a new FID for the DID.
+    """
+
+    def __init__(self, path: str = None, lifetime: float = None, volatile: float = None):
+        """
+        Initialize the cache settings.
+
+        :param path: path to the SQLite database (default from config)
+        :param lifetime: hours before file records expire (default from config)
+        :param volatile: hours before query results and provenance expire (default from config)
+        """
+        if path is None:
+            naming.Formatter().format(config.validation.cache.path)
+            path = str(config.validation.cache.path)
+        self.path = path
+        if lifetime is None:
+            lifetime = float(config.validation.cache.lifetime)
+        if volatile is None:
+            volatile = float(config.validation.cache.volatile)
+        self.lifetime = lifetime * 3600
+        self.volatile = min(volatile, lifetime) * 3600
+        self.conn = None
+        self.hits = 0
+        self.misses = 0
+
+    def __bool__(self) -> bool:
+        """Return True if the cache database is open."""
+        return self.conn is not None
+
+    def open(self) -> None:
+        """Open the cache database, creating it if necessary and purging expired records."""
+        if self.conn is not None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=60)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+            now = time.time()
+            with self.conn:
+                self.conn.execute("DELETE FROM files WHERE fetched < ?", (now - self.lifetime,))
+                self.conn.execute("DELETE FROM queries WHERE fetched < ?", (now - self.volatile,))
+        except (OSError, sqlite3.Error) as err:
+            logger.warning("Failed to open MetaCat cache %s, caching disabled:\n  %s",
+                           self.path, err)
+            self.conn = None
+            return
+        logger.debug("Opened MetaCat cache %s", self.path)
+
+    def close(self) -> None:
+        """Close the cache database."""
+        if self.conn is None:
+            return
+        logger.debug("MetaCat cache hits: %d, misses: %d", self.hits, self.misses)
+        self.conn.close()
+        self.conn = None
+
+    def _select(self, column: str, values: list) -> list:
+        """Select rows from the files table where a column matches any of the values."""
+        rows = []
+        for start in range(0, len(values), MAX_PARAMS):
+            chunk = values[start:start+MAX_PARAMS]
+            marks = ','.join('?' * len(chunk))
+            rows.extend(self.conn.execute(
+                "SELECT did, fid, metadata, provenance, fetched, record FROM files "
+                f"WHERE {column} IN ({marks})", chunk
+            ))
+        return rows
+
+    def _usable(self, row: tuple, metadata: bool, provenance: bool, now: float) -> dict | None:
+        """
+        Check whether a cached row satisfies a request, and decode it if so.
+
+        :param row: row from the files table
+        :param metadata: whether metadata is required
+        :param provenance: whether provenance is required
+        :param now: current time
+        :return: file record with only the requested fields, or None if unusable
+        """
+        _, _, has_metadata, has_provenance, fetched, record = row
+        if metadata and not has_metadata:
+            return None
+        if provenance and (not has_provenance or now - fetched > self.volatile):
+            return None
+        if now - fetched > self.lifetime:
+            return None
+        record = json.loads(record)
+        if not metadata:
+            record.pop('metadata', None)
+        if not provenance:
+            record.pop('parents', None)
+            record.pop('children', None)
+        return record
+
+    def get_files(self, files: list, metadata: bool, provenance: bool) -> tuple[list, list]:
+        """
+        Look up a list of file requests in the cache.
+
+        :param files: list of file dicts, with either 'fid', 'did', or 'namespace' & 'name' keys
+        :param metadata: whether metadata is required
+        :param provenance: whether provenance is required
+        :return: list of cached records in request order, and list of requests that still need
+            to go to MetaCat
+        """
+        if self.conn is None:
+            return [], files
+        dids = {}
+        fids = {}
+        for idx, file in enumerate(files):
+            if 'did' in file:
+                dids[file['did']] = idx
+            elif 'namespace' in file and 'name' in file:
+                dids[record_did(file)] = idx
+            elif 'fid' in file:
+                fids[str(file['fid'])] = idx
+        now = time.time()
+        found = {}
+        for row in self._select('did', list(dids)) + self._select('fid', list(fids)):
+            record = self._usable(row, metadata, provenance, now)
+            if record is None:
+                continue
+            idx = dids.get(row[0])
+            if idx is None:
+                idx = fids.get(row[1])
+            if idx is not None:
+                found[idx] = record
+        missing = [file for idx, file in enumerate(files) if idx not in found]
+        self.hits += len(found)
+        self.misses += len(missing)
+        return [found[idx] for idx in sorted(found)], missing
+
+    def put_files(self, records: list, metadata: bool, provenance: bool) -> None:
+        """
+        Store file records returned by MetaCat.
+
+        :param records: list of MetaCat file records
+        :param metadata: whether the records include metadata
+        :param provenance: whether the records include provenance
+        """
+        if self.conn is None or not records:
+            return
+        now = time.time()
+        existing = {row[0]: row for row in self._select('did', [record_did(r) for r in records])}
+        rows = []
+        retired = []
+        for record in records:
+            did = record_did(record)
+            if record.get('retired', False):
+                retired.append(did)
+                continue
+            fid = record.get('fid')
+            fid = str(fid) if fid is not None else None
+            old = existing.get(did)
+            # Don't replace a more complete record for the same FID with a partial one
+            if old is not None and old[1] == fid and now - old[4] < self.lifetime:
+                if (old[2] and not metadata) or (old[3] and not provenance):
+                    continue
+            rows.append((did, fid, int(metadata), int(provenance), now,
+                         json.dumps(record, separators=(',', ':'))))
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO files (did, fid, metadata, provenance, fetched, record) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", rows)
+                if retired:
+                    self.conn.executemany("DELETE FROM files WHERE did = ?",
+                                          [(did,) for did in retired])
+        except sqlite3.Error as err:
+            logger.warning("Failed to update MetaCat cache:\n  %s", err)
+
+    def get_query(self, query: str, metadata: bool, provenance: bool) -> list | None:
+        """
+        Look up the results of a MetaCat query in the cache.
+        A page of an ordered query is also served from the cached results of the whole query.
+
+        :param query: MQL query string
+        :param metadata: whether metadata is required
+        :param provenance: whether provenance is required
+        :return: list of file records in query order, or None if the query is not cached
+        """
+        if self.conn is None:
+            return None
+        now = time.time()
+        base, skip, limit = split_paging(query)
+        for text in dict.fromkeys([query, base]):
+            row = self.conn.execute(
+                "SELECT fetched, dids FROM queries WHERE fingerprint = ?",
+                (fingerprint(text, metadata, provenance),)
+            ).fetchone()
+            if row is not None and now - row[0] <= self.volatile:
+                break
+        else:
+            self.misses += 1
+            return None
+        dids = json.loads(row[1])
+        if text != query:
+            skip = skip or 0
+            dids = dids[skip:skip + limit if limit is not None else None]
+        rows = {r[0]: r for r in self._select('did', dids)}
+        records = []
+        for did in dids:
+            record = self._usable(rows[did], metadata, provenance, now) if did in rows else None
+            if record is None:
+                self.misses += 1
+                return None
+            records.append(record)
+        self.hits += 1
+        return records
+
+    def put_query(self, query: str, metadata: bool, provenance: bool, records: list) -> bool:
+        """
+        Store the results of a MetaCat query.
+
+        :param query: MQL query string
+        :param metadata: whether the records include metadata
+        :param provenance: whether the records include provenance
+        :param records: list of MetaCat file records in query order
+        :return: True if the query results were stored
+        """
+        if self.conn is None:
+            return False
+        self.put_files(records, metadata, provenance)
+        # Queries returning retired files must always be rerun
+        if any(record.get('retired', False) for record in records):
+            return False
+        dids = json.dumps([record_did(record) for record in records], separators=(',', ':'))
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO queries (fingerprint, fetched, dids) VALUES (?, ?, ?)",
+                    (fingerprint(query, metadata, provenance), time.time(), dids))
+        except sqlite3.Error as err:
+            logger.warning("Failed to update MetaCat cache:\n  %s", err)
+            return False
+        return True
+
+
+def get() -> MetaCatCache | None:
+    """
+    Create a MetaCat cache based on the configuration.
+
+    :return: MetaCatCache object, or None if caching is disabled
+    """
+    if not config.validation.cache.enabled:
+        return None
+    return MetaCatCache()
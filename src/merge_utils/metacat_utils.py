@@ -3,48 +3,189 @@
 import logging
 import sys
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 
 import metacat.webapi as metacat #pylint: disable=import-error
 
-#from merge_utils import config
+from merge_utils.metacat_cache import split_paging
 
 logger = logging.getLogger(__name__)
 
+def request_key(file: dict) -> tuple:
+    """Get a key matching a file request to the MetaCat record it returns"""
+    if 'did' in file:
+        return ('did', file['did'])
+    if 'namespace' in file and 'name' in file:
+        return ('did', f"{file['namespace']}:{file['name']}")
+    return ('fid', str(file.get('fid')))
+
+def request_order(files: list, records: list) -> list:
+    """
+    Sort file records into the order they were requested in.
+
+    :param files: list of file requests
+    :param records: list of MetaCat file records, in any order
+    :return: records in request order, followed by any that don't match a request
+    """
+    found = {}
+    for idx, record in enumerate(records):
+        found.setdefault(('did', f"{record['namespace']}:{record['name']}"), idx)
+        found.setdefault(('fid', str(record.get('fid'))), idx)
+    order = []
+    used = set()
+    for file in files:
+        idx = found.get(request_key(file))
+        if idx is not None and idx not in used:
+            order.append(idx)
+            used.add(idx)
+    order.extend(idx for idx in range(len(records)) if idx not in used)
+    return [records[idx] for idx in order]
+
 class MetaCatWrapper:
-    """Class for sending asynchronous requests to the MetaCat web API."""
+    """
+    Class for sending asynchronous requests to the MetaCat web API.
+
+    The blocking MetaCat client is driven from a dedicated pool of worker threads, each of which
+    keeps its own client (and therefore its own keep-alive HTTP session) for the lifetime of the
+    wrapper.  The size of the pool bounds the number of requests in flight at once, and results
+    are decoded as they stream in on the worker thread rather than on the event loop.
+    """
+
+    def __init__(self, cache = None, connections: int = 1, max_files: int = 0,
+                 factory: Callable = None):
+        """
+        Initialize the MetaCatWrapper.
 
-    def __init__(self):
-        """Initialize the MetaCatWrapper."""
+        :param cache: optional MetaCatCache to consult before sending requests
+        :param connections: maximum number of concurrent requests to MetaCat
+        :param max_files: split file requests larger than this into concurrent requests (0 = never)
+        :param factory: callable that creates a MetaCat client (default MetaCatClient)
+        """
         self.client = None
+        self.cache = cache
+        self.connections = max(1, int(connections))
+        self.max_files = max(0, int(max_files))
+        self.factory = factory or metacat.MetaCatClient
+        self.executor = None
+        self.local = threading.local()
+        self.queries = {}  # {(query, metadata, provenance): Task for the whole query results}
+        self.uncached = set()  # Queries whose results can't be cached, so are always paged
+
+    def _thread_client(self):
+        """Get the MetaCat client for the current worker thread, creating it if necessary."""
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            logger.debug("Opening MetaCat connection on %s", threading.current_thread().name)
+            client = self.factory()
+            self.local.client = client
+        return client
+
+    async def _call(self, method: str, *args, collect: Callable = list, **kwargs) -> list:
+        """
+        Run a MetaCat client method on the worker pool and collect the results.
+
+        :param method: name of the MetaCatClient method to call
+        :param args: positional arguments for the method
+        :param collect: function applied to the method output on the worker thread
+        :param kwargs: keyword arguments for the method
+        :return: list of results
+        """
+        def call():
+            return collect(getattr(self._thread_client(), method)(*args, **kwargs))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, call)
 
     async def connect(self) -> None:
         """Connect to the MetaCat web API"""
+        if self.cache is not None:
+            self.cache.open()
         if not self.client:
-            logger.debug("Connecting to MetaCat")
-            self.client = await asyncio.to_thread(metacat.MetaCatClient)
+            logger.debug("Connecting to MetaCat with %d connection%s",
+                         self.connections, "s" if self.connections != 1 else "")
+            self.executor = ThreadPoolExecutor(max_workers=self.connections,
+                                               thread_name_prefix="metacat")
+            loop = asyncio.get_running_loop()
+            self.client = await loop.run_in_executor(self.executor, self._thread_client)
         else:
             logger.debug("Already connected to MetaCat")
 
     async def disconnect(self) -> None:
-        """No need to explicitly disconnect from MetaCat?"""
+        """Shut down the connection pool and close the cache."""
+        if self.cache is not None:
+            self.cache.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        self.client = None
+        self.local = threading.local()
+
+    async def _request(self, query: str, metadata: bool, provenance: bool) -> list:
+        """Send a query to MetaCat, exiting if it is malformed"""
+        try:
+            return await self._call('query', query,
+                                    with_metadata = metadata,
+                                    with_provenance = provenance)
+        except metacat.webapi.BadRequestError as err:
+            logger.critical("Malformed MetaCat query:\n  %s\n%s", query, err)
+            sys.exit(1)
+
+    async def _cache_query(self, query: str, metadata: bool, provenance: bool) -> list:
+        """Run a whole query and cache the results, so its pages can be served from the cache"""
+        logger.debug("Caching all results of MetaCat query:\n  %s", query)
+        res = await self._request(query, metadata, provenance)
+        if not self.cache.put_query(query, metadata, provenance, res):
+            self.uncached.add(query)
+        return res
 
     async def query(self, query: str, metadata: bool = True, provenance: bool = True) -> list:
         """
         Asynchronously query MetaCat.
+        With a cache, a page of an ordered query selected with skip is cut from the cached results
+        of the whole query, so repeated or concurrent pages only need one request to MetaCat.
+        Cursor pages have a different condition each, so they are only cached one by one.
 
         :param query: MQL query to execute
         :param metadata: whether to include metadata in the results
         :param provenance: whether to include provenance in the results
         :return: list of file metadata dictionaries
         """
+        if self.cache:
+            res = self.cache.get_query(query, metadata, provenance)
+            if res is not None:
+                logger.debug("Using cached results for MetaCat query:\n  %s", query)
+                return res
+            base, skip, limit = split_paging(query)
+            if skip is not None and base not in self.uncached:
+                key = (base, metadata, provenance)
+                task = self.queries.get(key)
+                if task is None:
+                    task = self.queries[key] = asyncio.ensure_future(
+                        self._cache_query(base, metadata, provenance))
+                    task.add_done_callback(lambda _: self.queries.pop(key, None))
+                res = await task
+                return res[skip:skip + limit if limit is not None else None]
+        res = await self._request(query, metadata, provenance)
+        if self.cache:
+            self.cache.put_query(query, metadata, provenance, res)
+        return res
+
+    async def count(self, query: str) -> int:
+        """
+        Asynchronously count the number of files matching a MetaCat query.
+
+        :param query: MQL query to execute
+        :return: number of matching files
+        """
+        def first(res):
+            return res if isinstance(res, dict) else next(iter(res))
         try:
-            res = await asyncio.to_thread(self.client.query, query,
-                                          with_metadata = metadata,
-                                          with_provenance = provenance)
+            res = await self._call('query', query, collect=first, summary='count')
         except metacat.webapi.BadRequestError as err:
             logger.critical("Malformed MetaCat query:\n  %s\n%s", query, err)
             sys.exit(1)
-        return list(res)
+        return int(res['count'])
 
     async def files(self, files: list, metadata: bool = True, provenance: bool = True) -> list:
         """
@@ -58,11 +199,30 @@ class MetaCatWrapper:
         if len(files) == 0:
             logger.debug("No files to request")
             return []
+        cached = []
+        requested = files
+        if self.cache:
+            cached, files = self.cache.get_files(files, metadata, provenance)
+            if len(files) == 0:
+                logger.debug("Found all %d requested files in cache", len(cached))
+                return cached
+        # Split very large requests so they can use several connections at once
+        step = self.max_files or len(files)
+        requests = [files[i:i+step] for i in range(0, len(files), step)]
         try:
-            res = await asyncio.to_thread(self.client.get_files, files,
-                                          with_metadata = metadata,
-                                          with_provenance = provenance)
+            results = await asyncio.gather(*[
+                self._call('get_files', request,
+                           with_metadata = metadata,
+                           with_provenance = provenance)
+                for request in requests
+            ])
         except (ValueError, metacat.webapi.BadRequestError) as err:
             logger.critical("%s", err)
             raise ValueError(f"MetaCat error: {err}") from err
-        return list(res)
+        res = [file for result in results for file in result]
+        if self.cache:
+            self.cache.put_files(res, metadata, provenance)
+        if not cached:
+            return res
+        # Keep the results in the order they were requested, however many came from the cache
+        return request_order(requested, cached + res)
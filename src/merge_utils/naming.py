@@ -1,7 +1,10 @@
 """Utilities for expanding name templates using metadata."""
 
 import os
+import re
 import sys
+import ast
+import string
 import logging
 
 from merge_utils import config, io_utils, config_keys
@@ -297,8 +300,9 @@ class Formatter:
         self.defer_uuid = defer_uuid
         result = str(template).format_map(self)
         if self.errors:
+            escaped = result.replace('{', '{{').replace('}', '}}')
             io_utils.log_list(
-                f"Config key '{name}' could not be formatted:\n  (got '{result}')",
+                f"Config key '{name}' could not be formatted:\n  (got '{escaped}')",
                 self.errors, logging.CRITICAL)
             sys.exit(1)
         # Expand paths if needed
@@ -314,18 +318,147 @@ class Formatter:
         :param condition: condition string to evaluate
         :return: evaluated value
         """
-        self.reset()
-        logger.debug("Evaluating condition '%s'", condition)
-        expr = str(condition).format_map(self)
-        if self.errors:
+        return get_condition(condition).evaluate(self)
+
+# Syntax allowed in condition expressions after the metadata values are substituted
+SAFE_NODES = (
+    ast.Expression, ast.Constant, ast.List, ast.Tuple, ast.Set, ast.Load,
+    ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd, ast.IfExp,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.In, ast.NotIn, ast.Is, ast.IsNot,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.Subscript, ast.Slice, ast.Call, ast.Name,
+)
+SAFE_FUNCS = {
+    func.__name__: func for func in [len, min, max, abs, int, float, str, bool, any, all, sorted]
+}
+# Methods that can be called on values, e.g. "'{core.run_type}'.startswith('hd')"
+SAFE_METHODS = {
+    'startswith', 'endswith', 'lower', 'upper', 'casefold', 'strip', 'lstrip', 'rstrip',
+    'split', 'rsplit', 'replace', 'count', 'find', 'index', 'join',
+    'isdigit', 'isalpha', 'isalnum', 'isspace', 'islower', 'isupper',
+}
+MAX_RESULTS = 4096 # Maximum number of memoized results per condition
+
+def compile_expr(expr: str):
+    """
+    Compile a condition expression, only allowing simple comparisons, literals, and a few
+    built-in functions and string methods.
+
+    :param expr: expression string, with all metadata values already substituted
+    :return: compiled code object
+    :raises ValueError: if the expression uses anything else
+    """
+    tree = ast.parse(expr.strip(), mode='eval')
+    methods = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            if node.func.attr not in SAFE_METHODS:
+                raise ValueError(f"method '{node.func.attr}' is not allowed in conditions")
+            methods.add(node.func)
+        elif isinstance(node, ast.Attribute):
+            if node not in methods:
+                raise ValueError("only method calls are allowed on values in conditions")
+        elif not isinstance(node, SAFE_NODES):
+            raise ValueError(f"'{type(node).__name__}' is not allowed in conditions")
+        elif isinstance(node, ast.Name) and node.id not in SAFE_FUNCS:
+            raise ValueError(f"name '{node.id}' is not defined")
+        elif isinstance(node, ast.Call) and not isinstance(node.func, ast.Name):
+            raise ValueError("only simple function calls are allowed in conditions")
+    return compile(tree, '<condition>', 'eval')
+
+def freeze(value) -> tuple:
+    """
+    Convert a metadata value to a hashable key, keeping its type so that e.g. 1 != True.
+
+    :param value: metadata value
+    :return: hashable representation of the value
+    """
+    if isinstance(value, list):
+        return (list, tuple(freeze(v) for v in value))
+    if isinstance(value, dict):
+        return (dict, tuple((k, freeze(v)) for k, v in value.items()))
+    return (type(value), value)
+
+class Condition:
+    """
+    A condition expression like "'{core.data_tier}' in ['raw', 'trigprim']", parsed once.
+
+    Evaluation substitutes the metadata values into the expression exactly like name formatting,
+    then runs it with a restricted evaluator.  Results are memoized by the raw values of the
+    metadata keys the condition refers to, so a dataset with only a few distinct combinations of
+    those values only evaluates the expression a few times.
+    """
+
+    def __init__(self, text: str):
+        """
+        Parse the condition expression.
+
+        :param text: condition expression string
+        """
+        self.text = str(text)
+        self.keys = []
+        self.cacheable = True
+        for _, field, spec, _ in string.Formatter().parse(self.text):
+            if field is None:
+                continue
+            first = re.match(r'[^.\[]*', field).group()
+            if (first in CONFIG_KEYS or first in FUNC_KEYS or first in KEY_BLACKLIST
+                    or first.startswith('$') or (spec and '{' in spec)):
+                # Depends on more than the metadata, so don't memoize
+                self.cacheable = False
+            self.keys.append(re.match(r'[^\[]*', field).group())
+        self.results = {}
+        self.codes = {}
+
+    def evaluate(self, formatter: Formatter):
+        """
+        Evaluate the condition for the metadata in a Formatter.
+
+        :param formatter: Formatter wrapping the metadata dictionary
+        :return: evaluated value, or False if the condition could not be evaluated
+        """
+        memo = None
+        if self.cacheable and formatter.metadata is not None:
+            memo = tuple(freeze(formatter.metadata.get(key)) for key in self.keys)
+            if memo in self.results:
+                return self.results[memo]
+        formatter.reset()
+        logger.debug("Evaluating condition '%s'", self.text)
+        expr = self.text.format_map(formatter)
+        if formatter.errors:
+            escaped = self.text.replace('{', '{{').replace('}', '}}')
             io_utils.log_list(
-                f"Error evaluating condition expression '{condition}':",
-                self.errors, logging.ERROR)
+                f"Error evaluating condition expression '{escaped}':",
+                formatter.errors, logging.ERROR)
             return False
         try:
-            val = eval(expr) #pylint: disable=eval-used
-        except Exception as exc:
+            code = self.codes.get(expr)
+            if code is None:
+                code = self.codes[expr] = compile_expr(expr)
+            val = eval(code, {'__builtins__': {}}, SAFE_FUNCS) #pylint: disable=eval-used
+        except Exception as exc: # pylint: disable=broad-exception-caught
             logger.error("Error evaluating condition expression '%s':\n  %s", expr, exc)
             return False
         logger.debug("Condition expression '%s' evaluated to '%s'", expr, val)
+        if memo is not None:
+            if len(self.results) >= MAX_RESULTS:
+                self.results.clear()
+                self.codes.clear()
+            self.results[memo] = val
         return val
+
+_conditions = {}
+
+def get_condition(text: str) -> Condition:
+    """
+    Get the compiled Condition for an expression, parsing it on first use.
+
+    :param text: condition expression string
+    :return: Condition object
+    """
+    text = str(text)
+    cond = _conditions.get(text)
+    if cond is None:
+        cond = _conditions[text] = Condition(text)
+    return cond
@@ -0,0 +1,133 @@
+"""
+Parallel gzip compression for the merge job runners.
+
+Data is split into blocks that are compressed independently on a thread pool (zlib releases the
+GIL while it compresses) and written out in order as a standard multi-member gzip stream, which
+the gzip and tarfile modules and the gzip command read as a single file.
+"""
+
+from __future__ import annotations
+import io
+import os
+import zlib
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+
+BLOCK_SIZE = 4 * 1024 * 1024  # Uncompressed size of each gzip member
+LEVEL = 6  # Same default level as tarfile
+
+def compress_member(data: bytes, level: int = LEVEL) -> bytes:
+    """
+    Compress a block of data as a complete gzip member.
+
+    :param data: Uncompressed data
+    :param level: Compression level (0-9)
+    :return: gzip member with its own header and trailer
+    """
+    comp = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return comp.compress(data) + comp.flush()
+
+def default_threads() -> int:
+    """Get a reasonable number of compression threads for this machine"""
+    return min(8, os.cpu_count() or 1)
+
+class GzipWriter(io.RawIOBase):
+    """
+    Write-only file object that compresses blocks on a pool of threads.
+
+    At most two blocks per thread are buffered or being compressed at once, so memory use is
+    bounded no matter how much is written.  A record of every gzip member written is kept in
+    members, so callers can map uncompressed offsets to positions in the compressed file.
+    """
+
+    def __init__(self, fileobj, level: int = LEVEL, threads: int = None,
+                 block_size: int = BLOCK_SIZE):
+        """
+        Initialize the writer.  The underlying file is not closed when the writer is closed.
+
+        :param fileobj: Binary file object to write the compressed stream to
+        :param level: Compression level (0-9)
+        :param threads: Number of blocks to compress at once (default from the CPU count)
+        :param block_size: Uncompressed size of each gzip member in bytes
+        """
+        super().__init__()
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = max(1, threads or default_threads())
+        self.block_size = max(1, block_size)
+        self.pool = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        self.buffer = bytearray()
+        self.pending = collections.deque()  # (uncompressed offset, size, compressed data)
+        self.offset = 0  # Uncompressed bytes written so far
+        self.start = 0  # Uncompressed offset of the start of the buffer
+        self.compressed = 0  # Compressed bytes written to the file so far
+        self.members = []  # (offset, size, compressed offset, compressed size) of each member
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        """Get the uncompressed position in the stream"""
+        return self.offset
+
+    def write(self, data) -> int:
+        """
+        Write data to the stream, compressing any complete blocks.
+
+        :param data: Bytes-like object
+        :return: Number of bytes written
+        """
+        if self.closed:
+            raise ValueError("write to closed file")
+        size = memoryview(data).nbytes
+        self.buffer += data
+        self.offset += size
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self.submit(block)
+        return size
+
+    def end_member(self) -> None:
+        """End the current gzip member, so the next data written starts a new one."""
+        if self.buffer:
+            block = bytes(self.buffer)
+            self.buffer.clear()
+            self.submit(block)
+
+    def submit(self, block: bytes) -> None:
+        """Queue a block for compression, writing out finished blocks to keep the queue short"""
+        if self.pool is None:
+            data = Future()
+            data.set_result(compress_member(block, self.level))
+        else:
+            data = self.pool.submit(compress_member, block, self.level)
+        self.pending.append((self.start, len(block), data))
+        self.start += len(block)
+        while self.pending and (len(self.pending) > 2 * self.threads or self.pending[0][2].done()):
+            self.write_member()
+
+    def write_member(self) -> None:
+        """Write the oldest compressed block to the file, waiting for it if necessary"""
+        offset, size, data = self.pending.popleft()
+        data = data.result()
+        self.fileobj.write(data)
+        self.members.append((offset, size, self.compressed, len(data)))
+        self.compressed += len(data)
+
+    def close(self) -> None:
+        """Compress and write out any remaining data."""
+        if self.closed:
+            return
+        try:
+            self.end_member()
+            if not self.pending and not self.members:
+                # An empty stream is still a valid gzip file
+                self.submit(b'')
+            while self.pending:
+                self.write_member()
+            self.fileobj.flush()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+            super().close()
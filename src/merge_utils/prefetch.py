@@ -0,0 +1,206 @@
+"""
+Read-ahead of merge inputs for the merging scripts, so fetching overlaps with merging.
+
+While the merging script works on one input, the next few remote inputs are copied to a local
+scratch directory in the background, and the next few local inputs are read into the page cache.
+The number of inputs fetched ahead and the disk space used by the copies are both limited.
+"""
+
+from __future__ import annotations
+import os
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+DEPTH = 2  # Default number of inputs to fetch ahead
+
+def is_remote(path: str) -> bool:
+    """Check whether an input is a URL rather than a local file"""
+    return '://' in path
+
+def read_ahead(path: str) -> None:
+    """
+    Ask the kernel to start reading a local file into the page cache.
+
+    :param path: Path to the file
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def fetch(url: str, local_path: str) -> int:
+    """
+    Copy a remote input to a local file, with xrdcp if it is available.
+
+    :param url: URL of the input
+    :param local_path: Path for the local copy
+    :return: Size of the local copy in bytes
+    :raises OSError: If the copy failed
+    """
+    try:
+        if shutil.which('xrdcp'):
+            ret = subprocess.run(['xrdcp', '--nopbar', '--silent', '--force', url, local_path],
+                                 check=False)
+            if ret.returncode != 0:
+                raise OSError(f"xrdcp failed with return code {ret.returncode}")
+        else:
+            # Relies on the xrootd POSIX preload library to open the URL
+            with open(url, 'rb') as fin, open(local_path, 'wb') as fout:
+                shutil.copyfileobj(fin, fout, 4 * 1024 * 1024)
+        return os.path.getsize(local_path)
+    except OSError:
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        raise
+
+class Prefetcher:
+    """
+    Iterate over merge inputs, fetching the next few in the background.
+
+    Each item is a tuple of the original input path and the path to open, which is a local copy
+    if one was made.  Normally a local copy is deleted as soon as the next input is requested.
+    With keep set, copies are kept until the prefetcher is closed, for scripts that need all
+    their inputs open at once, and inputs that don't fit in the disk budget are streamed.
+    """
+
+    def __init__(self, inputs: list[str], depth: int = None, tmp_dir: str = None,
+                 max_bytes: int = None, keep: bool = False):
+        """
+        Initialize the prefetcher, using the MERGE_PREFETCH, MERGE_PREFETCH_BYTES, and
+        MERGE_TMP_DIR environment variables set by do_merge for any unset options.
+
+        :param inputs: List of input paths or URLs, in the order they will be merged
+        :param depth: Number of inputs to fetch ahead (0 to disable)
+        :param tmp_dir: Parent directory for the local copies
+        :param max_bytes: Maximum disk space for local copies (default: half the free space)
+        :param keep: Keep local copies until the prefetcher is closed
+        """
+        if depth is None:
+            depth = int(os.environ.get('MERGE_PREFETCH', DEPTH))
+        if tmp_dir is None:
+            tmp_dir = os.environ.get('MERGE_TMP_DIR')
+        if max_bytes is None and 'MERGE_PREFETCH_BYTES' in os.environ:
+            max_bytes = int(os.environ['MERGE_PREFETCH_BYTES'])
+        self.inputs = list(inputs)
+        self.depth = max(0, depth)
+        self.keep = keep
+        self.tmp_dir = None
+        self.max_bytes = max_bytes
+        self.pool = None
+        if self.depth > 0 and any(is_remote(path) for path in self.inputs):
+            if tmp_dir:
+                os.makedirs(tmp_dir, exist_ok=True)
+            self.tmp_dir = tempfile.mkdtemp(prefix='prefetch_', dir=tmp_dir)
+            if self.max_bytes is None:
+                self.max_bytes = shutil.disk_usage(self.tmp_dir).free // 2
+            self.pool = ThreadPoolExecutor(self.depth)
+        self.pending = {}  # {input index: Future for the size of the local copy}
+        self.copies = {}  # {input index: (local path, size)} for finished copies
+        self.next = 0  # Index of the next input to consider fetching
+        self.streamed = 0
+
+    def __enter__(self) -> Prefetcher:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def local_path(self, idx: int) -> str:
+        """Get the path for the local copy of an input"""
+        return os.path.join(self.tmp_dir, f"{idx:06}", os.path.basename(self.inputs[idx]))
+
+    def used(self) -> tuple[int, int]:
+        """
+        Estimate the disk space used by local copies, including the ones still being fetched.
+
+        :return: Estimated bytes used, and number of copies held or in flight
+        """
+        used = sum(size for _, size in self.copies.values())
+        done = count = len(self.copies)
+        for future in self.pending.values():
+            if not future.done():
+                count += 1
+            elif future.exception() is None:
+                used += future.result()
+                done += 1
+                count += 1
+        if done < count:
+            # Assume the copies still in flight are the average size of the finished ones
+            used += (count - done) * (used // done if done else 0)
+        return used, count
+
+    def fill(self, current: int) -> None:
+        """
+        Start fetching inputs up to depth ahead of the current one, within the disk budget.
+
+        :param current: Index of the input about to be merged
+        """
+        while self.next < len(self.inputs) and self.next <= current + self.depth:
+            idx = self.next
+            path = self.inputs[idx]
+            if not is_remote(path):
+                if self.depth > 0:
+                    read_ahead(path)
+            elif self.pool is not None:
+                used, count = self.used()
+                average = used // count if count else 0
+                if count and used + average > self.max_bytes:
+                    if not self.keep:
+                        # Wait for the merge to release some space
+                        return
+                    # Copies are kept until the end, so stream the rest
+                    self.pool.shutdown(wait=False)
+                    self.pool = None
+                    self.streamed = len(self.inputs) - idx
+                    print(f"Prefetch space used up, streaming the last {self.streamed} inputs")
+                else:
+                    local_path = self.local_path(idx)
+                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                    self.pending[idx] = self.pool.submit(fetch, path, local_path)
+            self.next += 1
+
+    def release(self, idx: int) -> None:
+        """Delete the local copy of an input, if there is one"""
+        local_path, _ = self.copies.pop(idx, (None, 0))
+        if local_path is not None:
+            shutil.rmtree(os.path.dirname(local_path), ignore_errors=True)
+
+    def __iter__(self) -> Iterator[tuple[str, str]]:
+        for idx, path in enumerate(self.inputs):
+            self.fill(idx)
+            self.next = max(self.next, idx + 1)
+            # Local inputs, and inputs that weren't fetched, are opened directly
+            future = self.pending.pop(idx, None)
+            local_path = path
+            if future is not None:
+                try:
+                    self.copies[idx] = (self.local_path(idx), future.result())
+                    local_path = self.local_path(idx)
+                except OSError as err:
+                    print(f"WARNING: Failed to prefetch {os.path.basename(path)}, "
+                          f"streaming it instead: {err}")
+            yield path, local_path
+            if not self.keep:
+                self.release(idx)
+
+    def close(self) -> None:
+        """Stop fetching and delete all the local copies."""
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+        self.pending.clear()
+        self.copies.clear()
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
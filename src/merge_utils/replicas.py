@@ -2,17 +2,14 @@
 
 import os
 import sys
-import subprocess
 import logging
 import enum
 import asyncio
 import collections
-import zlib
-from dataclasses import dataclass
 from typing import AsyncGenerator
 from abc import ABC, abstractmethod
 
-from merge_utils import io_utils, config
+from merge_utils import io_utils, config, checksum, latency, naming, xrootd
 from merge_utils.merge_set import MergeSet, MergeFile, MergeFileError
 from merge_utils.retriever import MetaRetriever, InputBatch
 from merge_utils.rucio_utils import RucioWrapper
@@ -137,13 +134,28 @@ class Status(enum.Enum, metaclass=StatusMeta):
         """Return True if this status indicates a bad file replica"""
         return not self.good
 
-@dataclass
 class Replica:
     """Class representing a file replica, including its path and status."""
-    path: str
-    rse: 'BaseRSE' = None
-    status: Status = Status.UNREACHABLE # Assume unreachable until we can check otherwise
-    distance: float = float('inf')
+    __slots__ = ('path', 'rse', 'status', 'distance')
+
+    def __init__(self, path: str, rse: 'BaseRSE' = None,
+                 status: Status = Status.UNREACHABLE, distance: float = float('inf')):
+        self.path = path
+        self.rse = rse
+        self.status = status # Assume unreachable until we can check otherwise
+        self.distance = distance
+
+    def __repr__(self) -> str:
+        return (f"Replica(path={self.path!r}, rse={self.rse!r}, status={self.status!r}, "
+                f"distance={self.distance!r})")
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Replica):
+            return NotImplemented
+        return ((self.path, self.rse, self.status, self.distance)
+                == (other.path, other.rse, other.status, other.distance))
+
+    __hash__ = None
 
     @property
     def protocol(self) -> str:
@@ -172,6 +184,19 @@ class Replica:
             return f"{self.rse.name}: {self.status.name}"
         return f"{self.rse.name}: {self.status.name} (d = {self.distance})"
 
+def get_hasher() -> checksum.Hasher:
+    """
+    Create a checksum Hasher for local replicas based on the configuration.
+
+    :return: Hasher object, with a ChecksumCache if enabled
+    """
+    cfg = config.validation.checksum_cache
+    cache = None
+    if cfg.enabled:
+        naming.Formatter().format(cfg.path)
+        cache = checksum.ChecksumCache(str(cfg.path), float(cfg.lifetime))
+    return checksum.Hasher(config.validation.checksum_threads, cache)
+
 # Classes for representing RSEs and checking the status of replicas on those RSEs
 
 class BaseRSE(ABC):
@@ -186,26 +211,22 @@ class BaseRSE(ABC):
         self.read = True
         self.write = True
 
-    def ping(self) -> float:
-        """Get the ping time to the RSE in ms"""
+    async def ping(self, cache: latency.LatencyCache) -> float:
+        """
+        Get the lowest connection time to any of the RSE hosts in ms
+
+        :param cache: LatencyCache used to measure and remember connection times
+        :return: connection time in ms, or infinity if no hosts are reachable
+        """
         if len(self.urls) == 0:
             logger.warning("No URLs found for RSE %s, cannot ping", self.name)
             return float('inf')
         if 'file' in self.urls:
             logger.debug("RSE %s is local, skipping ping", self.name)
             return 0.0
-        # Try pinging the URLs
-        best_ping = float('inf')
-        hosts = set(get_host(url) for url in self.urls.values())
-        for host in hosts:
-            cmd = ['ping', '-c', '1', host]
-            ret = subprocess.run(cmd, capture_output=True, check=False)
-            if ret.returncode != 0:
-                logger.debug("Failed to ping %s", host)
-                continue
-            ping = float(ret.stdout.split()[-2].split(b'/')[0]) # min ping time
-            logger.debug("Pinged %s, t = %.1f ms", host, ping)
-            best_ping = min(best_ping, ping)
+        # Time connections to all the hosts at once
+        hosts = set((get_host(url), get_port(url)) for url in self.urls.values())
+        best_ping = await cache.best(hosts)
         if best_ping != float('inf'):
             logger.info("Best ping to RSE %s is %.1f ms", self.name, best_ping)
             return best_ping
@@ -213,61 +234,44 @@ class BaseRSE(ABC):
         logger.warning("Failed to ping any URLs for RSE %s", self.name)
         return float('inf')
 
-    async def xrdfs(self, replica: Replica, cmd: str, timeout: float = 1) -> str:
+    def probe_failed(self, replica: Replica, result: xrootd.ProbeResult) -> None:
         """
-        Run an xrdfs command on a replica and return the output
-        In case of failure, set the replica status accordingly and return None
+        Set the status of a replica after a failed xrootd probe.
 
-        :param replica: Replica object to check
-        :param cmd: xrdfs command to run (e.g. 'ls -l')
-        :param timeout: timeout for the xrdfs command in seconds
-        :return: stdout of the xrdfs command, or None if it failed
+        :param replica: Replica object that was checked
+        :param result: ProbeResult of the failed probe
         """
-        protocol = replica.protocol
-        if protocol != 'root':
-            raise ValueError(f"Unsupported protocol for xrdfs: {protocol}")
         host = get_host(replica.path)
-        port = get_port(replica.path)
-        path = get_path(replica.path)
-        url = f"{protocol}://{host}:{port}"
-        full_cmd = ['xrdfs', url] + cmd.split() + [path]
-        try:
-            ret = await asyncio.to_thread(subprocess.run, full_cmd, capture_output=True,
-                                          text=True, check=False, timeout=timeout)
-        except subprocess.TimeoutExpired:
+        replica.status = Status.UNREACHABLE
+        if result.code == xrootd.TIMEOUT:
             logger.debug("Timeout accessing xrootd server %s", host)
-            replica.status = Status.UNREACHABLE
-            return None
-        if ret.returncode != 0:
-            replica.status = Status.UNREACHABLE
-            if ret.returncode == 51:
-                logger.debug("Invalid xrootd server %s", host)
-            elif ret.returncode == 52:
-                logger.debug("Auth failed for xrootd server %s", host)
-            elif ret.returncode == 54:
-                logger.debug("No such file %s", replica.path)
-                replica.status = Status.MISSING
-            elif ret.returncode != 0:
-                logger.debug("Failed to access %s\n  %s", replica.path, ret.stderr.strip())
-            return None
-        return ret.stdout.strip()
-
-    async def checksum_xrootd(self, replica: Replica, cksums: dict) -> bool:
+        elif result.code == xrootd.NO_SERVER:
+            logger.debug("Invalid xrootd server %s", host)
+        elif result.code == xrootd.AUTH_FAILED:
+            logger.debug("Auth failed for xrootd server %s", host)
+        elif result.code == xrootd.NOT_FOUND:
+            logger.debug("No such file %s", replica.path)
+            replica.status = Status.MISSING
+        else:
+            logger.debug("Failed to access %s\n  %s", replica.path, result.message)
+
+    async def checksum_xrootd(self, replica: Replica, cksums: dict,
+                              probe: xrootd.XRootDProbe) -> bool:
         """
         Check the checksums of a remote file against expected values
         
         :param replica: Replica object to check
         :param cksums: dict of {algorithm: expected_checksum} pairs to check against
+        :param probe: XRootDProbe used to query the file
         :return: True if any matching checksums are found, False otherwise
         """
         logger.debug("RSE %s Checking xrootd checksums for file %s", self.name, replica.path)
-        xrdfs_cksums = await self.xrdfs(replica, 'query checksum')
-        if xrdfs_cksums is None:
-            logger.warning("Failed to get checksums for file %s", replica.path)
+        result = await probe.checksums(replica.path)
+        if not result:
+            logger.warning("Failed to get checksums for file %s\n  %s", replica.path, result.message)
             return False
         unknown_algos = set()
-        for line in xrdfs_cksums.splitlines():
-            algo, cksum = line.split()
+        for algo, cksum in result.checksums.items():
             if algo not in cksums:
                 unknown_algos.add(algo)
                 continue
@@ -283,61 +287,42 @@ class BaseRSE(ABC):
         logger.warning("Checksum failed for file %s", replica.path)
         return False
 
-    async def checksum_adler32(self, filename: str, chunk_size=8192) -> str:
-        """Calculate the Adler-32 checksum of a file, working in chunks"""
-        checksum = 1  # Adler-32 state must be initialized to 1 (not 0)
-        with open(filename, "rb") as f:
-            while chunk := f.read(chunk_size):
-                checksum = zlib.adler32(chunk, checksum)
-        return "%08x" % checksum
-
-    async def checksum_local(self, path: str, cksums: dict) -> bool:
+    async def checksum_local(self, path: str, cksums: dict, hasher: checksum.Hasher) -> bool:
         """
-        Check the checksums of a local file against expected values
-        
+        Check the checksums of a local file against expected values.
+        All the supported algorithms in cksums are calculated in a single pass over the file.
+
         :param path: path to the local file
         :param cksums: dict of {algorithm: expected_checksum} pairs to check against
+        :param hasher: Hasher used to read the file
         :return: True if any matching checksums are found, False otherwise
         """
         logger.debug("RSE %s Checking local checksums for file %s", self.name, path)
-        algorithms = [
-            ('adler32', 'xrdadler32'),
-            ('md5', 'md5sum'),
-            ('sha256', 'sha256sum'),
-            ('sha512', 'sha512sum')
-        ]
-        # Check known algorithms
-        for algo, cmd in algorithms:
-            if algo not in cksums:
-                continue
-            expected = cksums[algo]
-            if algo == 'adler32':
-                actual = await self.checksum_adler32(path)
-            else:
-                ret = await asyncio.to_thread(subprocess.run, [cmd, path],
-                                                capture_output=True, text=True, check=False)
-                if ret.returncode != 0:
-                    logger.debug("Failed to run %s for file %s: %s", cmd, path, ret.stderr.strip())
-                    continue
-                actual = ret.stdout.strip().split()[0]
-            if actual == expected:
-                return True
-            logger.warning("File %s has bad %s checksum: %s != %s",
-                            path, algo, actual, expected)
+        algorithms = checksum.supported(cksums)
+        if not algorithms:
+            logger.debug("Unsupported checksum algorithms: %s", ', '.join(cksums))
+            logger.warning("Checksum failed for file %s", path)
             return False
-        # Failed to verify any checksums
-        checked = set(a[0] for a in algorithms)
-        unchecked = set(cksums.keys()) - checked
-        if unchecked:
-            logger.debug("Missing commands for checksum algorithms: %s", ', '.join(unchecked))
-        logger.warning("Checksum failed for file %s", path)
-        return False
-
-    async def cache_xrootd(self, replica: Replica, timeout: float = 1) -> None:
+        try:
+            actual = await hasher.checksums(path, algorithms)
+        except OSError as err:
+            logger.warning("Failed to read file %s: %s", path, err)
+            return False
+        matched = any(actual[algo] == cksums[algo] for algo in algorithms)
+        for algo in algorithms:
+            if actual[algo] != cksums[algo]:
+                # A stale secondary checksum doesn't fail the file if another one matches
+                logger.log(logging.DEBUG if matched else logging.WARNING,
+                           "File %s has bad %s checksum: %s != %s",
+                           path, algo, actual[algo], cksums[algo])
+        return matched
+
+    async def cache_xrootd(self, replica: Replica, probe: xrootd.XRootDProbe) -> None:
         """
         Check if a replica is online or nearline by using gfal-xattr to query user.status
 
         :param replica: Replica object to check
+        :param probe: XRootDProbe used to query the file
         """
         logger.debug("RSE %s Checking xrootd cache status for file %s", self.name, replica.path)
         # Skip cache check if the distance is already too high
@@ -346,23 +331,18 @@ class BaseRSE(ABC):
             return
         # Assume nearline unless we can confirm it is online
         replica.status = Status.NEARLINE
-        cmd = ['gfal-xattr', '-t', int(timeout), replica.path, 'user.status']
-        try:
-            ret = await asyncio.to_thread(subprocess.run, cmd, capture_output=True,
-                                          text=True, check=False, timeout=timeout+1)
-        except subprocess.TimeoutExpired:
-            logger.debug("Timeout running gfal-xattr on %s", replica.path)
+        result = await probe.locality(replica.path)
+        if not result:
+            logger.debug("Failed to get locality of %s\n  %s", replica.path, result.message)
             return
-        if ret.returncode != 0:
-            # code 110 is timeout
-            logger.debug("Failed to run gfal-xattr on %s\n  %s", replica.path, ret.stderr.strip())
-            return
-        status = ret.stdout.strip()
-        if status == 'UNKNOWN':
+        if result.locality == 'UNKNOWN':
             logger.info("Got UNKNOWN status for %s, assuming NEARLINE", replica.path)
             return
         # If we got a valid status, set it on the replica
-        replica.status = Status[status]
+        try:
+            replica.status = Status[result.locality]
+        except KeyError:
+            logger.debug("Got unexpected status %s for %s", result.locality, replica.path)
 
     def cache_local(self, replica: Replica) -> None:
         """
@@ -381,11 +361,12 @@ class BaseRSE(ABC):
             status = stats.readline().strip()
         replica.status = Status[status]
 
-    async def check_cache(self, replica: Replica) -> None:
+    async def check_cache(self, replica: Replica, probe: xrootd.XRootDProbe) -> None:
         """
         Check if a replica is online or nearline using the appropriate method
 
         :param replica: Replica object to check
+        :param probe: XRootDProbe used to query remote files
         """
         logger.debug("RSE %s Checking cache status for file %s", self.name, replica.path)
         # For non-dcache RSEs, set status to ONLINE or NEARLINE depending on tape vs disk type
@@ -402,18 +383,21 @@ class BaseRSE(ABC):
             await asyncio.to_thread(self.cache_local, replica)
         else:
             logger.debug("RSE %s checking xrootd cache for file %s", self.name, replica.path)
-            await self.cache_xrootd(replica)
+            await self.cache_xrootd(replica, probe)
         # If the file is not online, add the staging penalty to the distance
         if replica.status != Status.ONLINE:
             replica.distance += self.staging
 
-    async def check_local(self, replica: Replica, size: int = None, cksums: dict = None):
+    async def check_local(self, replica: Replica, size: int = None, cksums: dict = None,
+                          probe: xrootd.XRootDProbe = None, hasher: checksum.Hasher = None):
         """
         Check the status of a local file replica
 
         :param replica: Replica object to check
         :param size: optionally check the file size against an expected value
         :param cksums: optionally check the file checksums against a dict of {algorithm: checksum}
+        :param probe: XRootDProbe used to query remote files
+        :param hasher: Hasher used to checksum local files
         """
         # Make sure the file exists and is readable
         if not await asyncio.to_thread(os.path.isfile, replica.path):
@@ -426,49 +410,59 @@ class BaseRSE(ABC):
         if size and await asyncio.to_thread(os.path.getsize, replica.path) != size:
             replica.status = Status.BAD_SIZE
             return
-        if cksums and not await self.checksum_local(replica.path, cksums):
+        if cksums and not await self.checksum_local(replica.path, cksums, hasher):
             replica.status = Status.BAD_CHECKSUM
             return
         # Check the cache status of the file
-        await self.check_cache(replica)
+        await self.check_cache(replica, probe)
 
-    async def check_xrootd(self, replica: Replica, size: int = None, cksums: dict = None):
+    async def check_xrootd(self, replica: Replica, size: int = None, cksums: dict = None,
+                           probe: xrootd.XRootDProbe = None):
         """
         Check the status of a remote file replica accessed via xrootd
 
         :param replica: Replica object to check
         :param size: optionally check the file size against an expected value
         :param cksums: optionally check the file checksums against a dict of {algorithm: checksum}
+        :param probe: XRootDProbe used to query remote files
         """
         # If we have an expected size, make sure the file exists and matches that size
         if size:
-            ls = await self.xrdfs(replica, 'ls -l')
-            if ls is None:
+            result = await probe.stat(replica.path)
+            if not result:
+                self.probe_failed(replica, result)
                 return
-            ls_perm, _, _, ls_size, _ = ls.split() # permissions, date, time, size, name
             # Make sure the file is readable
-            if ls_perm[1] != 'r':
+            if not result.readable:
                 logger.debug("File %s is not readable", replica.path)
+                replica.status = Status.UNREACHABLE
                 return
             # Check the size
-            if ls_size != size:
+            if result.size != size:
                 replica.status = Status.BAD_SIZE
                 return
             # Check the checksums, if we have expected values
-            if cksums and not await self.checksum_xrootd(replica, cksums):
+            if cksums and not await self.checksum_xrootd(replica, cksums, probe):
                 replica.status = Status.BAD_CHECKSUM
                 return
         # Check the cache status of the file
-        await self.check_cache(replica)
+        await self.check_cache(replica, probe)
 
-    async def check(self, replica: Replica, size: int = None, cksums: dict = None):
+    async def check(self, replica: Replica, size: int = None, cksums: dict = None,
+                    probe: xrootd.XRootDProbe = None, hasher: checksum.Hasher = None):
         """
         Check the status of a file replica on the RSE
 
         :param replica: Replica object to check
         :param size: optionally check the file size against an expected value
         :param cksums: optionally check the file checksums against a dict of {algorithm: checksum}
+        :param probe: XRootDProbe used to query remote files (default: a new CommandProbe)
+        :param hasher: Hasher used to checksum local files (default: the event loop's executor)
         """
+        if probe is None:
+            probe = xrootd.get()
+        if hasher is None:
+            hasher = checksum.Hasher()
         logger.debug("RSE %s checking replica %s", self.name, replica.path)
         replica.distance = self.distance
         # Don't bother checking bad RSEs
@@ -485,8 +479,7 @@ class BaseRSE(ABC):
         # For local files, check directly but try to convert to xrootd URL if possible
         if protocol == 'file':
             logger.debug("RSE %s checking local replica %s", self.name, replica.path)
-            await self.check_local(replica, size=size, cksums=cksums)
-            print("finished local check")
+            await self.check_local(replica, size=size, cksums=cksums, probe=probe, hasher=hasher)
             if 'xrootd' in self.urls:
                 replica.path = replica.path.replace(self.urls['file'], self.urls['xrootd'], 1)
             return
@@ -495,13 +488,13 @@ class BaseRSE(ABC):
             url = replica.path
             replica.path = url.replace(self.urls[protocol], self.urls['file'], 1)
             logger.debug("RSE %s converting to local path %s", self.name, replica.path)
-            await self.check_local(replica, size=size, cksums=cksums)
+            await self.check_local(replica, size=size, cksums=cksums, probe=probe, hasher=hasher)
             replica.path = url
             return
         # For xrootd files, check using xrdfs and gfal-xattr
         if protocol == 'root':
             logger.debug("RSE %s checking xrootd replica %s", self.name, replica.path)
-            await self.check_xrootd(replica, size=size, cksums=cksums)
+            await self.check_xrootd(replica, size=size, cksums=cksums, probe=probe)
             return
         # If we get here, we don't know how to check this replica
         logger.debug("Unsupported protocol %s for replica %s", protocol, replica.path)
@@ -561,8 +554,14 @@ class GenericRSE(BaseRSE):
             self.distance = float(config.sites.rse_distances['disk'])
             if self.staging is None:
                 self.staging = float(config.sites.rse_distances['tape']) - self.distance
-        # Add ping time to the distance
-        self.distance += self.ping()
+
+    async def add_latency(self, cache: latency.LatencyCache) -> None:
+        """
+        Add the connection time to the RSE to its distance
+
+        :param cache: LatencyCache used to measure and remember connection times
+        """
+        self.distance += await self.ping(cache)
 
 class RucioRSE(BaseRSE):
     """Class to store information about a Rucio RSE"""
@@ -620,6 +619,7 @@ class RucioRSE(BaseRSE):
 class PathFinder(MetaRetriever):
     """Base class for finding paths to files"""
     name: str = "replicas"
+    stage: str = "replicas"
     file_owner: bool = False
 
     def __init__(self, meta: MetaRetriever):
@@ -627,6 +627,9 @@ class PathFinder(MetaRetriever):
         self.meta = meta
         self.client = RucioWrapper()
         self.rses = {}
+        self.probe = xrootd.get()
+        self.hasher = get_hasher()
+        self.latency = latency.get()
         self.replica_queue = None
         self.workers = []
 
@@ -635,6 +638,11 @@ class PathFinder(MetaRetriever):
         """Return the set of files from the source"""
         return self.meta.files
 
+    @files.setter
+    def files(self, files: MergeSet) -> None:
+        """Replace the set of files, e.g. when restoring a checkpoint"""
+        self.meta.files = files
+
     async def replica_checker(self) -> None:
         """Asynchronous worker method to check the status of replicas from the replica queue"""
         while True:
@@ -645,7 +653,8 @@ class PathFinder(MetaRetriever):
                 self.replica_queue.task_done()
                 break
             # Check the replica and mark the job as done
-            await job[0].rse.check(job[0], size=job[1], cksums=job[2])
+            await job[0].rse.check(job[0], size=job[1], cksums=job[2],
+                                   probe=self.probe, hasher=self.hasher)
             self.replica_queue.task_done()
 
     async def check_replica(self, replica: Replica, size: int = None, cksums: dict = None) -> None:
@@ -662,6 +671,7 @@ class PathFinder(MetaRetriever):
     async def connect(self) -> None:
         """Connect to the file source and rucio"""
         await asyncio.gather(self.meta.connect(), self.client.connect())
+        self.latency.open()
         self.replica_queue = asyncio.Queue()
         for _ in range(int(config.validation.concurrency)):
             worker = asyncio.create_task(self.replica_checker())
@@ -670,10 +680,12 @@ class PathFinder(MetaRetriever):
     async def disconnect(self) -> None:
         """Disconnect from the file source and rucio, and stop the replica checkers"""
         await asyncio.gather(self.meta.disconnect(), self.client.disconnect())
+        self.latency.close()
         # Stop the replica checkers
         for _ in self.workers:
             await self.replica_queue.put(None)
         await asyncio.gather(*self.workers)
+        self.hasher.close()
 
     async def get_metadata(self, batch: InputBatch, limit: int) -> list:
         raise NotImplementedError("PathFinder does not implement get_metadata")
@@ -864,6 +876,7 @@ class PathListFinder(PathFinder):
     def __init__(self, source: MetaRetriever, paths: dict = None):
         super().__init__(source)
         self.paths = paths or {}
+        self.new_rses = {}  # {prefix: task creating a GenericRSE for that prefix}
 
     def add_rse(self, rse: BaseRSE) -> None:
         """Add an RSE to the list of known RSEs"""
@@ -871,6 +884,19 @@ class PathListFinder(PathFinder):
             rses = self.rses.setdefault(protocol, {})
             rses[url] = rse
 
+    async def new_rse(self, prefix: str) -> BaseRSE:
+        """
+        Create a generic RSE for a path prefix, measuring its latency before it is registered
+        so other replicas never see it without the latency in its distance.
+
+        :param prefix: URL prefix for the RSE
+        :return: the new RSE
+        """
+        rse = GenericRSE(url=prefix)
+        await rse.add_latency(self.latency)
+        self.add_rse(rse)
+        return rse
+
     async def connect(self) -> None:
         """Connect to the file source and rucio"""
         await super().connect()
@@ -884,13 +910,12 @@ class PathListFinder(PathFinder):
             logger.critical("Failed to connect to Rucio client")
             sys.exit(1)
         # For local jobs, fall back to generic RSEs for DCACHE locations
-        for name in config.sites.dcache.keys():
-            self.add_rse(GenericRSE(name=name))
+        rses = [GenericRSE(name=name) for name in config.sites.dcache.keys()]
         # Also check for path-like keys in the distance config to create generic RSEs for those
-        for url in config.sites.rse_distances.keys():
-            if '/' not in url:
-                continue
-            self.add_rse(GenericRSE(url=url))
+        rses.extend(GenericRSE(url=url) for url in config.sites.rse_distances.keys() if '/' in url)
+        await asyncio.gather(*[rse.add_latency(self.latency) for rse in rses])
+        for rse in rses:
+            self.add_rse(rse)
 
     async def add_replica(self, file: MergeFile, path: str, rse_name: str = None) -> None:
         """
@@ -917,8 +942,11 @@ class PathListFinder(PathFinder):
                 prefix = "/{path.split('/',2)[1]}/"
             else:
                 prefix = f"{protocol}://{get_host(path)}:{get_port(path)}/"
-            rse = GenericRSE(url=prefix)
-            self.add_rse(rse)
+            # Replicas with the same prefix wait for the same RSE while its latency is measured
+            task = self.new_rses.get(prefix)
+            if task is None:
+                task = self.new_rses[prefix] = asyncio.ensure_future(self.new_rse(prefix))
+            rse = await task
         # Add the replica to the file
         replica = Replica(path=path, rse=rse)
         file.replicas.append(replica)
@@ -1,22 +1,34 @@
 """FileRetriever classes"""
 
+from __future__ import annotations
 import logging
 import os
+import re
 import sys
-import json
+import math
 import asyncio
+import multiprocessing
 from abc import ABC, abstractmethod
 import collections
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 
 from typing import AsyncGenerator, Callable
 
-from merge_utils import config, io_utils
-from merge_utils.merge_set import MergeSet, MergeFileError
+from merge_utils import config, io_utils, metacat_cache, checkpoint
+from merge_utils.merge_set import MergeSet, MergeFile, MergeFileError
 from merge_utils.metacat_utils import MetaCatWrapper
 
 logger = logging.getLogger(__name__)
 
+QUOTED = re.compile(r"'[^']*'|\"[^\"]*\"")
+# Queries that cursor paging can add a condition to: all files, or one dataset, filtered by
+# a single where clause
+SIMPLE_QUERY = re.compile(r"\s*files(?:\s+from\s+[^\s(),]+)?(?:\s+where\s+(?P<cond>.+?))?"
+                          r"(?:\s+ordered)?\s*", re.IGNORECASE | re.DOTALL)
+PAGING = re.compile(r"(?:\s(?:skip|limit)\s+\d+)+\s*$", re.IGNORECASE)
+KEYWORDS = re.compile(r"\b(?:files|where|ordered|skip|limit)\b", re.IGNORECASE)
+
 @dataclass
 class InputBatch:
     """Class representing a batch of input file data, starting at a specific skip index."""
@@ -45,9 +57,120 @@ def file_serializer(obj):
         return obj.name
     raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
+class LogCollector(logging.Handler):
+    """Log handler that keeps records in memory, so a worker process can pass them back"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # Format the message now, since the arguments might not be picklable
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+    def pop(self) -> list:
+        """Return and clear the collected records"""
+        records, self.records = self.records, []
+        return records
+
+worker_log = LogCollector()
+
+def init_validation_worker(cfg: str, level: int) -> None:
+    """
+    Set up a worker process for validating file metadata.
+
+    :param cfg: snapshot of the parent process configuration
+    :param level: logging level of the parent process
+    :return: None
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(worker_log)
+    root.setLevel(level)
+    config.restore(cfg)
+    worker_log.pop()
+
+def validate_records(records: list) -> tuple[list, list]:
+    """
+    Create and validate MergeFile objects for raw file records, in a worker process.
+
+    :param records: list of file metadata dictionaries
+    :return: list of MergeFile summaries, and list of log records emitted while validating
+    """
+    files = [file.summary() for file in MergeFile.from_batch(records)]
+    return files, worker_log.pop()
+
+def mask_strings(query: str) -> str:
+    """Blank out the contents of quoted strings in an MQL query, keeping character positions"""
+    return QUOTED.sub(lambda m: m.group()[0] + ' ' * (len(m.group()) - 2) + m.group()[0], query)
+
+def has_paging(query: str) -> bool:
+    """
+    Check whether an MQL query ends with its own skip or limit clause.
+
+    :param query: MQL query
+    :return: True if the query already limits which files it returns
+    """
+    return PAGING.search(mask_strings(query)) is not None
+
+def match_simple(query: str) -> re.Match | None:
+    """
+    Match a query with a form that cursor_query can safely extend.
+
+    :param query: MQL query
+    :return: match against the masked query, or None if the query is not simple enough
+    """
+    match = SIMPLE_QUERY.fullmatch(mask_strings(query))
+    if match is None or (match['cond'] and KEYWORDS.search(match['cond'])):
+        return None
+    return match
+
+def fid_condition(fid: str) -> str:
+    """
+    Build the MQL condition for files following a given FID in the 'ordered' order.
+    Numeric FIDs are compared as numbers, so FIDs of different lengths are in the right order.
+
+    :param fid: last FID of the previous page
+    :return: MQL condition string
+    """
+    fid = str(fid)
+    if fid.isdigit():
+        return f"fid > {int(fid)}"
+    return f"fid > '{fid}'"
+
+def cursor_query(query: str, fid: str | None, limit: int) -> str:
+    """
+    Build an MQL query for the page of files following a given FID.
+
+    :param query: base MQL query, with or without the 'ordered' keyword
+    :param fid: last FID of the previous page, or None for the first page
+    :param limit: maximum number of files to return
+    :return: MQL query string
+    :raises ValueError: if the query is too complex to add a FID condition to
+    """
+    query = query.strip()
+    match = match_simple(query)
+    if match is None:
+        raise ValueError(f"Cannot use cursor paging with query '{query}'")
+    if match['cond']:
+        query = f"{query[:match.start('cond')]}({query[match.start('cond'):match.end('cond')]})"
+        if fid is not None:
+            query += f" and {fid_condition(fid)}"
+    else:
+        if query.lower().endswith(' ordered'):
+            query = query[:-len(' ordered')].rstrip()
+        if fid is not None:
+            query += f" where {fid_condition(fid)}"
+    return f"{query} ordered limit {limit}"
+
 class MetaRetriever(ABC):
     """Base class for retrieving metadata from a source"""
     name: str = "metadata"
+    stage: str = "metadata"
     file_owner: bool = True
 
     def __init__(self):
@@ -55,13 +178,22 @@ class MetaRetriever(ABC):
             self._files = MergeSet()
         self.dir = os.path.join(str(config.job.dir), 'cache', self.name)
         os.makedirs(self.dir, exist_ok=True)
-        self.client = MetaCatWrapper()
+        self.client = MetaCatWrapper(metacat_cache.get(),
+                                     connections = int(config.validation.connections),
+                                     max_files = int(config.validation.batch_size))
+        self.processes = int(config.validation.processes) if self.file_owner else 1
+        self.pool = None
 
     @property
     def files(self) -> MergeSet:
         """Return the set of files from the source"""
         return self._files
 
+    @files.setter
+    def files(self, files: MergeSet) -> None:
+        """Replace the set of files, e.g. when restoring a checkpoint"""
+        self._files = files
+
     @property
     def namespace(self) -> str:
         """
@@ -84,29 +216,46 @@ class MetaRetriever(ABC):
         tag = str(config.input.tag)
         logger.info("Checking MetaCat for already merged files with tag '%s'", tag)
         query = f"files where merge.tag == '{tag}' and dune.output_status == confirmed"
+        step = int(config.validation.batch_size)
+        cursor = config.validation.paging == 'cursor'
         dids = []
         skip = 0
+        fid = None
         while True:
-            batch_query = query + f" skip {skip} limit {config.validation.batch_size}"
+            if cursor:
+                batch_query = cursor_query(query, fid, step)
+            else:
+                batch_query = query + f" ordered skip {skip} limit {step}"
             files = await self.client.query(batch_query, metadata=False, provenance=False)
             self.files.children.update(f['fid'] for f in files)
             dids.extend(f"{f['namespace']}:{f['name']}" for f in files)
-            if len(files) < config.validation.batch_size:
+            if len(files) < step:
                 break
-            skip += config.validation.batch_size
+            skip += step
+            fid = files[-1]['fid']
         if not dids:
             logger.info("No already merged files found with tag '%s'", tag)
             return
         io_utils.log_list("Found {n} merged file{s} with tag '%s':" % tag, dids, logging.INFO)
 
     async def connect(self) -> None:
-        """Connect to the MetaCat web API"""
+        """Connect to the MetaCat web API, and start the validation processes if enabled"""
+        if self.processes > 1 and self.pool is None:
+            logger.debug("Validating metadata with %d processes", self.processes)
+            self.pool = ProcessPoolExecutor(
+                max_workers = self.processes,
+                mp_context = multiprocessing.get_context('spawn'),
+                initializer = init_validation_worker,
+                initargs = (config.snapshot(), logging.getLogger().getEffectiveLevel()))
         await self.client.connect()
         await self.get_done()
 
     async def disconnect(self) -> None:
-        """Disconnect from the MetaCat web API"""
+        """Disconnect from the MetaCat web API, and stop the validation processes"""
         await self.client.disconnect()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
 
     @abstractmethod
     async def get_metadata(self, batch: InputBatch, limit: int) -> list:
@@ -129,17 +278,52 @@ class MetaRetriever(ABC):
         :return: list of file dictionaries
         """
         skip = batch.skip
-        cache = os.path.join(self.dir, f"batch_{skip}.json")
+        cache = os.path.join(self.dir, f"batch_{skip}.jsonl.gz")
+        old_cache = os.path.join(self.dir, f"batch_{skip}.json")
         if os.path.exists(cache):
             logger.debug("Loading cached %s input batch %d", self.name, skip)
-            files = io_utils.read_config_file(cache).get('files', [])
+            files = list(io_utils.iter_jsonl(cache))
+        elif os.path.exists(old_cache):
+            # Caches from older versions were written as a single JSON document
+            logger.debug("Loading old-style cached %s input batch %d", self.name, skip)
+            files = io_utils.read_config_file(old_cache).get('files', [])
         else:
             logger.debug("Retrieving new %s input batch %d", self.name, skip)
             files = await getter(batch=batch, **kwargs)
-            with open(cache, 'w', encoding="utf-8") as f:
-                f.write(json.dumps({'files': files}, indent=2, default=file_serializer))
+            await asyncio.to_thread(io_utils.write_jsonl, cache, files, default=file_serializer)
         return InputBatch(skip=skip, files=files)
 
+    async def validate_batch(self, batch: InputBatch) -> tuple[list, list] | None:
+        """
+        Validate a batch of raw file records in the worker processes, if they are enabled.
+
+        :param batch: InputBatch object with file metadata dictionaries
+        :return: list of validated MergeFile objects and list of log records to emit when they
+            are added, or None if the files should be validated when they are added
+        """
+        if self.pool is None or not batch:
+            return None
+        step = math.ceil(len(batch) / self.processes)
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(self.pool, validate_records, batch.files[i:i+step])
+            for i in range(0, len(batch), step)
+        ])
+        files = [MergeFile.from_summary(file) for summaries, _ in results for file in summaries]
+        logs = [record for _, records in results for record in records]
+        return files, logs
+
+    async def retrieve_batch(self, batch: InputBatch, limit: int) -> tuple[InputBatch, tuple]:
+        """
+        Asynchronously retrieve a batch of input metadata and start validating it.
+
+        :param batch: empty InputBatch object with the skip index set
+        :param limit: maximum number of files to retrieve
+        :return: InputBatch with the file dictionaries, and the results of validate_batch
+        """
+        batch = await self.get_batch(self.get_metadata, batch, limit=limit)
+        return batch, await self.validate_batch(batch)
+
     async def check_existence(self, files: list) -> None:
         """
         Check that MetaCat records exist for a batch of input files.
@@ -274,46 +458,65 @@ class MetaRetriever(ABC):
             await self.get_siblings(files)
         return files
 
+    async def count(self) -> int | None:
+        """
+        Get the total number of input files, if it can be known before retrieving them.
+
+        :return: number of input files, or None if unknown
+        """
+        return None
+
     async def input_batches(self) -> AsyncGenerator[InputBatch, None]:
         """
         Asynchronously retrieve input file metadata in batches.
+        Several batches are requested at once, but they are always processed in skip order.
 
         :return: InputBatch object containing skip index and list of MergeFile objects
         """
         skip0 = int(config.input.skip or 0)
-        skip = skip0
         step = int(config.validation.batch_size)
-        task = None
-        while True:
-            # Determine file limit for next batch
-            limit = step
-            if config.input.limit:
-                limit = min(limit, config.input.limit + skip0 - skip)
-            # Get previous batch to process, if we have a request in flight
-            batch = await task if task is not None else None
-            task = None
-            # Start request for next batch
-            if limit > 0:
-                req = InputBatch(skip=skip)
-                task = asyncio.create_task(self.get_batch(self.get_metadata, req, limit=limit))
-            # Increment skip for next batch
-            skip += step
-            # Process previous batch while we wait, if we have one
-            if batch is None:
-                continue
-            logger.info("Processing new %s input batch %d", self.name, batch.skip)
-            # Add file to merge set, and yield if we added any
-            added = await asyncio.to_thread(self.files.add, batch.skip, batch.files)
-            if added:
-                yield InputBatch(skip=batch.skip, files=added)
-            # If there is no next task, we're done
-            if task is None:
-                break
-            # If the last batch was a partial batch, we're done
-            if len(batch) < step:
-                # Need to wait for the the last task to finish
-                await task
-                break
+        # Determine the end of the input range, if we can
+        end = skip0 + int(config.input.limit) if config.input.limit else None
+        total = await self.count()
+        if total is not None:
+            logger.info("Found %d %s input file%s", total, self.name, "s" if total != 1 else "")
+            end = total if end is None else min(end, total)
+        # Limit the requests in flight, even if we know how many batches there are
+        depth = max(1, int(config.validation.prefetch))
+        tasks = collections.deque()
+        skip = skip0
+        try:
+            while True:
+                # Keep the request window full
+                while len(tasks) < depth and (end is None or skip < end):
+                    limit = step if end is None else min(step, end - skip)
+                    req = InputBatch(skip=skip)
+                    tasks.append(asyncio.create_task(self.retrieve_batch(req, limit)))
+                    skip += step
+                # If there are no requests in flight, we're done
+                if not tasks:
+                    break
+                # Process the oldest batch while the others are in flight
+                batch, validated = await tasks.popleft()
+                logger.info("Processing new %s input batch %d", self.name, batch.skip)
+                # Add file to merge set, and yield if we added any
+                if validated is None:
+                    added = await asyncio.to_thread(self.files.add, batch.skip, batch.files)
+                else:
+                    files, logs = validated
+                    for record in logs:
+                        logging.getLogger(record.name).handle(record)
+                    added = await asyncio.to_thread(self.files.add, batch.skip, batch.files, files)
+                if added:
+                    yield InputBatch(skip=batch.skip, files=added)
+                # If the last batch was a partial batch, we're done
+                if end is None and len(batch) < step:
+                    break
+        finally:
+            # Don't leave requests running if we stopped early or a batch failed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
         # Yield empty batch to signal completion
         yield InputBatch()
 
@@ -324,12 +527,29 @@ class MetaRetriever(ABC):
         # Loop over batches, checking for errors as we go
         async for _ in self.input_batches():
             self.files.check_errors()
-        # Close connections and do final error checking
-        await self.client.disconnect()
+        # Close connections, save the results, and do final error checking
+        await self.disconnect()
+        checkpoint.save(self.stage, {'files': self.files})
         self.files.check_errors(final = True)
 
+    def restore(self) -> bool:
+        """
+        Restore the files from a checkpoint of this stage, if one exists.
+
+        :return: True if the files were restored
+        """
+        state = checkpoint.load(self.stage)
+        if state is None:
+            return False
+        self.files = state['files']
+        io_utils.log_print(f"Restored {len(self.files)} files from previous {self.stage} check")
+        return True
+
     def run(self) -> None:
-        """Retrieve metadata for all files."""
+        """Retrieve metadata for all files, or restore them from a previous run."""
+        if self.restore():
+            self.files.check_errors(final = True)
+            return
         try:
             asyncio.run(self._loop())
         except ValueError as err:
@@ -347,13 +567,56 @@ class QueryRetriever(MetaRetriever):
         :param query: MQL query to find files
         """
         super().__init__()
-        if 'skip' in query or 'limit' in query:
+        if has_paging(query):
             logger.warning("Consider using command line options for 'skip' and 'limit'!")
         elif query.endswith(' ordered'):
             logger.info("Merge-Utils will append the 'ordered' keyword to queries automatically.")
         else:
             query += ' ordered'
         self.query = query
+        # Cursor paging needs a query simple enough to add a FID condition to
+        self.cursor = config.validation.paging == 'cursor' and match_simple(query) is not None
+        if config.validation.paging == 'cursor' and not self.cursor:
+            logger.info("Query is too complex for cursor paging, paging by offset instead")
+        self.cursors = {}
+
+    async def count(self) -> int | None:
+        """
+        Count the files matching the query, unless it already has its own skip or limit.
+
+        :return: number of matching files, or None if unknown
+        """
+        if has_paging(self.query):
+            return None
+        return await self.client.count(self.query)
+
+    async def get_batch(self, getter: Callable, batch: InputBatch, **kwargs) -> InputBatch:
+        """
+        Asynchronously retrieve a batch of input data, with caching.
+        In cursor paging mode, also pass the last FID of the batch on to the next request.
+
+        :param getter: function to call to retrieve inputs
+        :param batch: InputBatch object to retrieve data for
+        :param kwargs: additional arguments to pass to getter
+        :return: list of file dictionaries
+        """
+        if not self.cursor:
+            return await super().get_batch(getter, batch, **kwargs)
+        # Requests are started in skip order, so the next batch can wait on this one's cursor
+        step = int(config.validation.batch_size)
+        cursor = asyncio.get_running_loop().create_future()
+        self.cursors[batch.skip + step] = cursor
+        try:
+            result = await super().get_batch(getter, batch, **kwargs)
+        except asyncio.CancelledError:
+            cursor.cancel()
+            raise
+        except Exception as err:
+            cursor.set_exception(err)
+            cursor.exception()  # Don't warn if no other request is waiting on this one
+            raise
+        cursor.set_result(result.files[-1]['fid'] if len(result) == step else None)
+        return result
 
     async def get_metadata(self, batch: InputBatch, limit: int) -> list:
         """
@@ -363,7 +626,15 @@ class QueryRetriever(MetaRetriever):
         :param limit: maximum number of files to retrieve
         :return: list of file metadata dictionaries
         """
-        query_batch = self.query + f" skip {batch.skip} limit {limit}"
+        cursor = self.cursors.pop(batch.skip, None)
+        if cursor is None:
+            query_batch = self.query + f" skip {batch.skip} limit {limit}"
+        else:
+            fid = await cursor
+            if fid is None:
+                logger.debug("No files left to request for skip=%d", batch.skip)
+                return []
+            query_batch = cursor_query(self.query, fid, limit)
         # In grandparents mode, we need the parents of the input files
         parents = bool(config.output.grandparents)
         # To check for already merged files, we need the children of the input files
@@ -440,6 +711,14 @@ class DidRetriever(MetaRetriever):
             sys.exit(1)
         return dupes
 
+    async def count(self) -> int:
+        """
+        Get the number of DIDs in the input list.
+
+        :return: number of input files
+        """
+        return len(self.dids)
+
     async def get_metadata(self, batch: InputBatch, limit: int) -> list:
         """
         Asynchronously request a batch of DIDs from MetaCat
@@ -494,6 +773,14 @@ class LocalMetaRetriever(MetaRetriever):
         super().__init__()
         self.paths = paths
 
+    async def count(self) -> int:
+        """
+        Get the number of metadata files in the input list.
+
+        :return: number of input files
+        """
+        return len(self.paths)
+
     async def get_metadata(self, batch: InputBatch, limit: int) -> list:
         """
         Asynchronously retrieve metadata for a specific batch of files.
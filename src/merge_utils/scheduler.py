@@ -3,17 +3,19 @@
 import logging
 import os
 import sys
+import glob
 import shutil
 import json
 import tarfile
+import shlex
 import subprocess
 import collections
-import math
 import asyncio
 from abc import ABC, abstractmethod
 from typing import AsyncGenerator
 
-from merge_utils import io_utils, config, justin_utils
+from merge_utils import io_utils, config, naming, justin_utils, checkpoint
+from merge_utils import checksum, parallel_gzip, prefetch, tar_index
 from merge_utils.merge_set import MergeFileError, MergeSet, MergeFile, MergeChunk
 from merge_utils.retriever import InputBatch
 from merge_utils.replicas import Replica, PathFinder, GenericRSE, RucioRSE
@@ -40,6 +42,7 @@ class JobScheduler(ABC):
         self.source = source
         self.dir = os.path.join(str(config.job.dir), 'merge')
         self.distances = {} # Cache of RSE-site distances
+        self.justin_rows = [] # Raw site-RSE table from JustIN, if any
         self.jobs = []
 
     @property
@@ -114,28 +117,43 @@ class JobScheduler(ABC):
         :return: InputBatch object containing skip index and list of MergeFile objects
         """
         async for batch in self.source.input_batches():
-            unreachable = []
             for file in batch:
                 if file.errors:
                     continue
-                # Get minimum distance from the file replicas to any merging site
-                min_dist = float('inf')
+                # Make sure we have distances for all the good replicas
                 for replica in file.replicas:
-                    if not replica.status.good:
-                        continue
-                    replica_dists = await self.replica_distances(replica)
-                    dist = replica.distance + min(replica_dists.values())
-                    min_dist = min(min_dist, dist)
-                # File is unreachable no RSE-site distance was below threshold
-                if min_dist > config.sites.max_distance:
-                    logger.warning("File %s has no replicas within max distance", file.did)
-                    unreachable.append(file.did)
+                    if replica.status.good:
+                        await self.replica_distances(replica)
             # Set unreachable flag for bad files
-            self.files.set_error(unreachable, 'UNREACHABLE')
+            self.check_reachable(batch.files)
             # Output batch with reachable files
             good_files = [f for f in batch if not f.errors]
             yield InputBatch(skip=batch.skip, files=good_files)
 
+    def check_reachable(self, files: list) -> None:
+        """
+        Flag files with no replicas within the maximum distance of any merging site.
+
+        :param files: list of MergeFile objects to check
+        """
+        unreachable = []
+        for file in files:
+            if file.errors:
+                continue
+            # Get minimum distance from the file replicas to any merging site
+            min_dist = float('inf')
+            for replica in file.replicas:
+                if not replica.status.good:
+                    continue
+                replica_dists = self.distances.get(replica.rse.name)
+                if replica_dists:
+                    min_dist = min(min_dist, replica.distance + min(replica_dists.values()))
+            # File is unreachable no RSE-site distance was below threshold
+            if min_dist > config.sites.max_distance:
+                logger.warning("File %s has no replicas within max distance", file.did)
+                unreachable.append(file.did)
+        self.files.set_error(unreachable, 'UNREACHABLE')
+
     async def _loop(self) -> None:
         """Repeatedly get input_batches until all files are retrieved."""
         # Connect to source
@@ -153,9 +171,39 @@ class JobScheduler(ABC):
         except ValueError as err:
             logger.critical("%s", err)
             sys.exit(1)
-
+        # Save the validated files before scheduling modifies the replica lists
+        checkpoint.save('schedule', {
+            'files': self.files,
+            'distances': self.distances,
+            'justin_rows': self.justin_rows,
+        })
         self.files.check_errors(final = True)
 
+    def restore(self) -> bool:
+        """
+        Restore the validated files and RSE distances from a previous run, if possible.
+        This lets a job be re-scheduled with different site or grouping options offline.
+
+        :return: True if the state was restored
+        """
+        state = checkpoint.load('schedule')
+        if state is None or not self.restore_distances(state):
+            return False
+        self.source.files = state['files']
+        io_utils.log_print(f"Restored {len(self.files)} validated files from previous run")
+        return True
+
+    def restore_distances(self, state: dict) -> bool:
+        """
+        Restore the RSE-site distances from a checkpoint.
+
+        :param state: dictionary of saved objects
+        :return: True if the distances are usable by this scheduler
+        """
+        self.distances = state['distances']
+        self.justin_rows = state['justin_rows']
+        return True
+
     def assign_site(self, chunk: MergeChunk, site: str = None) -> None:
         """
         Assign a merging site for a chunk of files, and select the best replica for each file
@@ -178,21 +226,69 @@ class JobScheduler(ABC):
                 raise RuntimeError(f"File {file.did} has no good replicas for site {site}")
             file.replicas = [best_replica]
 
+    def footprint(self, files: list) -> float:
+        """
+        Estimate the disk space needed to merge a group of files, including local copies of the
+        inputs (unless they are streamed) and the estimated sizes of all the outputs.
+
+        :param files: List of MergeFile objects
+        :return: Estimated space in bytes
+        """
+        sizes = [file.size or 0 for file in files]
+        total = sum(output.size(sizes) for output in config.method.outputs)
+        if not config.input.streaming:
+            total += sum(sizes)
+        return total
+
+    def fits(self, files: list) -> bool:
+        """
+        Check whether a group of files can be merged as a single chunk.
+
+        :param files: List of MergeFile objects
+        :return: True if the group is within the chunk count and disk space limits
+        """
+        if len(files) > config.method.chunks.max_count:
+            return False
+        return self.footprint(files) <= config.method.chunks.max_size * 1024**3
+
     def split_files(self, files: list) -> list[list]:
         """
         Split a list of files into groups for merging, based on the configured chunk size.
+        Groups are kept within both the maximum file count and the disk space available for
+        merging, as estimated by footprint().  Files too large to fit on their own are put in
+        groups by themselves, and the rest are packed into as few groups as possible.
         
         :param files: List of MergeFile objects to split
         :return: List of lists of MergeFile objects, where each sublist is a group for merging
         """
         if not files:
             return []
-        chunk_max = config.method.chunks.max_count
-        if len(files) <= chunk_max:
+        if self.fits(files):
             return [files]
-        n_chunks = math.ceil(len(files) / chunk_max)
-        target_size = len(files) / n_chunks
-        return [files[int(i*target_size):int((i+1)*target_size)] for i in range(n_chunks)]
+        budget = config.method.chunks.max_size * 1024**3
+        oversized = [file for file in files if not self.fits([file])]
+        io_utils.log_nonzero(f"Found {{n}} input file{{s}} too large for the {budget/1024**3:.1f} GB "
+                             "available for merging", len(oversized), logging.WARNING)
+        if oversized:
+            skip = set(map(id, oversized))
+            files = [file for file in files if id(file) not in skip]
+        # Pack the remaining files greedily to find how many groups are needed
+        groups = []
+        group = []
+        for file in files:
+            if group and not self.fits(group + [file]):
+                groups.append(group)
+                group = []
+            group.append(file)
+        if group:
+            groups.append(group)
+        # Prefer groups of even size if they also fit
+        n_chunks = len(groups)
+        target_size = len(files) / max(n_chunks, 1)
+        even = [files[int(i*target_size):int((i+1)*target_size)] for i in range(n_chunks)]
+        if all(self.fits(group) for group in even):
+            groups = even
+        return groups + [[file] for file in oversized]
 
     @abstractmethod
     def schedule(self, chunk: MergeChunk) -> None:
@@ -223,7 +319,7 @@ class JobScheduler(ABC):
         for spec in chunk.specs:
             name = os.path.join(self.dir, f"{prefix}_{len(site_jobs)+1:>06}.json")
             with open(name, 'w', encoding="utf-8") as fjson:
-                fjson.write(json.dumps(spec, indent=2))
+                fjson.write(json.dumps(spec, separators=(',', ':')))
             site_jobs.append((name, chunk))
 
     @abstractmethod
@@ -240,8 +336,15 @@ class JobScheduler(ABC):
         
         :return: None
         """
-        self.run_loop()
+        if self.restore():
+            self.check_reachable(self.files.good_files)
+            self.files.check_errors(final = True)
+        else:
+            self.run_loop()
         os.makedirs(self.dir, exist_ok=True)
+        # Remove specs from any previous scheduling of this job
+        for old_spec in glob.glob(os.path.join(self.dir, "pass*.json")):
+            os.remove(old_spec)
 
         for chunk in self.files.groups():
             self.schedule(chunk)
@@ -284,7 +387,8 @@ class LocalScheduler(JobScheduler):
         # If we have a local site name, try to get distances from JustIN
         if config.local.site:
             local_site = str(config.local.site)
-            justin_dists = await justin_utils.get_site_rse_distances()
+            self.justin_rows = await justin_utils.get_site_rse_rows()
+            justin_dists = justin_utils.site_rse_distances(self.justin_rows)
             if justin_dists:
                 self.justin = True
             for rse, dists in justin_dists.items():
@@ -305,11 +409,24 @@ class LocalScheduler(JobScheduler):
             if self.justin:
                 distances[None] = float('inf')
             elif isinstance(replica.rse, RucioRSE):
-                distances[None] = replica.rse.ping()
+                distances[None] = await replica.rse.ping(self.source.latency)
             else:
                 distances[None] = 0
         return distances
 
+    def restore_distances(self, state: dict) -> bool:
+        """
+        Restore the RSE distances from a checkpoint, if they were saved by a local job.
+
+        :param state: dictionary of saved objects
+        :return: True if the distances are usable by this scheduler
+        """
+        if any(None not in dists for dists in state['distances'].values()):
+            logger.info("Previous run was scheduled for JustIN, repeating validation")
+            return False
+        self.justin = bool(state['justin_rows'])
+        return super().restore_distances(state)
+
     def schedule(self, chunk: MergeChunk) -> None:
         """
         Schedule a chunk for merging, clearing any site assignment and subdividing as necessary.
@@ -318,8 +435,8 @@ class LocalScheduler(JobScheduler):
         """
         # Just set site to None for local jobs
         self.assign_site(chunk, site=None)
-        # Split into subchunks if there are too many files
-        if len(chunk.files) > config.method.chunks.max_count:
+        # Split into subchunks if there are too many files or they need too much space
+        if not self.fits(chunk.files):
             for subchunk in self.split_files(chunk.files):
                 chunk.make_child(subchunk)
 
@@ -347,6 +464,11 @@ class LocalScheduler(JobScheduler):
         with open(script_name, 'w', encoding="utf-8") as f:
             f.write("#!/bin/bash\n")
             f.write("# This script will run the merge jobs locally\n")
+            if config.validation.checksum_cache.enabled:
+                # Share checksums of the merged files with later passes and jobs
+                naming.Formatter().format(config.validation.checksum_cache.path)
+                cache_path = shlex.quote(str(config.validation.checksum_cache.path))
+                f.write(f"export MERGE_CHECKSUM_CACHE={cache_path}\n")
             for tier, jobs in enumerate(self.jobs):
                 if len(self.jobs) == 1:
                     f.write("echo 'Creating merged files'\n")
@@ -381,11 +503,29 @@ class JustinScheduler(JobScheduler):
         # Connect to source
         await self.source.connect()
         # Get site-rse distances from JustIN
-        self.distances = await justin_utils.get_site_rse_distances()
+        self.justin_rows = await justin_utils.get_site_rse_rows()
+        self.distances = justin_utils.site_rse_distances(self.justin_rows)
         if not self.distances:
             logger.critical("Cannot run batch jobs without JustIN connection!")
             sys.exit(1)
 
+    def restore_distances(self, state: dict) -> bool:
+        """
+        Recompute the RSE-site distances from the saved JustIN table, so that changes to the
+        site options take effect without contacting JustIN again.
+
+        :param state: dictionary of saved objects
+        :return: True if the distances are usable by this scheduler
+        """
+        self.justin_rows = state['justin_rows']
+        if not self.justin_rows:
+            logger.info("Previous run has no JustIN site distances, repeating validation")
+            return False
+        self.distances = justin_utils.site_rse_distances(self.justin_rows)
+        for rse in state['distances']:
+            self.distances.setdefault(rse, {None: float('inf')})
+        return True
+
     def schedule(self, chunk: MergeChunk) -> None:
         """
         Schedule a chunk for merging, subdividing and assigning to sites as necessary.
@@ -393,7 +533,7 @@ class JustinScheduler(JobScheduler):
         :param chunk: MergeChunk object to schedule
         """
         # Try to do merge as one chunk if possible
-        if len(chunk.files) < config.method.chunks.max_count:
+        if len(chunk.files) < config.method.chunks.max_count and self.fits(chunk.files):
             site, dist = sorted(self.chunk_distances(chunk).items(), key=lambda x: x[1])[0]
             if dist < float('inf'):
                 self.assign_site(chunk, site=site)
@@ -408,8 +548,8 @@ class JustinScheduler(JobScheduler):
         # If all files are at the same site, just assign the chunk there and split if needed
         if len(best_sites) == 1:
             self.assign_site(chunk, site=best_sites[0][0])
-            # Split into subchunks if there are too many files
-            if len(chunk.files) > config.method.chunks.max_count:
+            # Split into subchunks if there are too many files or they need too much space
+            if not self.fits(chunk.files):
                 for subchunk in self.split_files(chunk.files):
                     chunk.make_child(subchunk)
             return
@@ -460,6 +600,12 @@ class JustinScheduler(JobScheduler):
         cfg_base = os.path.join(str(config.job.dir), "config.tar")
         with tarfile.open(cfg_base,"w") as tar:
             add_file(tar, io_utils.find_runner("do_merge.py"))
+            # The runners import these helpers directly on the worker nodes, where merge_utils
+            # is not installed, so they must only depend on the standard library
+            add_file(tar, checksum.__file__)
+            add_file(tar, parallel_gzip.__file__)
+            add_file(tar, tar_index.__file__)
+            add_file(tar, prefetch.__file__)
             for dep in config.method.dependencies:
                 add_file(tar, dep)
 
@@ -0,0 +1,123 @@
+"""
+Member index for merged tarballs, so single members can be listed and extracted without
+decompressing the whole archive.
+
+The archive is written through parallel_gzip.GzipWriter with a new gzip member started at every
+tar entry, and the index records where each entry's gzip member starts in the compressed file.
+Extracting an entry only decompresses from that point to the end of the entry's data.
+"""
+
+from __future__ import annotations
+import os
+import zlib
+import gzip
+import json
+import bisect
+import tarfile
+
+INDEX = '.index.json'  # Suffix for the index file written next to an archive
+VERSION = 1
+
+class HashingReader:
+    """Wrap a file object to calculate the Adler-32 checksum of everything read from it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.value = 1
+
+    def read(self, size: int = -1) -> bytes:
+        """Read data from the file, updating the checksum"""
+        data = self.fileobj.read(size)
+        self.value = zlib.adler32(data, self.value)
+        return data
+
+class IndexedTarFile(tarfile.TarFile):
+    """
+    TarFile that writes to a parallel_gzip.GzipWriter, starting a new gzip member at every entry
+    and recording where each entry starts and ends in the uncompressed stream.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.entries = []  # (name, header offset, data offset, size, adler32)
+
+    def addfile(self, tarinfo, fileobj=None) -> None:
+        """Add an entry to the archive, starting a new gzip member for it"""
+        self.fileobj.end_member()
+        start = self.offset
+        reader = HashingReader(fileobj) if fileobj is not None else None
+        super().addfile(tarinfo, reader)
+        size = tarinfo.size if reader is not None else 0
+        blocks = -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        value = reader.value if reader is not None else 1
+        self.entries.append((tarinfo.name, start, self.offset - blocks, size, f"{value:08x}"))
+
+def write_index(path: str, entries: list, members: list) -> None:
+    """
+    Write the member index for a finished archive.
+
+    :param path: Path to the archive
+    :param entries: IndexedTarFile.entries
+    :param members: GzipWriter.members
+    """
+    starts = [member[0] for member in members]
+    index = {}
+    for name, start, data, size, value in entries:
+        first = members[bisect.bisect_right(starts, start) - 1]
+        last = members[bisect.bisect_right(starts, max(data + size - 1, start)) - 1]
+        index[name] = {
+            'offset': first[2],  # Compressed offset of the gzip member the entry starts in
+            'length': last[2] + last[3] - first[2],  # Compressed bytes to read for the entry
+            'skip': data - first[0],  # Uncompressed bytes before the data in that member
+            'size': size,
+            'adler32': value,
+        }
+    stat = os.stat(path)
+    tmp_name = f"{path}{INDEX}.tmp"
+    with open(tmp_name, 'w', encoding="utf-8") as f:
+        json.dump({'version': VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                   'members': index}, f)
+    os.replace(tmp_name, path + INDEX)
+
+def read_index(path: str) -> dict | None:
+    """
+    Read the member index for an archive, if it exists and the archive hasn't changed since.
+
+    :param path: Path to the archive
+    :return: Dictionary of {member name: location}, or None if there is no usable index
+    """
+    try:
+        with open(path + INDEX, encoding="utf-8") as f:
+            index = json.load(f)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != VERSION or index.get('size') != stat.st_size or \
+            index.get('mtime_ns') != stat.st_mtime_ns:
+        return None
+    return index['members']
+
+def extract(path: str, name: str, index: dict = None) -> bytes:
+    """
+    Extract a single member from an indexed archive, only decompressing the blocks it spans.
+
+    :param path: Path to the archive
+    :param name: Name of the member
+    :param index: Member index from read_index (default: read it now)
+    :return: Contents of the member
+    :raises KeyError: If the member is not in the index
+    :raises ValueError: If there is no usable index, or the member fails its checksum
+    """
+    if index is None:
+        index = read_index(path)
+        if index is None:
+            raise ValueError(f"No up-to-date index for {path}")
+    entry = index[name]
+    with open(path, 'rb') as f:
+        f.seek(entry['offset'])
+        with gzip.GzipFile(fileobj=f, mode='rb') as member:
+            member.seek(entry['skip'])
+            data = member.read(entry['size'])
+    if len(data) != entry['size'] or f"{zlib.adler32(data):08x}" != entry['adler32']:
+        raise ValueError(f"Member {name} of {path} does not match its index entry")
+    return data
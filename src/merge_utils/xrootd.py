@@ -0,0 +1,246 @@
+"""Backends for probing the status of remote file replicas over xrootd"""
+
+from __future__ import annotations
+import os
+import re
+import logging
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable
+
+from merge_utils import config
+
+logger = logging.getLogger(__name__)
+
+# Return codes used by xrdfs, plus one for commands that timed out
+TIMEOUT = -1
+OK = 0
+NO_SERVER = 51
+AUTH_FAILED = 52
+NOT_FOUND = 54
+
+DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+def split_url(url: str) -> tuple[str, str]:
+    """
+    Split an xrootd URL into the server and the path on that server.
+
+    :param url: URL of the form 'root://host:port/path'
+    :return: server URL ('root://host:port') and absolute path
+    """
+    protocol, rest = url.split('://', 1)
+    host, _, path = rest.partition('/')
+    return f"{protocol}://{host}", '/' + path.lstrip('/')
+
+class ProbeResult:
+    """Result of probing a remote file"""
+    __slots__ = ('code', 'message', 'size', 'readable', 'checksums', 'locality')
+
+    def __init__(self, code: int = OK, message: str = "", size: int = None,
+                 readable: bool = True, checksums: dict = None, locality: str = None):
+        self.code = code
+        self.message = message
+        self.size = size
+        self.readable = readable
+        self.checksums = checksums
+        self.locality = locality
+
+    def __bool__(self) -> bool:
+        """Return True if the probe succeeded"""
+        return self.code == OK
+
+    def __repr__(self) -> str:
+        return (f"ProbeResult(code={self.code}, size={self.size}, readable={self.readable}, "
+                f"checksums={self.checksums}, locality={self.locality})")
+
+def parse_listing(line: str) -> tuple[str, int, bool] | None:
+    """
+    Parse a line of 'xrdfs ls -l' output.
+    Depending on the xrootd version, the size comes either before or after the date and time,
+    and the owner and group may also be listed.
+
+    :param line: line of output
+    :return: path, size and whether the file is readable, or None if the line can't be parsed
+    """
+    fields = line.split()
+    if len(fields) < 5:
+        return None
+    perms, path = fields[0], fields[-1]
+    for idx, field in enumerate(fields[1:-1], start=1):
+        if not DATE.match(field):
+            continue
+        if fields[idx-1].isdigit() and idx > 1:
+            size = fields[idx-1]
+        elif idx + 2 < len(fields) - 1:
+            size = fields[idx+2]
+        else:
+            return None
+        if not size.isdigit():
+            return None
+        # Permissions are either 'dr-x' style flags or 'drwxr-xr-x' style modes
+        return path, int(size), len(perms) > 1 and perms[1] == 'r'
+    return None
+
+async def run_command(cmd: list[str], timeout: float) -> tuple[int, str, str]:
+    """
+    Run a command without blocking the event loop.
+
+    :param cmd: command and arguments
+    :param timeout: time limit in seconds
+    :return: return code (or TIMEOUT), stdout, and stderr
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as err:
+        return NO_SERVER, "", str(err)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return TIMEOUT, "", f"Timed out after {timeout} s"
+    return proc.returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace')
+
+class XRootDProbe(ABC):
+    """Base class for probing the size, checksums, and locality of remote files"""
+
+    @abstractmethod
+    async def stat(self, url: str) -> ProbeResult:
+        """
+        Get the size of a remote file and check that it is readable.
+
+        :param url: xrootd URL of the file
+        :return: ProbeResult with the size and readable fields set
+        """
+
+    @abstractmethod
+    async def checksums(self, url: str) -> ProbeResult:
+        """
+        Get the checksums of a remote file.
+
+        :param url: xrootd URL of the file
+        :return: ProbeResult with a dictionary of {algorithm: checksum} pairs
+        """
+
+    @abstractmethod
+    async def locality(self, url: str) -> ProbeResult:
+        """
+        Check whether a remote file is online or nearline.
+
+        :param url: xrootd URL of the file
+        :return: ProbeResult with the locality (e.g. 'ONLINE', 'NEARLINE') set
+        """
+
+class CommandProbe(XRootDProbe):
+    """
+    Probe remote files with the xrdfs and gfal-xattr commands.
+
+    Commands run as asynchronous subprocesses, with a limit on how many run at once for each
+    server.  File sizes are found by listing the whole directory the first time a file in it is
+    checked, so checking many files in the same directory costs a single request.
+    """
+
+    def __init__(self, runner: Callable[[list, float], Awaitable[tuple]] = None,
+                 connections: int = None, timeout: float = None, listings: bool = None):
+        """
+        Initialize the probe, using the validation.xrootd config for any unset options.
+
+        :param runner: coroutine function that runs a command (default run_command)
+        :param connections: maximum number of commands to run at once for each server
+        :param timeout: time limit for each command in seconds
+        :param listings: whether to stat files by listing their directories
+        """
+        cfg = config.validation.xrootd
+        self.runner = runner or run_command
+        self.connections = max(1, int(connections or cfg.connections))
+        self.timeout = float(timeout or cfg.timeout)
+        self.listings = bool(cfg.listings) if listings is None else listings
+        self.limits = {}
+        self.dirs = {}
+
+    async def run(self, server: str, cmd: list[str]) -> tuple[int, str, str]:
+        """
+        Run a command for a server, waiting if too many are already running.
+
+        :param server: server URL, used to limit the number of concurrent commands
+        :param cmd: command and arguments
+        :return: return code, stdout, and stderr
+        """
+        limit = self.limits.get(server)
+        if limit is None:
+            limit = self.limits[server] = asyncio.Semaphore(self.connections)
+        async with limit:
+            return await self.runner(cmd, self.timeout)
+
+    async def list_dir(self, server: str, path: str) -> dict | None:
+        """
+        List a remote directory.
+
+        :param server: server URL
+        :param path: directory path
+        :return: dictionary of {name: (size, readable)}, or None if the listing failed
+        """
+        code, out, err = await self.run(server, ['xrdfs', server, 'ls', '-l', path])
+        if code != OK:
+            logger.debug("Failed to list %s%s, checking files one at a time\n  %s",
+                         server, path, err.strip())
+            return None
+        listing = {}
+        for line in out.splitlines():
+            entry = parse_listing(line)
+            if entry is not None:
+                listing[os.path.basename(entry[0])] = entry[1:]
+        logger.debug("Listed %d files in %s%s", len(listing), server, path)
+        return listing
+
+    async def stat(self, url: str) -> ProbeResult:
+        server, path = split_url(url)
+        if self.listings:
+            directory, name = os.path.split(path)
+            key = (server, directory)
+            task = self.dirs.get(key)
+            if task is None:
+                task = self.dirs[key] = asyncio.ensure_future(self.list_dir(server, directory))
+            listing = await task
+            if listing is not None:
+                if name not in listing:
+                    return ProbeResult(NOT_FOUND, f"No such file {url}")
+                size, readable = listing[name]
+                return ProbeResult(size=size, readable=readable)
+        code, out, err = await self.run(server, ['xrdfs', server, 'ls', '-l', path])
+        if code != OK:
+            return ProbeResult(code, err.strip())
+        entry = parse_listing(out.strip())
+        if entry is None:
+            return ProbeResult(NO_SERVER, f"Could not parse listing: {out.strip()}")
+        return ProbeResult(size=entry[1], readable=entry[2])
+
+    async def checksums(self, url: str) -> ProbeResult:
+        server, path = split_url(url)
+        code, out, err = await self.run(server, ['xrdfs', server, 'query', 'checksum', path])
+        if code != OK:
+            return ProbeResult(code, err.strip())
+        cksums = {}
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                cksums[fields[0]] = fields[1]
+        return ProbeResult(checksums=cksums)
+
+    async def locality(self, url: str) -> ProbeResult:
+        server, _ = split_url(url)
+        timeout = max(1, int(self.timeout) - 1)
+        code, out, err = await self.run(
+            server, ['gfal-xattr', '-t', str(timeout), url, 'user.status'])
+        if code != OK:
+            return ProbeResult(code, err.strip())
+        return ProbeResult(locality=out.strip())
+
+def get() -> XRootDProbe:
+    """
+    Create an xrootd probe based on the configuration.
+
+    :return: XRootDProbe object
+    """
+    return CommandProbe()
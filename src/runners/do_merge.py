@@ -7,19 +7,32 @@ import copy
 import subprocess
 import shutil
 import socket
+import time
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 import tarfile
-import zlib
 import h5py #type: ignore pylint: disable=import-error
 import ROOT #type: ignore pylint: disable=import-error
 
-def checksums(filename: str, chunk_size=8192) -> dict:
-    """Calculate the Adler-32 checksum of a file, working in chunks"""
-    checksum = 1  # Adler-32 state must be initialized to 1 (not 0)
-    with open(filename, "rb") as f:
-        while chunk := f.read(chunk_size):
-            checksum = zlib.adler32(chunk, checksum)
-    return {'adler32': "%08x" % checksum}
+try:
+    # Batch jobs get copies of the merge_utils helper modules next to the runner scripts
+    # pylint: disable=import-error,multiple-imports
+    import checksum, tar_index #type: ignore
+except ImportError:
+    from merge_utils import checksum, tar_index
+
+CHECKSUMS = ['adler32']
+
+def checksums(filename: str) -> dict:
+    """Calculate the checksums of a file in a single pass"""
+    return checksum.file_checksums(filename, CHECKSUMS)
+
+def get_hasher() -> checksum.Hasher:
+    """Create a checksum Hasher, using the host checksum cache if the job was given one"""
+    path = os.environ.get('MERGE_CHECKSUM_CACHE')
+    return checksum.Hasher(cache=checksum.ChecksumCache(path) if path else None)
 
 def list_root(folder, base="") -> list:
     """
@@ -65,6 +78,9 @@ def check_exists(path: str, rename: str = None) -> bool:
     if rename is not None:
         if os.path.isfile(rename):
             shutil.move(rename, path)
+            for suffix in [checksum.SIDECAR, tar_index.INDEX]:
+                if os.path.isfile(rename + suffix):
+                    shutil.move(rename + suffix, path + suffix)
         else:
             print(f"ERROR: Expected output file {rename} not found!")
             return False
@@ -103,8 +119,14 @@ def check_contents(path: str, checklist: str = None) -> bool:
             with h5py.File(path, 'r') as hdf5_file:
                 contents = list_hdf5(hdf5_file)
         elif ext in ['.tar', '.gz']:
-            with tarfile.open(path, 'r') as tar_file:
-                contents = tar_file.getnames()
+            # Use the member index written with the archive instead of decompressing it
+            index = tar_index.read_index(path)
+            if index is not None:
+                print(f"Checking contents of {name} against its member index")
+                contents = list(index)
+            else:
+                with tarfile.open(path, 'r') as tar_file:
+                    contents = tar_file.getnames()
         else:
             print(f"WARNING: Output file {name} has unknown type {ext}, skipping content check")
             return True
@@ -148,48 +170,182 @@ def renew_token():
     else:
         print ("WARNING: Token renewal failed, skip for now")
 
-def local_copy(inputs: list[str], outdir: str) -> list[str]:
-    """Make a local copy of the input files"""
-    tmp_files = []
+def source_host(path: str) -> str:
+    """Get the host an input file is copied from"""
+    if '://' not in path:
+        return ''
+    return path.split('/', 3)[2]
+
+def stage_file(path: str, local_path: str, rate: str = None) -> bool:
+    """
+    Copy an input file with xrdcp, resuming and verifying an existing copy if there is one.
+
+    :param path: URL of the input file
+    :param local_path: path for the local copy
+    :param rate: optional xrdcp transfer rate limit, eg. '10m'
+    :return: True if the local copy is good
+    """
+    basename = os.path.basename(path)
+    cmd = ['xrdcp', '--nopbar', path, local_path, '-C', 'adler32']
+    if rate:
+        cmd += ['--xrate', rate]
+    if os.path.exists(local_path):
+        print(f"  Checking {basename} (local copy already exists)")
+        ret = subprocess.run(cmd + ['--continue'], check=False)
+        if ret.returncode == 0:
+            return True
+        print(f"  Replacing {basename} (existing local copy is corrupted)")
+        os.remove(local_path)
+    else:
+        print(f"  Copying {basename}")
+    ret = subprocess.run(cmd, check=False)
+    if ret.returncode != 0:
+        print(f"ERROR: Local copy of {basename} failed with return code {ret.returncode}")
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        return False
+    return True
+
+def plan_staging(jobs: list[tuple], tmp_dir: str, staging: dict) -> list[tuple]:
+    """
+    Choose which inputs to copy, keeping the local copies and the outputs within the free
+    space on the local disk and the job's disk budget.  Inputs that don't fit are streamed.
+
+    :param jobs: list of (input index, path, local path) tuples for the remote inputs
+    :param tmp_dir: directory for the local copies
+    :param staging: staging settings, with the input sizes, output size, and budget in bytes
+    :return: list of the jobs to copy
+    """
+    sizes = staging.get('sizes') or []
+    if not sizes or max(idx for idx, _, _ in jobs) >= len(sizes):
+        print("WARNING: Input sizes unknown, copying all inputs")
+        return jobs
+    space = shutil.disk_usage(tmp_dir).free
+    budget = staging.get('budget')
+    if budget:
+        space = min(space, budget)
+    space -= staging.get('output_size') or 0
+    selected = []
+    needed = 0
+    for job in jobs:
+        idx, _, local_path = job
+        size = sizes[idx] or 0
+        # Existing partial copies already take up some of the space
+        if os.path.exists(local_path):
+            size -= os.path.getsize(local_path)
+        if needed + size <= space:
+            selected.append(job)
+            needed += size
+    if len(selected) < len(jobs):
+        print(f"WARNING: Only {len(selected)} of {len(jobs)} inputs fit in the "
+              f"{max(space, 0)/1024**3:.1f} GB available, streaming the rest")
+    return selected
+
+def local_copy(inputs: list[str], outdir: str, staging: dict = None) -> list[str]:
+    """
+    Make a local copy of the input files, several at a time.
+
+    :param inputs: list of input paths, remote entries are replaced by their local copies
+    :param outdir: output directory, copies are made in its tmp subdirectory
+    :param staging: settings for the number of copies at once, bandwidth cap, and disk budget
+    :return: list of local copies to delete after merging
+    """
+    staging = staging or {}
+    parallel = max(1, int(staging.get('parallel') or 1))
+    per_host = max(1, int(staging.get('per_host') or parallel))
+    rate = None
+    if staging.get('bandwidth'):
+        # Split the bandwidth cap between the copies running at once
+        rate = f"{max(1, int(float(staging['bandwidth']) * 1000 / parallel))}k"
     tmp_dir = os.path.join(outdir, "tmp")
     print(f"Making local copy of input files in {tmp_dir}:")
+    jobs = []
     for i, path in enumerate(inputs):
         basename = os.path.basename(path)
         if os.path.exists(os.path.expanduser(os.path.expandvars(path))):
             print(f"  Skipping {basename} (file already local)")
             continue
+        jobs.append((i, path, os.path.join(tmp_dir, basename)))
+    if jobs:
+        os.makedirs(tmp_dir, exist_ok=True)
+        jobs = plan_staging(jobs, tmp_dir, staging)
+    if not jobs:
+        print("Copied 0 files")
+        return []
 
-        local_path = os.path.join(tmp_dir, basename)
-        cmd = ['xrdcp', path, local_path, '-C', 'adler32']
-        exists = os.path.exists(local_path)
-        if exists:
-            print(f"  Checking {basename} (local copy already exists)")
-            ret = subprocess.run(cmd + ['--continue'], check=False)
-            if ret.returncode != 0:
-                print(f"  Replacing {basename} (existing local copy is corrupted)")
-                os.remove(local_path)
-                exists = False
-        else:
-            print(f"  Copying {basename}")
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    # Interleave the sources so the pool isn't stuck waiting on one busy host
+    by_host = {}
+    for job in jobs:
+        by_host.setdefault(source_host(job[1]), []).append(job)
+    order = [job for group in itertools.zip_longest(*by_host.values()) for job in group if job]
+    host_limits = {host: threading.Semaphore(per_host) for host in by_host}
+    failed = threading.Event()
+    lock = threading.Lock()
+    progress = {'files': 0, 'bytes': 0}
+    start = time.perf_counter()
+
+    def copy(job: tuple) -> bool:
+        _, path, local_path = job
+        with host_limits[source_host(path)]:
+            # Don't start new copies once one has failed
+            if failed.is_set():
+                return False
+            file_start = time.perf_counter()
+            if not stage_file(path, local_path, rate):
+                failed.set()
+                return False
+            size = os.path.getsize(local_path)
+        elapsed = time.perf_counter() - file_start
+        with lock:
+            progress['files'] += 1
+            progress['bytes'] += size
+            print(f"  [{progress['files']}/{len(jobs)}] {os.path.basename(local_path)}: "
+                  f"{size/1e6:.1f} MB in {elapsed:.1f} s")
+        return True
 
-        if not exists:
-            ret = subprocess.run(cmd, check=False)
-            if ret.returncode != 0:
-                print(f"ERROR: Local copy of {basename} failed with return code {ret.returncode}")
-                os.remove(local_path)
-                sys.exit(1)
+    with ThreadPoolExecutor(min(parallel, len(jobs))) as pool:
+        results = list(pool.map(copy, order))
+    elapsed = time.perf_counter() - start
+    if not all(results):
+        # Leave the good copies in place so a retry can resume them
+        sys.exit(1)
 
+    tmp_files = []
+    for i, _, local_path in jobs:
         tmp_files.append(local_path)
         inputs[i] = local_path
-
-    print(f"Copied {len(tmp_files)} files")
+    rate_mb = progress['bytes'] / 1e6 / elapsed if elapsed > 0 else 0.0
+    print(f"Copied {len(tmp_files)} files ({progress['bytes']/1e6:.1f} MB) in {elapsed:.1f} s, "
+          f"{rate_mb:.1f} MB/s")
     return tmp_files
 
+def set_prefetch(tmp_dir: str, staging: dict, tmp_files: list[str]) -> None:
+    """
+    Tell the merging script how many streamed inputs to fetch ahead, and how much disk space
+    it can use for them, leaving room for the outputs and any inputs that were already copied.
+
+    :param tmp_dir: directory for temporary files
+    :param staging: staging settings, with the output size and budget in bytes
+    :param tmp_files: local copies of inputs that were already made
+    """
+    if 'prefetch' in staging:
+        os.environ['MERGE_PREFETCH'] = str(staging['prefetch'])
+    os.makedirs(tmp_dir, exist_ok=True)
+    space = shutil.disk_usage(tmp_dir).free
+    budget = staging.get('budget')
+    if budget:
+        space = min(space, budget - sum(os.path.getsize(f) for f in tmp_files))
+    space -= staging.get('output_size') or 0
+    if space <= 0:
+        print("WARNING: No disk space left for prefetching streamed inputs")
+        os.environ['MERGE_PREFETCH'] = '0'
+    os.environ['MERGE_PREFETCH_BYTES'] = str(max(space, 0))
+
 def get_settings(config: dict, script_dir: str) -> dict:
     """Get the merging settings from the config"""
     settings = config.pop('settings', {})
     settings.setdefault('streaming', False)
+    settings.setdefault('staging', {})
     # Merge method settings
     if 'cfg' in settings:
         settings['cfg'] = os.path.join(script_dir, settings['cfg'])
@@ -246,6 +402,7 @@ def get_outputs(config: dict, script_dir: str, out_dir: str) -> list[dict]:
 def write_metadata(outputs: list[dict], out_dir: str, config: dict) -> None:
     """Write file metadata to JSON files"""
     valid = True
+    checked = []
     for output in outputs:
         name = output['name']
         print(f"Processing output file {name}")
@@ -264,12 +421,28 @@ def write_metadata(outputs: list[dict], out_dir: str, config: dict) -> None:
         if not check_contents(path, output.get('checklist')):
             valid = False
             continue
+        checked.append((output, path, size))
+    # Use checksums calculated while the outputs were written, and calculate the rest at once
+    hasher = get_hasher()
+    cksums = {}
+    for _, path, _ in checked:
+        sums = checksum.read_sidecar(path, CHECKSUMS)
+        if sums is None:
+            continue
+        print(f"Using checksums recorded while writing {os.path.basename(path)}")
+        cksums[path] = sums
+        if hasher.cache is not None:
+            hasher.cache.store(os.stat(path), sums)
+        os.remove(path + checksum.SIDECAR)
+    cksums.update(hasher.map([path for _, path, _ in checked if path not in cksums], CHECKSUMS))
+    hasher.close()
+    for output, path, size in checked:
         # Apply per-file metadata overrides
         metadata = copy.deepcopy(config)
         metadata['metadata'].update(output.get('metadata', {}))
-        metadata['name'] = name
+        metadata['name'] = output['name']
         metadata['size'] = size
-        metadata['checksums'] = checksums(path)
+        metadata['checksums'] = cksums[path]
         # Write metadata to JSON file
         with open(path+'.json', 'w', encoding="utf-8") as fjson:
             fjson.write(json.dumps(metadata, indent=2))
@@ -287,8 +460,16 @@ def merge(config: dict, script_dir: str, out_dir: str) -> None:
 
     # Make local copies of the input files if not streaming
     tmp_files = []
+    tmp_dir = os.path.abspath(os.path.join(out_dir, "tmp"))
     if not settings['streaming']:
-        tmp_files = local_copy(inputs, out_dir)
+        tmp_files = local_copy(inputs, out_dir, settings['staging'])
+        # Stream any inputs that didn't fit on the local disk
+        if any('://' in path for path in inputs):
+            settings['streaming'] = True
+    # Let the merging script know which inputs are temporary copies
+    os.environ['MERGE_TMP_DIR'] = tmp_dir
+    if settings['streaming']:
+        set_prefetch(tmp_dir, settings['staging'], tmp_files)
 
     # Merge the input files based on the specified method
     out_paths = [os.path.join(out_dir, output['name']) for output in outputs]
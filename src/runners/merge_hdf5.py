@@ -5,11 +5,19 @@ import re
 import os
 import collections
 from datetime import datetime, timezone
+from typing import Iterable, Iterator
 import numpy
 import yaml
 import h5py
 
+try:
+    import prefetch #type: ignore pylint: disable=import-error
+except ImportError:
+    from merge_utils import prefetch
+
 cfg = {}
+_rules = {}
+_matches = {}
 divisions = {}
 cleanup = {}
 inconsistent = {}
@@ -121,6 +129,22 @@ ATTR_CLASSES = {
     'sum': AttrSum,
 }
 
+def compile_rules(cfg_dict: dict) -> list:
+    """
+    Compile the path patterns of a configuration section, so they are only parsed once.
+
+    :param cfg_dict: Dictionary containing configuration settings
+    :return: List of (compiled path patterns, key, value) tuples
+    """
+    rules = _rules.get(id(cfg_dict))
+    if rules is None:
+        rules = []
+        for key, value in cfg_dict.items():
+            key_arr = key.split('/')
+            rules.append((tuple(re.compile(k) for k in key_arr[:-1]), key_arr[-1], value))
+        _rules[id(cfg_dict)] = rules
+    return rules
+
 def get_cfg(cfg_dict: dict, path: str) -> dict:
     """
     Get configuration keys that match a given path
@@ -129,17 +153,19 @@ def get_cfg(cfg_dict: dict, path: str) -> dict:
     :param path: Path to the object in the HDF5 file
     :return: Dictionary with matching keys
     """
+    cache_key = (id(cfg_dict), path)
+    out = _matches.get(cache_key)
+    if out is not None:
+        return out
     out = {}
     path_arr = path.split('/')
     # Check if any keys match the path
-    for key, value in cfg_dict.items():
-        key_arr = key.split('/')
-        if key_arr[-1] in out:
+    for patterns, key, value in compile_rules(cfg_dict):
+        if key in out or len(patterns) != len(path_arr):
             continue
-        if len(key_arr) != len(path_arr) + 1:
-            continue
-        if all(re.fullmatch(k, p) for k, p in zip(key_arr[:-1], path_arr)):
-            out[key_arr[-1]] = value
+        if all(k.fullmatch(p) for k, p in zip(patterns, path_arr)):
+            out[key] = value
+    _matches[cache_key] = out
     return out
 
 def merge_attrs(path: str, attrs: list) -> dict:
@@ -209,23 +235,234 @@ def get_axis(dataset) -> int:
         axis = 0
     return axis
 
-def merge_dataset(fout: str, datasets: list) -> None:
+def same_filters(dset1, dset2) -> bool:
+    """
+    Check whether two datasets are stored with the same chunk shape and filter pipeline,
+    so their raw chunks can be copied without decompressing them.
+
+    :param dset1: First dataset
+    :param dset2: Second dataset
+    :return: True if the raw chunks are interchangeable
+    """
+    if dset1.chunks is None or dset1.chunks != dset2.chunks or dset1.dtype != dset2.dtype:
+        return False
+    plist1 = dset1.id.get_create_plist()
+    plist2 = dset2.id.get_create_plist()
+    if plist1.get_nfilters() != plist2.get_nfilters():
+        return False
+    for i in range(plist1.get_nfilters()):
+        # Compare the filter ID, flags, and parameters (but not the name)
+        if plist1.get_filter(i)[:3] != plist2.get_filter(i)[:3]:
+            return False
+    return True
+
+def copy_chunks(source, target, axis: int, start: int) -> bool:
+    """
+    Copy the stored chunks of a dataset into a larger dataset without decompressing them.
+    Only works if the datasets have the same filters and chunk shape, and the source starts
+    on a chunk boundary of the target.
+
+    :param source: Dataset to copy
+    :param target: Dataset to copy into
+    :param axis: Concatenation axis
+    :param start: Position of the source along the axis in the target
+    :return: True if the chunks were copied, False if the data must be copied normally
+    """
+    if start % target.chunks[axis] != 0 or not same_filters(source, target):
+        return False
+    dsid = source.id
+    try:
+        n_chunks = dsid.get_num_chunks()
+    except AttributeError:
+        # Chunk queries need h5py 3 and HDF5 1.10.5
+        return False
+    for idx in range(n_chunks):
+        offset = list(dsid.get_chunk_info(idx).chunk_offset)
+        filter_mask, data = dsid.read_direct_chunk(tuple(offset))
+        offset[axis] += start
+        target.id.write_direct_chunk(tuple(offset), data, filter_mask)
+    return True
+
+def copy_blocks(source, target, axis: int, start: int) -> None:
+    """
+    Copy a dataset into a larger dataset a block at a time, so the memory used is bounded
+    by the configured block size rather than the size of the dataset.
+    Blocks are aligned to the chunks of the source so each chunk is only decompressed once.
+
+    :param source: Dataset to copy
+    :param target: Dataset to copy into
+    :param axis: Concatenation axis
+    :param start: Position of the source along the axis in the target
+    """
+    length = source.shape[axis]
+    if length == 0:
+        return
+    row_bytes = source.dtype.itemsize * int(numpy.prod(source.shape)) // length
+    block_bytes = int(cfg.get('datasets', {}).get('block_size', 64) * 1024**2)
+    step = max(1, block_bytes // max(row_bytes, 1))
+    if source.chunks is not None:
+        chunk = source.chunks[axis]
+        step = max(chunk, step // chunk * chunk)
+    src_slice = [slice(None)] * len(source.shape)
+    dst_slice = [slice(None)] * len(source.shape)
+    for pos in range(0, length, step):
+        end = min(pos + step, length)
+        src_slice[axis] = slice(pos, end)
+        dst_slice[axis] = slice(start + pos, start + end)
+        target[tuple(dst_slice)] = source[tuple(src_slice)]
+
+class MergePlan:
+    """
+    Index of the objects in all the input files, with the layout of the merged datasets.
+
+    Each input file is traversed once to find every group and dataset, and the datasets that
+    will be concatenated are checked for consistent types, shapes, and axes up front, so any
+    problems are found before anything is written to the output file.
+    """
+
+    def __init__(self, fins: Iterable, virtual: bool = False):
+        """
+        Index and check the input files.  Each file is indexed as soon as it is produced, so the
+        files can be opened as they arrive.
+
+        :param fins: Iterable of open input files
+        :param virtual: Write virtual datasets that reference the inputs instead of copying them
+        :raises ValueError: If the files cannot be merged, listing every problem found
+        """
+        self.virtual = virtual
+        self.objects = {'/': []}   # {path: [matching objects from each file]}
+        self.children = {'/': []}  # {group path: [child paths, in the order first seen]}
+        self.layouts = {}          # {dataset path: (axis, divisions, merged shape)}
+        for fin in fins:
+            self.objects['/'].append(fin)
+            fin.visititems(self.add)
+        self.errors = []
+        self.check_modes()
+        for path, objs in self.objects.items():
+            self.check(path, objs)
+        if self.errors:
+            raise ValueError("Cannot merge input files:\n  " + "\n  ".join(self.errors))
+
+    def add(self, name: str, obj) -> None:
+        """Add an object to the index, used as a visititems callback"""
+        path = '/' + name
+        objs = self.objects.get(path)
+        if objs is None:
+            objs = self.objects[path] = []
+            self.children[path.rsplit('/', 1)[0] or '/'].append(path)
+        if isinstance(obj, h5py.Group):
+            # A dataset in another file at the same path is reported by check()
+            self.children.setdefault(path, [])
+        objs.append(obj)
+
+    def check_modes(self) -> None:
+        """Check that all the attribute merging modes are known"""
+        for key, value in cfg['attrs']['mode'].items():
+            if value not in ATTR_CLASSES:
+                self.errors.append(f"Unknown attribute mode: {value} for key {key}")
+
+    def check(self, path: str, objs: list) -> None:
+        """
+        Check that matching objects can be merged, and work out the merged dataset layout.
+
+        :param path: Path to the objects
+        :param objs: List of matching objects from each file
+        """
+        datasets = [obj for obj in objs if isinstance(obj, h5py.Dataset)]
+        if not datasets:
+            return
+        if len(datasets) != len(objs):
+            self.errors.append(f"'{path}' is a group in some files and a dataset in others")
+            return
+        first = datasets[0]
+        shape = first.shape
+        if len(datasets) == 1:
+            self.layouts[path] = (0, [0, shape[0]] if shape else [0], shape)
+            return
+        if not shape:
+            self.errors.append(f"Cannot concatenate scalar dataset '{path}'")
+            return
+        axis = get_axis(first)
+        divs = [0, shape[axis]]
+        for dataset in datasets[1:]:
+            if dataset.dtype != first.dtype:
+                self.errors.append(f"Inconsistent dtype for dataset '{path}': "
+                                   f"{first.dtype} vs {dataset.dtype}")
+                return
+            if len(dataset.shape) != len(shape) or any(
+                    s != shape[i] for i, s in enumerate(dataset.shape) if i != axis):
+                self.errors.append(f"Inconsistent shape for dataset '{path}': "
+                                   f"{shape} vs {dataset.shape}")
+                return
+            divs.append(divs[-1] + dataset.shape[axis])
+        merged = list(shape)
+        merged[axis] = divs[-1]
+        self.layouts[path] = (axis, divs, tuple(merged))
+
+def virtual_dataset(fout, datasets: list, name: str, axis: int, divs: list, shape: tuple):
+    """
+    Create a virtual dataset that maps the input datasets along the concatenation axis,
+    without copying any data.
+
+    :param fout: Output file handle
+    :param datasets: List of datasets to merge
+    :param name: Path of the dataset
+    :param axis: Concatenation axis
+    :param divs: Positions of the input datasets along the axis
+    :param shape: Shape of the merged dataset
+    :return: The new virtual dataset
+    """
+    layout = h5py.VirtualLayout(shape=shape, dtype=datasets[0].dtype)
+    index = [slice(None)] * len(shape)
+    for i, dataset in enumerate(datasets):
+        source = h5py.VirtualSource(os.path.abspath(dataset.file.filename), dataset.name,
+                                    shape=dataset.shape)
+        index[axis] = slice(divs[i], divs[i+1])
+        layout[tuple(index)] = source
+    return fout.create_virtual_dataset(name, layout)
+
+def can_reference(inputs: list) -> bool:
+    """
+    Check whether virtual datasets can reference the input files, which must be local files
+    that will still exist after the merge (not URLs or temporary copies made by do_merge).
+
+    :param inputs: List of input file paths
+    :return: True if the inputs can be referenced
+    """
+    tmp_dir = os.environ.get('MERGE_TMP_DIR')
+    for path in inputs:
+        if '://' in path:
+            print(f"Warning: Cannot reference remote input {path}, copying datasets instead")
+            return False
+        if tmp_dir and os.path.abspath(path).startswith(os.path.join(tmp_dir, '')):
+            print(f"Warning: Cannot reference temporary input {path}, copying datasets instead")
+            return False
+    return True
+
+def merge_dataset(fout: str, plan: MergePlan, name: str) -> None:
     """
     Merge a list of datasets into the output file.
+    The data is copied in bounded blocks, or as raw chunks if the storage layouts match.
     
     :param fout: Output file handle
-    :param datasets: List of datasets to merge
+    :param plan: MergePlan for the input files
+    :param name: Path of the dataset
     """
-    name = datasets[0].name
-    shape = datasets[0].shape
-    dtype = datasets[0].dtype
-    axis = get_axis(datasets[0])
+    datasets = plan.objects[name]
+    axis, divs, shape = plan.layouts[name]
 
     name_arr = name.split('/')
     dim_str = f" ({axis})" if axis else ""
-    print(f"{'. '*(len(name_arr)-2)}{name_arr[-1]}\t\tF={len(datasets)}, S={shape}{dim_str}, T={dtype}")
+    print(f"{'. '*(len(name_arr)-2)}{name_arr[-1]}\t\tF={len(datasets)}, "
+          f"S={datasets[0].shape}{dim_str}, T={datasets[0].dtype}")
     attrs = merge_attrs(name, [d.attrs for d in datasets])
 
+    if plan.virtual and datasets[0].shape:
+        new_dset = virtual_dataset(fout, datasets, name, axis, divs, shape)
+        new_dset.attrs.update(attrs)
+        divisions[name] = divs[1:]
+        return
+
     if len(datasets) == 1:
         # If only one dataset, just copy it
         fout.copy(datasets[0], name, without_attrs=True)
@@ -233,43 +470,32 @@ def merge_dataset(fout: str, datasets: list) -> None:
         new_dset.attrs.update(attrs)
         return
 
-    # Check shape and dtype consistency, and find divisions
-    divs = [0, shape[axis]]
-    for dataset in datasets[1:]:
-        if dataset.dtype != dtype:
-            raise ValueError(f"Inconsistent dtype for dataset '{name}': {dtype} vs {dataset.dtype}")
-        for i, s in enumerate(dataset.shape):
-            if i == axis:
-                divs.append(divs[-1] + s)
-            elif s != shape[i]:
-                raise ValueError(f"Inconsistent shape for dataset '{name}': {shape} vs {dataset.shape}")
-
     # Create new merged dataset
-    shape = list(shape)
-    shape[axis] = divs[-1]
-    shape = tuple(shape)
+    first = 0
     if datasets[0].maxshape[axis] is None or datasets[0].maxshape[axis] >= shape[axis]:
+        # Copy the first dataset natively, then extend it with the rest
         fout.copy(datasets[0], name, without_attrs=True)
         new_dset = fout[name]
         new_dset.resize(shape)
+        first = 1
     else:
         new_dset = fout.create_dataset_like(name, datasets[0], shape=shape)
     new_dset.attrs.update(attrs)
-    insert_slice = [slice(None)] * len(shape)
-    for i, dataset in enumerate(datasets):
-        insert_slice[axis] = slice(divs[i], divs[i+1])
-        new_dset[tuple(insert_slice)] = dataset[:]
+    for i, dataset in enumerate(datasets[first:], start=first):
+        if new_dset.chunks is None or not copy_chunks(dataset, new_dset, axis, divs[i]):
+            copy_blocks(dataset, new_dset, axis, divs[i])
 
     divisions[name] = divs[1:]
 
-def merge_group(fout: str, groups: list) -> None:
+def merge_group(fout: str, plan: MergePlan, name: str = '/') -> None:
     """
     Merge a list of groups into the output file.
     
     :param fout: Output file handle
-    :param groups: List of groups to merge
+    :param plan: MergePlan for the input files
+    :param name: Path of the group
     """
-    name = groups[0].name
+    groups = plan.objects[name]
     if name == '/':
         fout.attrs.update( merge_attrs('', [g.attrs for g in groups]) )
     else:
@@ -277,17 +503,24 @@ def merge_group(fout: str, groups: list) -> None:
         print(f"{'. '*(len(name_arr)-2)}{name_arr[-1]}\t\tF={len(groups)}")
         fout.create_group(name)
         fout[name].attrs.update( merge_attrs(name, [g.attrs for g in groups]) )
-    for i, group in enumerate(groups):
-        for val in group.values():
-            # Skip values we have already copied
-            if val.name in fout:
-                continue
-            # See if the same value appears in multiple files
-            vals = [val] + [f[val.name] for f in groups[i+1:] if val.name in f]
-            if isinstance(val, h5py.Group):
-                merge_group(fout, vals)
-            elif isinstance(val, h5py.Dataset):
-                merge_dataset(fout, vals)
+    for path in plan.children[name]:
+        if path in plan.children:
+            merge_group(fout, plan, path)
+        elif path in plan.layouts:
+            merge_dataset(fout, plan, path)
+
+def open_inputs(prefetcher: prefetch.Prefetcher, fins: list) -> Iterator[h5py.File]:
+    """
+    Open the input files as the prefetcher delivers them.
+
+    :param prefetcher: Prefetcher for the input files
+    :param fins: List to add each open file to, so the caller can close them
+    :return: Iterator of open input files
+    """
+    for _, local_file in prefetcher:
+        fin = h5py.File(local_file, 'r')
+        fins.append(fin)
+        yield fin
 
 def merge_hdf5(output: str, inputs: list, config: str) -> None:
     """Merge the input hdf5 files"""
@@ -297,16 +530,22 @@ def merge_hdf5(output: str, inputs: list, config: str) -> None:
     print(f"Oputput file: {output}")
     print(f"Input files: {inputs}")
     print(f"Configuration: {cfg}")
-    fout = h5py.File(output, 'w')
-
-    # Merge all the input files
-    # copy files locally
-    fins = [h5py.File(f, 'r') for f in inputs]
-    fout.attrs.update( merge_attrs('', [f.attrs for f in fins]) )
-    merge_group(fout, fins)
-    for f in fins:
-        f.close()
-        # remove the local copy
+    # All the inputs stay open during the merge, so any local copies are kept until the end
+    fins = []
+    with prefetch.Prefetcher(inputs, keep=True) as prefetcher:
+        try:
+            # Index and check each input while the next few are fetched, before writing anything
+            virtual = cfg['datasets'].get('virtual', False) and can_reference(inputs)
+            plan = MergePlan(open_inputs(prefetcher, fins), virtual)
+
+            # Written with the native HDF5 driver, do_merge checksums the finished file
+            fout = h5py.File(output, 'w')
+
+            # Merge all the input files
+            merge_group(fout, plan)
+        finally:
+            for f in fins:
+                f.close()
 
     # Warn about inconsistent attributes
     if inconsistent:
@@ -318,6 +557,7 @@ def merge_hdf5(output: str, inputs: list, config: str) -> None:
 
     # Set special attributes
     closing_time = datetime.now(timezone.utc)
+    fout.flush()
     special_vals = {
         'creation_time': str(int(creation_time.timestamp()*1000)),
         'closing_time': str(int(closing_time.timestamp()*1000)),
@@ -338,7 +578,47 @@ def merge_hdf5(output: str, inputs: list, config: str) -> None:
 
     fout.close()
 
+def materialize(path: str, output: str = None) -> None:
+    """
+    Turn the virtual datasets in a merged file into real datasets, copying the data from the
+    files they reference.  Other objects and all attributes are copied unchanged.
+
+    :param path: Merged file with virtual datasets
+    :param output: Name of the new file (default: replace the merged file)
+    """
+    if output is None:
+        output = path
+    tmp_name = f"{output}.tmp"
+    with h5py.File(path, 'r') as fin, h5py.File(tmp_name, 'w') as fout:
+        fout.attrs.update(fin.attrs)
+
+        def visit(name, obj):
+            if isinstance(obj, h5py.Group):
+                fout.create_group(name).attrs.update(obj.attrs)
+            elif isinstance(obj, h5py.Dataset) and obj.is_virtual:
+                # Use the storage layout and filters of the first source dataset
+                source = obj.virtual_sources()[0]
+                with h5py.File(source.file_name, 'r') as fsrc:
+                    template = fsrc[source.dset_name]
+                    maxshape = obj.shape if template.chunks is None else tuple(
+                        None if m is None else max(m, s)
+                        for m, s in zip(template.maxshape, obj.shape))
+                    new_dset = fout.create_dataset_like(name, template, shape=obj.shape,
+                                                        maxshape=maxshape)
+                print(f"Materializing {obj.name}\t\tS={obj.shape}, T={obj.dtype}")
+                copy_blocks(obj, new_dset, 0, 0)
+                new_dset.attrs.update(obj.attrs)
+            elif isinstance(obj, h5py.Dataset):
+                fout.copy(obj, name)
+
+        fin.visititems(visit)
+    os.replace(tmp_name, output)
+
 if __name__ == "__main__":
+    if sys.argv[1] == "--materialize":
+        # merge_hdf5.py --materialize <merged file> [new file]
+        materialize(*sys.argv[2:4])
+        sys.exit(0)
     cfg_file = sys.argv[1]
     output_file = sys.argv[2]
     input_files = sys.argv[3:]
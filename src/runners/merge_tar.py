@@ -3,19 +3,51 @@
 import os
 import sys
 import tarfile
+import yaml
+
+try:
+    # pylint: disable=import-error,multiple-imports
+    import checksum, parallel_gzip, tar_index, prefetch #type: ignore
+except ImportError:
+    from merge_utils import checksum, parallel_gzip, tar_index, prefetch
 
 TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
 
-def merge_tar(output: str, inputs: list[str]) -> None:
+def get_compression(config: str = None) -> dict:
+    """
+    Get the gzip compression settings from the merging config.
+
+    :param config: Path to the config file (default settings if None)
+    :return: Keyword arguments for parallel_gzip.GzipWriter
+    """
+    cfg = {}
+    if config:
+        with open(config, encoding="utf-8") as f:
+            cfg = (yaml.safe_load(f) or {}).get('compression', {})
+    return {
+        'level': int(cfg.get('level', parallel_gzip.LEVEL)),
+        'threads': int(cfg.get('threads', 0)) or None,
+        'block_size': int(float(cfg.get('block_size', 4)) * 1024**2),
+    }
+
+def merge_tar(output: str, inputs: list[str], config: str = None) -> None:
     """Merge the input files into a tar.gz archive"""
     added = set()
     error = False
-    with tarfile.open(output,"w:gz") as out_tar:
-        for file in inputs:
+    compression = get_compression(config)
+    print(f"Compressing at level {compression['level']} with "
+          f"{compression['threads'] or parallel_gzip.default_threads()} threads")
+    # Checksum the archive as it is written, so do_merge doesn't have to read it again
+    out_file = checksum.open_output(output)
+    # Fetch the next few inputs in the background while each one is added
+    with prefetch.Prefetcher(inputs) as prefetcher, out_file, \
+            parallel_gzip.GzipWriter(out_file, **compression) as out_gz, \
+            tar_index.IndexedTarFile(fileobj=out_gz, mode="w") as out_tar:
+        for file, local_file in prefetcher:
             name = os.path.basename(file)
             if name.endswith(TAR_EXTENSIONS):
                 print(f"Adding contents of tarball {name}:")
-                with tarfile.open(file, "r:*") as in_tar:
+                with tarfile.open(local_file, "r:*") as in_tar:
                     for member in in_tar.getmembers():
                         if member.name in added:
                             print(f"  Found duplicate file {member.name}!")
@@ -35,13 +67,18 @@ def merge_tar(output: str, inputs: list[str]) -> None:
                     error = True
                     continue
                 print(f"Adding {name}")
-                out_tar.add(file, name)
+                out_tar.add(local_file, name)
                 added.add(name)
+    out_file.raw.finish()
+    # Record where each member starts, so they can be listed and extracted individually
+    tar_index.write_index(output, out_tar.entries, out_gz.members)
     if error:
         print("Errors were encountered during merging!")
         sys.exit(1)
 
 if __name__ == "__main__":
-    output_file = sys.argv[1]
-    input_files = sys.argv[2:]
-    merge_tar(output_file, input_files)
+    args = sys.argv[1:]
+    cfg_file = args.pop(0) if args[0].endswith(('.yaml', '.yml')) else None
+    output_file = args[0]
+    input_files = args[1:]
+    merge_tar(output_file, input_files, cfg_file)
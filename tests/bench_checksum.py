@@ -0,0 +1,64 @@
+"""
+Benchmark file checksums with small reads and one algorithm at a time against single-pass large
+block reads, checksumming several files at once on a thread pool, and with a warm checksum cache.
+Run with `python tests/bench_checksum.py [files] [MiB per file] [threads]`.
+"""
+
+import os
+import sys
+import time
+import zlib
+import hashlib
+import tempfile
+
+from merge_utils import checksum
+
+ALGORITHMS = ['adler32', 'md5', 'sha256']
+
+def old_checksums(path: str, chunk_size: int = 8192) -> dict:
+    """Checksum a file the old way, re-reading it in small chunks for each algorithm"""
+    result = {}
+    for algo in ALGORITHMS:
+        cksum = 1 if algo == 'adler32' else hashlib.new(algo)
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                if algo == 'adler32':
+                    cksum = zlib.adler32(chunk, cksum)
+                else:
+                    cksum.update(chunk)
+        result[algo] = f"{cksum:08x}" if algo == 'adler32' else cksum.hexdigest()
+    return result
+
+def benchmark(count: int, size: int, threads: int) -> None:
+    """Compare the two methods on a set of temporary files"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for idx in range(count):
+            path = os.path.join(tmp_dir, f"file_{idx}.bin")
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size * 1024 * 1024))
+            paths.append(path)
+        print(f"{count} files of {size} MiB, algorithms {', '.join(ALGORITHMS)}")
+        start = time.perf_counter()
+        old = {path: old_checksums(path) for path in paths}
+        print(f"8 KiB reads, one pass per algorithm: {time.perf_counter() - start:.2f} s")
+        hasher = checksum.Hasher(threads)
+        start = time.perf_counter()
+        new = hasher.map(paths, ALGORITHMS)
+        print(f"{checksum.BLOCK_SIZE // 1024} KiB reads, single pass, {threads} threads: "
+              f"{time.perf_counter() - start:.2f} s")
+        hasher.close()
+        assert old == new
+        hasher = checksum.Hasher(threads, checksum.ChecksumCache(os.path.join(tmp_dir, "cache.db")))
+        hasher.map(paths, ALGORITHMS)
+        start = time.perf_counter()
+        cached = hasher.map(paths, ALGORITHMS)
+        print(f"Unchanged files from the checksum cache: {time.perf_counter() - start:.4f} s")
+        hasher.close()
+        assert cached == new
+
+if __name__ == '__main__':
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    mib = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    n_threads = int(sys.argv[3]) if len(sys.argv) > 3 else checksum.default_threads()
+    benchmark(n_files, mib, n_threads)
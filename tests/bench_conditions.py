@@ -0,0 +1,48 @@
+"""
+Benchmark condition evaluation for metadata.conditional and the standard merging methods.
+
+Compares rendering and evaluating every condition from scratch for each file (the old approach)
+with the compiled, memoized conditions used by naming.Formatter.eval.
+Run with `python tests/bench_conditions.py [files]`.
+"""
+
+import sys
+import time
+
+from merge_utils import config, naming
+from bench_merge_set_memory import record # also loads the default config
+
+def old_eval(formatter: naming.Formatter, condition: str):
+    """Render and evaluate a condition from scratch, like the original Formatter.eval"""
+    formatter.reset()
+    expr = str(condition).format_map(formatter)
+    if formatter.errors:
+        return False
+    try:
+        return eval(expr) #pylint: disable=eval-used
+    except Exception: # pylint: disable=broad-exception-caught
+        return False
+
+def run(count: int) -> None:
+    """Time both approaches over a set of realistic metadata dictionaries"""
+    tiers = ['hit-reconstructed', 'full-reconstructed', 'root-tuple', 'raw']
+    files = []
+    for idx in range(count):
+        metadata = record(idx)['metadata']
+        metadata['core.data_tier'] = tiers[idx % len(tiers)]
+        files.append(metadata)
+    conditions = [str(spec.cond) for spec in config.metadata.conditional]
+    conditions += [str(method.cond) for method in config.standard_methods]
+    print(f"{count} files, {len(conditions)} conditions")
+    results = {}
+    for name, func in [('old', old_eval), ('compiled', naming.Formatter.eval)]:
+        start = time.perf_counter()
+        results[name] = [
+            [bool(func(naming.Formatter(md), cond)) for cond in conditions] for md in files
+        ]
+        elapsed = time.perf_counter() - start
+        print(f"{name:<10}{elapsed:>8.3f} s  ({1e6*elapsed/(count*len(conditions)):.2f} us each)")
+    assert results['old'] == results['compiled'], "Results differ!"
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,46 @@
+"""
+Measure the memory used by a MergeSet holding a large number of typical input files.
+
+Each file gets a realistic MetaCat record, decoded from JSON like the batch caches so that
+strings are not shared by accident.  Run with `python tests/bench_merge_set_memory.py [files]`.
+"""
+
+import sys
+import json
+import copy
+import tracemalloc
+
+from merge_utils.merge_set import MergeSet
+from merge_set_test import FILE_DEFAULTS # also loads the default config
+
+def record(idx: int) -> dict:
+    """Make a MetaCat record for a file, with per-file names, runs, and event numbers"""
+    rec = copy.deepcopy(FILE_DEFAULTS)
+    rec['name'] = f"file_{idx:08}.root"
+    rec['fid'] = str(80000000 + idx)
+    rec['size'] = 26731046 + idx
+    rec['checksums'] = {'adler32': f"{idx:08x}"}
+    rec['parents'] = [{'fid': str(70000000 + idx)}]
+    md = rec['metadata']
+    md['dune_mc.gen_fcl_filename'] = 'gen.fcl'
+    md['core.runs'] = [70520830 + idx // 100]
+    md['core.first_event_number'] = idx * 10 + 1
+    md['core.last_event_number'] = idx * 10 + 10
+    md['core.start_time'] = 1689943000.0 + idx
+    md['core.end_time'] = 1689943892.0 + idx
+    return json.loads(json.dumps(rec))
+
+def measure(count: int) -> None:
+    """Build a MergeSet and report the memory it holds"""
+    tracemalloc.start()
+    files = MergeSet()
+    step = 1000
+    for skip in range(0, count, step):
+        files.add(skip, [record(i) for i in range(skip, min(skip + step, count))])
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{files.good_count}/{len(files)} good files, {size/2**20:.1f} MiB "
+          f"({size/len(files):.0f} bytes per file)")
+
+if __name__ == '__main__':
+    measure(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
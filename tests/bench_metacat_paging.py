@@ -0,0 +1,49 @@
+"""
+Benchmark offset and cursor paging against the local MetaCat stand-in.
+
+The stand-in charges a fixed latency per request plus a cost for every row skipped by an offset,
+mimicking how the MetaCat server has to scan past skipped rows of an ordered query.
+Run with `python tests/bench_metacat_paging.py [files] [batch_size]`.
+"""
+
+import sys
+import time
+import asyncio
+
+from conftest import MetaCatStandIn
+from merge_utils.metacat_utils import MetaCatWrapper
+from merge_utils.retriever import cursor_query
+
+QUERY = "files from test:dataset where dune.output_status=confirmed ordered"
+
+async def page_times(wrapper: MetaCatWrapper, count: int, step: int, cursor: bool) -> list:
+    """Retrieve all pages in sequence and time each request"""
+    times = []
+    fid = None
+    for skip in range(0, count, step):
+        query = cursor_query(QUERY, fid, step) if cursor else f"{QUERY} skip {skip} limit {step}"
+        start = time.perf_counter()
+        files = await wrapper.query(query, metadata=True, provenance=False)
+        times.append(time.perf_counter() - start)
+        if len(files) < step:
+            break
+        fid = files[-1]['fid']
+    return times
+
+async def benchmark(count: int, step: int) -> None:
+    """Compare per-page latency for both paging modes"""
+    metacat = MetaCatStandIn(count=count, latency=0.002, scan_cost=2e-6)
+    wrapper = MetaCatWrapper(factory=metacat)
+    await wrapper.connect()
+    print(f"{count} files in pages of {step}")
+    print(f"{'mode':<8}{'first':>10}{'middle':>10}{'last':>10}{'total':>10}  (seconds)")
+    for mode in ['offset', 'cursor']:
+        times = await page_times(wrapper, count, step, mode == 'cursor')
+        print(f"{mode:<8}{times[0]:>10.4f}{times[len(times)//2]:>10.4f}"
+              f"{times[-1]:>10.4f}{sum(times):>10.3f}")
+    await wrapper.disconnect()
+
+if __name__ == '__main__':
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    asyncio.run(benchmark(n_files, batch_size))
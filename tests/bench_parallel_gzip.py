@@ -0,0 +1,77 @@
+"""
+Benchmark writing merged tarballs with tarfile's single-threaded gzip compression against the
+parallel_gzip block writer, for archives of small and large members.
+Run with `python tests/bench_parallel_gzip.py [member sizes] [threads] [level]`, where the sizes
+are a comma-separated list like the default '1K,1M,64M,1G'.
+"""
+
+import os
+import sys
+import time
+import gzip
+import tarfile
+import tempfile
+
+from merge_utils import parallel_gzip
+
+UNITS = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+ARCHIVE_SIZE = 256 * 1024**2  # Approximate uncompressed size of the archives with small members
+MAX_MEMBERS = 10000
+
+def parse_size(text: str) -> int:
+    """Convert a size like '64M' to bytes"""
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+def make_file(path: str, size: int) -> None:
+    """Write a file of hex text, which compresses about 2:1 like typical merged outputs"""
+    with open(path, 'w', encoding='ascii') as f:
+        while size > 0:
+            block = min(size, 16 * 1024**2)
+            f.write(os.urandom(block // 2 + 1).hex()[:block])
+            size -= block
+
+def write_tar(inputs: list, output: str, threads: int, level: int) -> float:
+    """Write a tarball of the inputs, returning the time taken"""
+    start = time.perf_counter()
+    if threads:
+        with open(output, 'wb') as out_file, \
+                parallel_gzip.GzipWriter(out_file, level=level, threads=threads) as out_gz, \
+                tarfile.open(fileobj=out_gz, mode="w") as tar:
+            for path in inputs:
+                tar.add(path, os.path.basename(path))
+    else:
+        with tarfile.open(output, "w:gz", compresslevel=level) as tar:
+            for path in inputs:
+                tar.add(path, os.path.basename(path))
+    return time.perf_counter() - start
+
+def benchmark(sizes: list, threads: int, level: int) -> None:
+    """Compare the two writers for each member size"""
+    print(f"Compression level {level}, {threads} threads, {os.cpu_count()} CPUs")
+    for size in sizes:
+        count = min(MAX_MEMBERS, max(1, ARCHIVE_SIZE // size))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            inputs = [os.path.join(tmp_dir, f"member_{idx}.txt") for idx in range(count)]
+            for path in inputs:
+                make_file(path, size)
+            total = size * count / 1024**2
+            old_tar = os.path.join(tmp_dir, "old.tar.gz")
+            new_tar = os.path.join(tmp_dir, "new.tar.gz")
+            old = write_tar(inputs, old_tar, 0, level)
+            new = write_tar(inputs, new_tar, threads, level)
+            with gzip.open(old_tar) as f_old, gzip.open(new_tar) as f_new:
+                while block := f_old.read(16 * 1024**2):
+                    assert f_new.read(len(block)) == block
+            print(f"{count} x {size} B ({total:.0f} MiB): tarfile w:gz {old:.2f} s "
+                  f"({total/old:.0f} MiB/s), parallel {new:.2f} s ({total/new:.0f} MiB/s), "
+                  f"size {os.path.getsize(new_tar)/os.path.getsize(old_tar):.3f}x")
+
+if __name__ == '__main__':
+    member_sizes = [parse_size(s) for s in (sys.argv[1] if len(sys.argv) > 1
+                                            else '1K,1M,64M,1G').split(',')]
+    n_threads = int(sys.argv[2]) if len(sys.argv) > 2 else parallel_gzip.default_threads()
+    comp_level = int(sys.argv[3]) if len(sys.argv) > 3 else parallel_gzip.LEVEL
+    benchmark(member_sizes, n_threads, comp_level)
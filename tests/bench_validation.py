@@ -0,0 +1,62 @@
+"""
+Time the metadata fixes and validation of a large number of typical input files.
+
+Only the validation of each file is timed, not building the records or the rest of the MergeSet.
+With a number of processes, also time adding the files to a MergeSet with and without validating
+them in worker processes first.
+Run with `python tests/bench_validation.py [files] [repeats] [processes]`.
+"""
+
+import sys
+import time
+import math
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from merge_utils import config, meta, retriever
+from merge_utils.merge_set import MergeSet, MergeFile
+from bench_merge_set_memory import record # also loads the default config
+
+def benchmark(count: int, repeats: int) -> None:
+    """Validate fresh copies of the metadata several times and report the best time"""
+    best = None
+    for _ in range(repeats):
+        batch = [(f"test:{idx}", record(idx)['metadata']) for idx in range(count)]
+        start = time.perf_counter()
+        valid = sum(meta.validate(name, metadata) for name, metadata in batch)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{valid}/{count} valid files, {best:.3f} s ({best / count * 1e6:.1f} us per file)")
+
+def benchmark_processes(count: int, processes: int, step: int = 1000) -> None:
+    """Compare adding batches of files to a MergeSet with and without worker processes"""
+    batches = [[record(idx) for idx in range(skip, min(skip + step, count))]
+               for skip in range(0, count, step)]
+    files = MergeSet()
+    start = time.perf_counter()
+    for idx, batch in enumerate(batches):
+        files.add(idx * step, batch)
+    print(f"{'main process':<14}{time.perf_counter() - start:>8.3f} s")
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                             initializer=retriever.init_validation_worker,
+                             initargs=(config.snapshot(), logging.WARNING)) as pool:
+        list(pool.map(math.sqrt, range(processes)))  # start the workers
+        files = MergeSet()
+        start = time.perf_counter()
+        chunk = math.ceil(step / processes)
+        results = [[pool.submit(retriever.validate_records, batch[i:i+chunk])
+                    for i in range(0, len(batch), chunk)] for batch in batches]
+        for idx, (batch, futures) in enumerate(zip(batches, results)):
+            summaries = [file for future in futures for file in future.result()[0]]
+            files.add(idx * step, batch, [MergeFile.from_summary(file) for file in summaries])
+        print(f"{f'{processes} processes':<14}{time.perf_counter() - start:>8.3f} s")
+
+if __name__ == '__main__':
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    n_repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    benchmark(n_files, n_repeats)
+    if len(sys.argv) > 3:
+        benchmark_processes(n_files, int(sys.argv[3]))
@@ -0,0 +1,52 @@
+"""
+Benchmark checking remote replicas through the xrootd probe against a local stand-in server.
+
+The stand-in charges a fixed latency for every command, like a round trip to a remote server.
+Replicas are checked by a fixed number of concurrent workers, as in PathFinder, either with one
+listing per file or one listing per directory.
+Run with `python tests/bench_xrootd_probe.py [files] [files_per_dir] [latency]`.
+"""
+
+import sys
+import time
+import asyncio
+
+from merge_utils import config, xrootd
+from merge_utils.replicas import BaseRSE, Replica
+from conftest import XRootDStandIn
+
+async def check_all(replicas: list, files: dict, probe: xrootd.XRootDProbe) -> None:
+    """Check all the replicas with a fixed number of workers"""
+    queue = asyncio.Queue()
+    for replica in replicas:
+        queue.put_nowait(replica)
+    async def worker():
+        while not queue.empty():
+            replica = queue.get_nowait()
+            size, adler32, _ = files[replica.path]
+            await replica.rse.check(replica, size=size, cksums={'adler32': adler32}, probe=probe)
+    await asyncio.gather(*[worker() for _ in range(int(config.validation.concurrency))])
+
+def benchmark(count: int, per_dir: int, latency: float) -> None:
+    """Compare the number of commands and time taken with and without directory listings"""
+    server = "root://fake.host:1094"
+    files = {f"{server}/pnfs/dir{idx // per_dir}/file_{idx:06}.root": (idx, f"{idx:08x}", 'ONLINE')
+             for idx in range(count)}
+    rse = BaseRSE()
+    rse.name, rse.distance, rse.staging = 'fake', 0.0, 0.0
+    print(f"{count} files, {per_dir} per directory, {latency*1000:.0f} ms per command")
+    for listings in [False, True]:
+        fake = XRootDStandIn(files, latency=latency)
+        probe = xrootd.CommandProbe(runner=fake, listings=listings)
+        replicas = [Replica(url, rse) for url in files]
+        start = time.perf_counter()
+        asyncio.run(check_all(replicas, files, probe))
+        elapsed = time.perf_counter() - start
+        print(f"listings={listings!s:<6}{sum(fake.commands.values()):>8} commands{elapsed:>8.2f} s")
+
+if __name__ == '__main__':
+    config.load()
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_per_dir = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    t_latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.02
+    benchmark(n_files, n_per_dir, t_latency)
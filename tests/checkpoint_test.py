@@ -0,0 +1,44 @@
+"""Tests for the checkpoint module"""
+
+import pytest
+from merge_utils import config, checkpoint
+
+@pytest.fixture(name='job_dir')
+def fixture_job_dir(tmp_path):
+    """Point the job directory at a temporary path, loading the default config if needed"""
+    if not config.cfg_dict._locked: # pylint: disable=protected-access
+        config.load()
+    old_dir = config.job.dir.value
+    config.job.dir = str(tmp_path)
+    yield tmp_path
+    config.job.dir = old_dir
+
+def test_round_trip(job_dir):
+    """Saved state is restored, and missing checkpoints are ignored"""
+    assert checkpoint.load('schedule') is None
+    state = {'distances': {'RSE_A': {'SITE_1': 5.0}}, 'justin_rows': []}
+    checkpoint.save('schedule', state)
+    assert (job_dir / 'checkpoint' / 'schedule.pkl.gz').is_file()
+    assert checkpoint.load('schedule') == state
+
+def test_config_changes(job_dir): # pylint: disable=unused-argument
+    """Checkpoints are only reused if the settings for that stage are unchanged"""
+    checkpoint.save('schedule', {'files': []})
+    old_default = config.sites.default.value
+    config.sites.default = 'CERN'
+    assert checkpoint.load('schedule') == {'files': []}
+    config.sites.default = old_default
+    old_skip = config.input.skip.value
+    config.input.skip = 5
+    assert checkpoint.load('schedule') is None
+    config.input.skip = old_skip
+    assert checkpoint.load('schedule') == {'files': []}
+
+def test_handling_changes(job_dir): # pylint: disable=unused-argument
+    """Changing how bad or already merged files are handled invalidates the metadata checkpoint"""
+    checkpoint.save('metadata', {'files': []})
+    old_done = str(config.validation.handling.already_done)
+    config.validation.handling.already_done = 'skip' if old_done == 'include' else 'include'
+    assert checkpoint.load('metadata') is None
+    config.validation.handling.already_done = old_done
+    assert checkpoint.load('metadata') == {'files': []}
@@ -0,0 +1,95 @@
+"""Tests for the checksum module"""
+
+import zlib
+import asyncio
+import hashlib
+
+from merge_utils import checksum
+from merge_utils.replicas import BaseRSE
+
+def test_file_checksums(tmp_path):
+    """Checksums calculated in one pass across block boundaries match the reference values"""
+    data = bytes(range(256)) * 5000
+    path = tmp_path / "data.bin"
+    path.write_bytes(data)
+    result = checksum.file_checksums(str(path), ['adler32', 'md5', 'sha256'], block_size=4096)
+    assert result == {
+        'adler32': f"{zlib.adler32(data):08x}",
+        'md5': hashlib.md5(data).hexdigest(),
+        'sha256': hashlib.sha256(data).hexdigest(),
+    }
+    assert checksum.supported(['md5', 'bogus', 'adler32', 'shake_128']) == ['md5', 'adler32']
+
+def test_hasher(tmp_path):
+    """Files are checksummed in parallel, and local replicas are checked with the thread pool"""
+    paths = []
+    for idx in range(4):
+        path = tmp_path / f"file_{idx}.bin"
+        path.write_bytes(bytes([idx]) * (100000 + idx))
+        paths.append(str(path))
+    hasher = checksum.Hasher(2)
+    sums = hasher.map(paths, ['adler32'])
+    assert [sums[p]['adler32'] for p in paths] == \
+        [f"{zlib.adler32(bytes([i]) * (100000 + i)):08x}" for i in range(4)]
+
+    rse = BaseRSE()
+    rse.name = 'local'
+    async def check():
+        return await asyncio.gather(
+            rse.checksum_local(paths[0], sums[paths[0]], hasher),
+            rse.checksum_local(paths[1], {'adler32': 'deadbeef'}, hasher),
+            rse.checksum_local(paths[1], {'bogus': 'deadbeef'}, hasher),
+            rse.checksum_local(paths[2], {**sums[paths[2]], 'md5': 'deadbeef'}, hasher),
+            rse.checksum_local(paths[3], {'md5': 'deadbeef', 'sha256': 'deadbeef'}, hasher))
+    assert asyncio.run(check()) == [True, False, False, True, False]
+    hasher.close()
+
+def test_cache(tmp_path):
+    """Unchanged files are served from the cache, and changed files are checksummed again"""
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"first version")
+    cache = checksum.ChecksumCache(str(tmp_path / "cache" / "checksums.db"))
+    hasher = checksum.Hasher(cache=cache)
+    first = hasher.compute(str(path), ['adler32'])
+    assert first == {'adler32': f"{zlib.adler32(b'first version'):08x}"}
+    assert hasher.compute(str(path), ['adler32']) == first
+    assert cache.hits == 1
+    # Only the missing algorithm is calculated
+    both = hasher.compute(str(path), ['md5', 'adler32'])
+    assert list(both) == ['md5', 'adler32'] and both['adler32'] == first['adler32']
+    # Rewriting the file invalidates the entry, even though the inode is the same
+    path.write_bytes(b"second version")
+    assert hasher.compute(str(path), ['adler32']) == \
+        {'adler32': f"{zlib.adler32(b'second version'):08x}"}
+    assert cache.hits == 2
+    hasher.close()
+    # Entries persist between processes
+    cache = checksum.ChecksumCache(str(tmp_path / "cache" / "checksums.db"))
+    stat = path.stat()
+    assert cache.lookup(stat, ['adler32', 'md5']) == \
+        {'adler32': f"{zlib.adler32(b'second version'):08x}"}
+    cache.close()
+
+def test_writer(tmp_path):
+    """Checksums kept while writing match the file, only rereading blocks written out of order"""
+    data = bytes(range(256)) * 20000
+    assert checksum.adler32_combine(zlib.adler32(data[:1000]), zlib.adler32(data[1000:]),
+                                    len(data) - 1000) == zlib.adler32(data)
+    path = str(tmp_path / "out.bin")
+    with checksum.open_output(path) as out_file:
+        out_file.write(data)
+        out_file.seek(100)
+        out_file.write(b"header")
+        out_file.seek(0, 2)
+        out_file.write(b"trailer")
+    sums = out_file.raw.finish()
+    with open(path, 'rb') as f:
+        expected = f"{zlib.adler32(f.read()):08x}"
+    assert sums == {'adler32': expected}
+    assert out_file.raw.reread == checksum.WRITE_BLOCK
+    assert checksum.read_sidecar(path) == sums
+    assert checksum.read_sidecar(path, ['adler32', 'md5']) is None
+    # The sidecar is ignored once the file changes
+    with open(path, 'ab') as f:
+        f.write(b"more")
+    assert checksum.read_sidecar(path) is None
@@ -0,0 +1,194 @@
+"""Shared test fixtures"""
+
+import re
+import os
+import time
+import bisect
+import asyncio
+import threading
+
+import pytest
+from merge_utils import config
+
+class MetaCatStandIn:
+    """
+    Local stand-in for a MetaCat server, with the same interface as metacat.webapi.MetaCatClient.
+    Serves a fixed catalogue of files with a configurable per-request latency, and keeps track
+    of how many requests were in flight at once.
+    """
+
+    def __init__(self, count: int = 250, latency: float = 0.0, scan_cost: float = 0.0,
+                 namespace: str = 'test', first_fid: int = 1000):
+        self.latency = latency
+        self.scan_cost = scan_cost
+        self.files = []
+        for idx in range(count):
+            self.files.append({
+                'fid': str(first_fid + idx),
+                'namespace': namespace,
+                'name': f"file_{idx:06}.root",
+                'size': 1000 + idx,
+                'checksums': {'adler32': f"{idx:08x}"},
+                'retired': False,
+                'metadata': {
+                    'core.data_stream': 'physics',
+                    'core.data_tier': 'full-reconstructed',
+                    'core.file_format': 'artroot',
+                    'core.file_type': 'detector',
+                    'core.run_type': 'hd-protodune',
+                    'core.runs': [idx // 10],
+                    'core.event_count': 10,
+                    'dune.campaign': 'test',
+                },
+                'parents': [],
+                'children': []
+            })
+        self.by_did = {f"{f['namespace']}:{f['name']}": f for f in self.files}
+        self.by_fid = {f['fid']: f for f in self.files}
+        self.fids = [int(f['fid']) for f in self.files]  # Ordered numerically
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+
+    def __call__(self):
+        """Act as a client factory, all clients share the same catalogue"""
+        return self
+
+    def _start(self) -> None:
+        with self.lock:
+            self.requests += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def _stop(self) -> None:
+        with self.lock:
+            self.active -= 1
+
+    @staticmethod
+    def _record(file: dict, with_metadata: bool, with_provenance: bool) -> dict:
+        record = dict(file)
+        if not with_metadata:
+            record.pop('metadata')
+        if not with_provenance:
+            record.pop('parents')
+            record.pop('children')
+        return record
+
+    def _select(self, query: str) -> tuple[list, int]:
+        """
+        Select files for a query, and count how many rows the server had to scan past.
+        Files are ordered by numeric FID, and FID cursors are compared as numbers unless quoted.
+        """
+        number = re.search(r"\bfid > (\d+)", query)
+        string = re.search(r"\bfid > '([^']*)'", query)
+        skip = re.search(r'\bskip (\d+)', query)
+        limit = re.search(r'\blimit (\d+)', query)
+        files = self.files
+        if number:
+            files = files[bisect.bisect_right(self.fids, int(number.group(1))):]
+        elif string:
+            files = [f for f in files if f['fid'] > string.group(1)]
+        scanned = int(skip.group(1)) if skip else 0
+        end = scanned + int(limit.group(1)) if limit else None
+        return files[scanned:end], scanned
+
+    def query(self, query: str, with_metadata: bool = False, with_provenance: bool = False,
+              summary: str = None):
+        """
+        Run a query, only skip, limit, and FID cursor clauses are interpreted.
+        Skipped rows add scan_cost each to the latency, like an offset scan on the server.
+        """
+        self._start()
+        try:
+            files, scanned = self._select(query)
+            time.sleep(self.latency + self.scan_cost * scanned)
+        finally:
+            self._stop()
+        if summary == 'count':
+            return iter([{'count': len(files)}])
+        return (self._record(f, with_metadata, with_provenance) for f in files)
+
+    def get_files(self, lookup_list: list, with_metadata: bool = True,
+                  with_provenance: bool = False):
+        """Look up files by DID, namespace and name, or FID"""
+        self._start()
+        try:
+            time.sleep(self.latency)
+            files = []
+            for item in lookup_list:
+                if 'did' in item:
+                    file = self.by_did.get(item['did'])
+                elif 'fid' in item:
+                    file = self.by_fid.get(str(item['fid']))
+                else:
+                    file = self.by_did.get(f"{item['namespace']}:{item['name']}")
+                if file is not None:
+                    files.append(file)
+        finally:
+            self._stop()
+        return (self._record(f, with_metadata, with_provenance) for f in files)
+
+class XRootDStandIn:
+    """
+    Local stand-in for xrootd servers, used in place of running the xrdfs and gfal-xattr commands.
+    Serves a fixed set of files with a configurable per-command latency, and keeps track of how
+    many commands of each kind were run and how many were running at once.
+    """
+
+    def __init__(self, files: dict = None, latency: float = 0.0):
+        """
+        :param files: dictionary of {url: (size, adler32, locality)}
+        :param latency: time taken by each command in seconds
+        """
+        self.files = files or {}
+        self.latency = latency
+        self.commands = {}
+        self.active = 0
+        self.max_active = 0
+
+    @staticmethod
+    def listing(path: str, size: int) -> str:
+        """Format a line of 'xrdfs ls -l' output"""
+        return f"-r-- 2023-07-21 12:35:54 {size:>12} {path}"
+
+    async def __call__(self, cmd: list, timeout: float) -> tuple:
+        """Run a command, returning the return code, stdout, and stderr"""
+        kind = ' '.join(cmd[2:4]) if cmd[0] == 'xrdfs' else cmd[0]
+        self.commands[kind] = self.commands.get(kind, 0) + 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.active -= 1
+        if cmd[0] == 'gfal-xattr':
+            file = self.files.get(cmd[3])
+            return (0, f"{file[2]}\n", "") if file else (2, "", "No such file")
+        server, path = cmd[1], cmd[-1]
+        if kind == 'ls -l':
+            file = self.files.get(server + path)
+            if file:
+                return 0, self.listing(path, file[0]) + "\n", ""
+            lines = [self.listing(url[len(server):], file[0]) for url, file in self.files.items()
+                     if url.startswith(server) and os.path.dirname(url[len(server):]) == path]
+            if lines:
+                return 0, "\n".join(lines) + "\n", ""
+            return 54, "", f"[ERROR] Server responded with an error: [3011] No such file {path}"
+        if kind == 'query checksum':
+            file = self.files.get(server + path)
+            if file:
+                return 0, f"adler32 {file[1]}\n", ""
+            return 54, "", f"[ERROR] Server responded with an error: [3011] No such file {path}"
+        return 50, "", f"Unknown command {cmd}"
+
+@pytest.fixture(name='cfg', autouse=True)
+def fixture_cfg():
+    """Load the default configuration if no other test has yet"""
+    if not config.cfg_dict._locked: # pylint: disable=protected-access
+        config.load()
+
+@pytest.fixture(name='metacat')
+def fixture_metacat():
+    """Local MetaCat stand-in with a small per-request latency"""
+    return MetaCatStandIn(count=250, latency=0.02)
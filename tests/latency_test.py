@@ -0,0 +1,79 @@
+"""Tests for the latency module"""
+
+import types
+import asyncio
+import socket
+
+from merge_utils import latency, replicas
+
+def free_port() -> int:
+    """Find a local port that nothing is listening on"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+async def measure(cache: latency.LatencyCache, hosts: list, serve: bool) -> tuple:
+    """Measure the latency to local hosts, optionally with a server listening on the first"""
+    server = None
+    if serve:
+        server = await asyncio.start_server(lambda r, w: w.close(), '127.0.0.1', hosts[0][1])
+    try:
+        return tuple(await asyncio.gather(*[cache.get(*host) for host in hosts]))
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+def test_latency_cache(tmp_path):
+    """Latencies and unreachable hosts are measured once and shared through the cache"""
+    path = str(tmp_path / "latency.db")
+    up = ('127.0.0.1', free_port())
+    down = ('127.0.0.1', free_port())
+    cache = latency.LatencyCache(path=path, lifetime=1, retry=1, timeout=1)
+    cache.open()
+    ms_up, ms_down, again = asyncio.run(measure(cache, [up, down, up], serve=True))
+    cache.close()
+    assert 0 <= ms_up < 1000 and again == ms_up
+    assert ms_down == float('inf')
+    assert len(cache.tasks) == 2
+
+    # A new job reuses the cached values, even though the server is gone
+    cache = latency.LatencyCache(path=path, lifetime=1, retry=1, timeout=1)
+    cache.open()
+    assert cache.lookup(*up) == ms_up
+    assert asyncio.run(measure(cache, [up, down], serve=False)) == (ms_up, float('inf'))
+
+    # Expired entries are measured again
+    cache = latency.LatencyCache(path=path, lifetime=0, retry=0, timeout=1)
+    cache.open()
+    assert cache.lookup(*up) is None
+    assert asyncio.run(measure(cache, [up], serve=False)) == (float('inf'),)
+
+class SlowLatency:
+    """Latency cache stand-in that takes a while to answer"""
+    async def best(self, hosts) -> float:
+        """Return a fixed latency after a delay"""
+        await asyncio.sleep(0.05)
+        return 50.0
+
+def test_new_rse_latency():
+    """Replicas on a new RSE all see its distance with the latency already added"""
+    finder = replicas.PathListFinder(None)
+    finder.latency = SlowLatency()
+    files = [types.SimpleNamespace(replicas=[], size=None, checksums={}) for _ in range(3)]
+    distances = []
+
+    async def check_replica(replica, size=None, cksums=None):
+        # Record the distance the replica check would copy from the RSE
+        distances.append(replica.rse.distance)
+    finder.check_replica = check_replica
+
+    async def add():
+        await asyncio.gather(*[
+            finder.add_replica(file, f"root://host.example:1094/data/file_{idx}.root")
+            for idx, file in enumerate(files)])
+
+    asyncio.run(add())
+    assert len({id(file.replicas[0].rse) for file in files}) == 1
+    assert len(distances) == 3 and len(set(distances)) == 1 and distances[0] >= 50.0
+    finder.hasher.close()
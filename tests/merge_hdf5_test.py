@@ -0,0 +1,123 @@
+"""Tests for the merge_hdf5 runner script"""
+
+import importlib.util
+
+import pytest
+import yaml
+
+from merge_utils import io_utils
+
+h5py = pytest.importorskip("h5py")
+numpy = pytest.importorskip("numpy")
+
+LENGTHS = [8, 7, 13]  # Not chunk multiples, and the third input doesn't start on a chunk boundary
+
+@pytest.fixture(name='runner')
+def fixture_runner():
+    """Load a fresh copy of the runner script, since it keeps its state in module globals"""
+    spec = importlib.util.spec_from_file_location(
+        "merge_hdf5", io_utils.find_runner("merge_hdf5.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def write_config(tmp_path, **datasets) -> str:
+    """Write a copy of the default HDF5 merging config, with some dataset settings changed"""
+    with open(io_utils.find_cfg("hdf5.yaml"), encoding="utf-8") as f:
+        cfg = yaml.safe_load(f)
+    cfg['datasets'].update(datasets)
+    path = tmp_path / "hdf5.yaml"
+    path.write_text(yaml.safe_dump(cfg), encoding="utf-8")
+    return str(path)
+
+def write_inputs(tmp_path) -> tuple[list, dict]:
+    """Write chunked, compressed input files, returning their paths and the expected data"""
+    paths = []
+    data = {'/charge/hits': [], '/charge/ids': []}
+    for idx, length in enumerate(LENGTHS):
+        hits = numpy.arange(length * 3, dtype='f4').reshape(length, 3) + 1000 * idx
+        ids = numpy.arange(length, dtype='i8') + 100 * idx
+        path = str(tmp_path / f"input_{idx}.hdf5")
+        with h5py.File(path, 'w') as f:
+            f.attrs['run'] = 1
+            grp = f.create_group('charge')
+            grp.create_dataset('hits', data=hits, chunks=(4, 3), maxshape=(None, 3),
+                               compression='gzip', shuffle=True)
+            grp.create_dataset('ids', data=ids, chunks=(4,), maxshape=(None,),
+                               compression='gzip')
+        paths.append(path)
+        data['/charge/hits'].append(hits)
+        data['/charge/ids'].append(ids)
+    return paths, {name: numpy.concatenate(arrays) for name, arrays in data.items()}
+
+def test_merge(runner, tmp_path, monkeypatch):
+    """Merged datasets match numpy.concatenate, using raw chunk copies where they line up"""
+    paths, expected = write_inputs(tmp_path)
+    copied = []
+    copy_chunks = runner.copy_chunks
+    def spy(source, target, axis, start):
+        result = copy_chunks(source, target, axis, start)
+        copied.append((source.name, start, result))
+        return result
+    monkeypatch.setattr(runner, 'copy_chunks', spy)
+    output = str(tmp_path / "merged.hdf5")
+    # Small blocks, so the fallback copies several blocks per input
+    runner.merge_hdf5(output, paths, write_config(tmp_path, block_size=32 / 1024**2))
+
+    with h5py.File(output, 'r') as f:
+        for name, values in expected.items():
+            assert f[name].compression == 'gzip'
+            numpy.testing.assert_array_equal(f[name][()], values)
+        assert f.attrs['run'] == 1
+        assert 'creation_timestamp' in f.attrs
+    # The second input starts on a chunk boundary, the third doesn't
+    assert ('/charge/hits', 8, True) in copied
+    assert ('/charge/hits', 15, False) in copied
+    assert runner.divisions['/charge/hits'] == [8, 15, 28]
+
+def test_copy_blocks(runner, tmp_path):
+    """Block copies are aligned to the source chunks and cover partial edge chunks"""
+    runner.cfg['datasets'] = {'block_size': 16 / 1024**2}  # 16 bytes, less than a chunk
+    with h5py.File(str(tmp_path / "blocks.hdf5"), 'w') as f:
+        source = f.create_dataset('source', data=numpy.arange(10, dtype='i4'), chunks=(3,))
+        target = f.create_dataset('target', shape=(15,), dtype='i4')
+        runner.copy_blocks(source, target, 0, 5)
+        numpy.testing.assert_array_equal(target[5:], numpy.arange(10))
+
+def test_virtual(runner, tmp_path):
+    """Virtual datasets reference the inputs, and materializing them copies the data"""
+    paths, expected = write_inputs(tmp_path)
+    output = str(tmp_path / "virtual.hdf5")
+    runner.merge_hdf5(output, paths, write_config(tmp_path, virtual=True))
+    with h5py.File(output, 'r') as f:
+        for name, values in expected.items():
+            assert f[name].is_virtual
+            numpy.testing.assert_array_equal(f[name][()], values)
+
+    materialized = str(tmp_path / "materialized.hdf5")
+    runner.materialize(output, materialized)
+    with h5py.File(materialized, 'r') as f:
+        assert f.attrs['run'] == 1
+        for name, values in expected.items():
+            assert not f[name].is_virtual
+            assert f[name].compression == 'gzip'
+            numpy.testing.assert_array_equal(f[name][()], values)
+
+def test_conflicts(runner, tmp_path):
+    """All the problems with the inputs are reported before the output is created"""
+    paths = [str(tmp_path / "input_0.hdf5"), str(tmp_path / "input_1.hdf5")]
+    with h5py.File(paths[0], 'w') as f:
+        f.create_dataset('a', data=numpy.zeros(3))
+        f.create_dataset('x', data=numpy.zeros((3, 2), dtype='i4'))
+    with h5py.File(paths[1], 'w') as f:
+        f.create_group('a').create_dataset('b', data=numpy.zeros(3))
+        f.create_dataset('x', data=numpy.zeros((3, 2), dtype='f8'))
+    output = tmp_path / "merged.hdf5"
+    with pytest.raises(ValueError) as err:
+        runner.merge_hdf5(str(output), paths, write_config(tmp_path))
+    assert "'/a' is a group in some files and a dataset in others" in str(err.value)
+    assert "Inconsistent dtype for dataset '/x'" in str(err.value)
+    assert not output.exists()
+    # The inputs were closed, so they can be replaced
+    for path in paths:
+        h5py.File(path, 'w').close()
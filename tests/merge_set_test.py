@@ -1,8 +1,10 @@
 """Tests for the metacat utils module"""
 
 import pytest
-from merge_utils import config
-from merge_utils.merge_set import MergeFile, MergeFileError, MergeSet
+from merge_utils import config, meta
+from merge_utils.merge_set import (
+    MergeFile, MergeFileError, MergeSet, MergeChunk, FileMetadata, compact_fid
+)
 
 config.load()  # Load the default configuration for testing
 
@@ -122,3 +124,79 @@ def test_merge_file(spec, errors):
             value = str(value)
         assert f_obj.get_fields([field]) == (f_dict['namespace'], value)
     assert f_obj.errors == errors
+
+def good_dict(name: str) -> dict:
+    """Create a valid file dictionary for testing"""
+    return file_dict({'name': name, 'metadata': {'dune_mc.gen_fcl_filename': 'gen.fcl'}})
+
+def test_merge_set_sparse():
+    """Files can be added out of order without padding the set"""
+    files = MergeSet()
+    files.add(200, [good_dict('c'), good_dict('d')])
+    files.add(0, [good_dict('a'), good_dict('b')])
+    assert len(files) == 4
+    assert files.good_count == 4
+    assert (files.start_idx, files.end_idx) == (0, 202)
+    assert files.indices == [0, 1, 200, 201]
+    assert [f.name for f in files.get_slice(1, 201)] == ['b', 'c']
+    assert files.get_by_idx(100) is None
+
+def test_merge_set_errors():
+    """Error indexes and counters follow files as they are flagged"""
+    files = MergeSet()
+    files.add(0, [good_dict('a'), good_dict('b'), good_dict('a'), good_dict('c')])
+    assert [f.name for f in files.error_files(MergeFileError.DUPLICATE)] == ['a']
+    files.set_error([f"{FILE_DEFAULTS['namespace']}:c"], MergeFileError.UNREACHABLE)
+    files.set_error([f"{FILE_DEFAULTS['namespace']}:a"], MergeFileError.NO_METADATA)
+    assert [f.name for f in files.error_files(MergeFileError.UNREACHABLE)] == ['c']
+    assert [f.name for f in files.error_files(MergeFileError.NO_METADATA)] == ['a']
+    assert MergeFileError.UNREACHABLE in files.errors
+    assert [f.name for f in files.good_files] == ['b']
+    assert files.good_count == 1
+
+def test_file_metadata():
+    """Metadata views only store the values that differ from the shared base"""
+    base = {'a': 1, 'b': 'x', 'c': [1, 2], 'd': 1}
+    md = FileMetadata(base, {'a': 1, 'b': 'y', 'c': [1, 2], 'd': 1.0, 'e': None})
+    assert dict(md) == {'a': 1, 'b': 'y', 'c': [1, 2], 'd': 1.0, 'e': None}
+    assert len(md) == 5
+    assert isinstance(md['d'], float)
+    assert md._own.keys() == {'b', 'd', 'e'} # pylint: disable=protected-access
+    md = FileMetadata(base, {'a': 1})
+    assert dict(md) == {'a': 1}
+    assert 'b' not in md and md.get('c') is None
+
+def test_merge_set_shared_metadata():
+    """Files in a set share metadata storage and keep numeric FIDs as integers"""
+    files = MergeSet()
+    files.add(0, [good_dict('a'), good_dict('b')])
+    file = files.get_by_did(f"{FILE_DEFAULTS['namespace']}:b")
+    assert isinstance(file.metadata, FileMetadata)
+    assert file.metadata['core.data_tier'] == 'hit-reconstructed'
+    assert not file.metadata._own # pylint: disable=protected-access
+    assert file.fid == int(FILE_DEFAULTS['fid'])
+    assert compact_fid('0123') == '0123' and compact_fid('abc') == 'abc'
+
+def test_chunk_metadata():
+    """Parent chunks combine their children's metadata to the same result as merging files"""
+    records = []
+    for idx in range(6):
+        rec = good_dict(f"f{idx}")
+        rec['metadata'].update({
+            'core.runs': [idx // 2],
+            'core.first_event_number': idx * 10 + 1,
+            'core.last_event_number': idx * 10 + 10,
+            'core.event_count': 10,
+        })
+        records.append(rec)
+    files = MergeSet()
+    files.add(0, records)
+    chunk = MergeChunk(files=files.good_files)
+    chunk.make_child(chunk.files[:4])
+    chunk.make_child(chunk.files[4:])
+    expected = meta.merged_keys(files.good_files, transform=False, warn=False)
+    assert chunk.accumulator.merged(transform=False, warn=False) == expected
+    assert files.metadata.merged(transform=False, warn=False) == expected
+    assert expected['core.event_count'] == 60
+    assert sorted(expected['core.runs']) == [0, 1, 2]
+    assert (expected['core.first_event_number'], expected['core.last_event_number']) == (1, 60)
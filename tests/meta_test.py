@@ -0,0 +1,121 @@
+"""Tests for the meta module"""
+
+import types
+import collections
+
+import pytest
+from merge_utils import config, meta
+
+def base_metadata() -> dict:
+    """Metadata that satisfies the default requirements"""
+    return {
+        'core.data_stream': 'physics',
+        'core.data_tier': 'full-reconstructed',
+        'core.file_format': 'artroot',
+        'core.file_type': 'detector',
+        'core.run_type': 'hd-protodune',
+        'core.runs': [1],
+        'core.end_time': 10,
+    }
+
+def test_validation_plan():
+    """The compiled plan applies the configured fixes and checks"""
+    plan = meta.validation_plan()
+    metadata = base_metadata()
+    metadata['DUNE.requestid'] = 'ritm1'
+    metadata['core.data_tier'] = 'pandora_info'
+    assert plan.validate('test:a', metadata)
+    assert metadata['dune.requestid'] == 'ritm1' and 'DUNE.requestid' not in metadata
+    assert metadata['core.data_tier'] == 'pandora-info'
+    assert metadata['retention.status'] == 'active'
+
+    metadata = base_metadata()
+    metadata['core.data_tier'] = 'raw'
+    metadata['core.run_type'] = 'not-a-run-type'
+    metadata['core.event_count'] = True
+    del metadata['core.data_stream']
+    errs = plan.check_required(metadata) + plan.check_values(metadata)
+    assert "Missing required key: core.data_stream" in errs
+    assert "Missing conditionally required key: core.first_event_number " \
+           "(from '{core.data_tier}' in ['raw', 'binary-raw', 'trigprim'])" in errs
+    assert "Invalid value for core.run_type: not-a-run-type" in errs
+    assert "Invalid type for core.event_count: True (expected int)" in errs
+    assert not any('core.end_time' in err for err in errs)
+    assert plan.validate_batch([('test:b', base_metadata()), ('test:c', metadata)]) == [True, False]
+
+def test_validation_plan_recompiled(monkeypatch):
+    """The plan is reused until the configuration changes"""
+    plan = meta.validation_plan()
+    assert meta.validation_plan() is plan
+    monkeypatch.setattr(config, 'generation', config.generation + 1)
+    assert meta.validation_plan() is not plan
+
+def test_subset_combine():
+    """Combining subset accumulators in either order matches adding the values one at a time"""
+    values = [{'x': 1, 'y': 1}, {'y': 2}, {'x': 1, 'y': 1}, {'z': 1}, {'x': 1, 'z': 2}]
+    sequential = meta.MergeMetaSubset()
+    for value in values:
+        sequential.add(value)
+    assert sequential.value == {'x': 1}
+    for split in range(1, len(values)):
+        parts = [values[:split], values[split:]]
+        children = []
+        for part in parts:
+            child = meta.MergeMetaSubset()
+            for value in part:
+                child.add(value)
+            children.append(child)
+        for order in [children, children[::-1]]:
+            combined = meta.MergeMetaSubset()
+            for child in order:
+                combined.combine(child)
+            expected = meta.MergeMetaSubset()
+            for child in order:
+                for value in parts[children.index(child)]:
+                    expected.add(value)
+            assert combined.value == expected.value
+            assert 'y' not in combined.value and 'z' not in combined.value
+
+def baseline_merged_keys(files: list, transform: bool = True) -> dict:
+    """Merge metadata the way merged_keys did before it used a MetaAccumulator"""
+    metadata = collections.defaultdict(
+        meta.MERGE_META_CLASSES[str(config.metadata.merging['default'])]
+    )
+    for key, mode in config.metadata.merging.items():
+        if key == 'default':
+            continue
+        metadata[key] = meta.MERGE_META_CLASSES.get(str(mode), meta.MergeMetaOverride)()
+    if transform:
+        for key, value in config.metadata.overrides.items():
+            metadata[key] = meta.MergeMetaOverride(value._value) # pylint: disable=protected-access
+        for key, value in meta.merge_cfg_keys().items():
+            metadata[f"merge.{key}"] = meta.MergeMetaOverride(str(value))
+        if config.input.campaign:
+            metadata['dune.campaign'] = meta.MergeMetaOverride(str(config.input.campaign))
+    for file in files:
+        for key, value in file.metadata.items():
+            metadata[key].add(value)
+    metadata = {k: v.value for k, v in metadata.items() if v.valid}
+    if transform and config.method.transform:
+        meta.add_origin(metadata, str(config.method.transform))
+    assert meta.validate("output", metadata, requirements=False)
+    return metadata
+
+@pytest.mark.parametrize('transform', [False, True])
+def test_merged_keys_baseline(transform):
+    """Merged metadata matches merging every file from scratch, including key order"""
+    values = [
+        {'core.event_count': 5, 'core.runs': [1], 'dune.workflow': {'a': 1, 'b': 2},
+         'core.end_time': 10, 'core.data_tier': 'raw'},
+        {'core.event_count': 0, 'core.runs': [2, 1], 'dune.workflow': {'a': 1, 'b': 3},
+         'core.first_event_number': 7, 'core.data_tier': 'raw', 'dune.extra': 'x'},
+        {'core.event_count': 3, 'core.runs': [3], 'core.first_event_number': 2,
+         'core.data_tier': 'raw', 'dune.extra': 'y', 'retention.status': 'pending'},
+    ]
+    files = [types.SimpleNamespace(metadata=value) for value in values]
+    expected = baseline_merged_keys(files, transform)
+    merged = meta.merged_keys(files, transform=transform, warn=False)
+    assert list(merged.items()) == list(expected.items())
+    chunks = [meta.MetaAccumulator(files[:1]), meta.MetaAccumulator(files[1:])]
+    chunks[0].combine(chunks[1])
+    assert list(chunks[0].merged(transform, warn=False).items()) == list(expected.items())
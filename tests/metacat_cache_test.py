@@ -0,0 +1,78 @@
+"""Tests for the metacat cache module"""
+
+import time
+
+import pytest
+from merge_utils.metacat_cache import MetaCatCache
+
+def record(name: str, fid: str, **kwargs) -> dict:
+    """Make a minimal MetaCat file record"""
+    rec = {
+        'namespace': 'test',
+        'name': name,
+        'fid': fid,
+        'size': 100,
+        'checksums': {'adler32': '00000001'},
+        'metadata': {'core.runs': [1]},
+        'parents': [],
+        'children': []
+    }
+    rec.update(kwargs)
+    return rec
+
+@pytest.fixture(name='cache')
+def fixture_cache(tmp_path):
+    """Open a fresh cache database"""
+    cache = MetaCatCache(str(tmp_path / 'metacat.db'), lifetime=24.0, volatile=1.0)
+    cache.open()
+    yield cache
+    cache.close()
+
+def test_files_by_did_and_fid(cache):
+    """Records can be found by DID or FID, and misses are passed through"""
+    cache.put_files([record('a', '1'), record('b', '2')], metadata=True, provenance=False)
+    found, missing = cache.get_files(
+        [{'did': 'test:a'}, {'fid': '2'}, {'did': 'test:c'}], metadata=True, provenance=False)
+    assert sorted(f['name'] for f in found) == ['a', 'b']
+    assert missing == [{'did': 'test:c'}]
+    assert 'parents' not in found[0]
+
+def test_partial_records(cache):
+    """Records without metadata or provenance do not satisfy fuller requests"""
+    cache.put_files([record('a', '1')], metadata=False, provenance=False)
+    found, missing = cache.get_files([{'did': 'test:a'}], metadata=True, provenance=False)
+    assert not found and len(missing) == 1
+    found, missing = cache.get_files([{'did': 'test:a'}], metadata=False, provenance=False)
+    assert len(found) == 1 and not missing
+    assert 'metadata' not in found[0]
+
+def test_retired_and_redeclared(cache):
+    """Retired files are dropped, and re-declared files replace the old record"""
+    cache.put_files([record('a', '1'), record('b', '2')], metadata=True, provenance=False)
+    cache.put_files([record('a', '1', retired=True), record('b', '3')],
+                    metadata=True, provenance=False)
+    found, missing = cache.get_files(
+        [{'did': 'test:a'}, {'did': 'test:b'}], metadata=True, provenance=False)
+    assert [f['fid'] for f in found] == ['3']
+    assert missing == [{'did': 'test:a'}]
+
+def test_queries(cache):
+    """Query results are returned in order, and expire after the volatile lifetime"""
+    records = [record('b', '2'), record('a', '1')]
+    cache.put_query("files where x ordered", True, True, records)
+    assert cache.get_query("files  where x ordered", True, True) == records
+    assert cache.get_query("files where x ordered", True, False) is None
+    cache.volatile = 0
+    time.sleep(0.01)
+    assert cache.get_query("files where x ordered", True, True) is None
+
+def test_query_pages(cache):
+    """Pages of an ordered query are cut from the cached results of the whole query"""
+    records = [record(name, str(idx)) for idx, name in enumerate('abcde')]
+    cache.put_query("files where x ordered", True, True, records)
+    def names(query: str) -> str:
+        return ''.join(f['name'] for f in cache.get_query(query, True, True))
+    assert names("files where x ordered skip 1 limit 2") == 'bc'
+    assert names("files where x ordered limit 2") == 'ab'
+    assert names("files where x ordered skip 4 limit 2") == 'e'
+    assert cache.get_query("files where y ordered skip 1 limit 2", True, True) is None
@@ -0,0 +1,72 @@
+"""Tests for the metacat utils module"""
+
+import asyncio
+
+from merge_utils.metacat_cache import MetaCatCache
+from merge_utils.metacat_utils import MetaCatWrapper
+
+async def run_wrapper(wrapper: MetaCatWrapper, coro):
+    """Connect, run a coroutine, and disconnect"""
+    await wrapper.connect()
+    try:
+        return await coro
+    finally:
+        await wrapper.disconnect()
+
+def test_query(metacat):
+    """Queries return the requested page of records"""
+    wrapper = MetaCatWrapper(connections=2, factory=metacat)
+    files = asyncio.run(run_wrapper(wrapper, wrapper.query(
+        "files where x ordered skip 100 limit 50", metadata=True, provenance=False)))
+    assert [f['name'] for f in files] == [f"file_{i:06}.root" for i in range(100, 150)]
+    assert 'metadata' in files[0] and 'parents' not in files[0]
+
+def test_bounded_concurrency(metacat):
+    """Concurrent requests share a bounded pool of connections"""
+    wrapper = MetaCatWrapper(connections=4, factory=metacat)
+    async def requests():
+        return await asyncio.gather(*[
+            wrapper.files([{'did': f"test:file_{i:06}.root"}], metadata=False, provenance=False)
+            for i in range(20)
+        ])
+    results = asyncio.run(run_wrapper(wrapper, requests()))
+    assert [res[0]['fid'] for res in results] == [str(1000 + i) for i in range(20)]
+    assert 1 < metacat.max_active <= 4
+
+def test_split_requests(metacat):
+    """Large file requests are split into several smaller ones"""
+    wrapper = MetaCatWrapper(connections=4, max_files=30, factory=metacat)
+    lookup = [{'fid': str(1000 + i)} for i in range(100)]
+    files = asyncio.run(run_wrapper(wrapper, wrapper.files(lookup)))
+    assert [f['fid'] for f in files] == [str(1000 + i) for i in range(100)]
+    assert metacat.requests == 4
+
+def test_cached_files_order(metacat, tmp_path):
+    """Files found in the cache are returned in request order along with the fetched ones"""
+    cache = MetaCatCache(str(tmp_path / 'metacat.db'), lifetime=24.0, volatile=1.0)
+    cache.open()
+    cache.put_files([metacat.by_fid[str(1000 + i)] for i in [3, 7, 8]], True, False)
+    cache.close()
+    wrapper = MetaCatWrapper(cache, connections=2, factory=metacat)
+    lookup = [{'fid': str(1000 + i)} for i in range(10)]
+    lookup[5] = {'did': "test:file_000005.root"}
+    files = asyncio.run(run_wrapper(wrapper, wrapper.files(lookup, provenance=False)))
+    assert [f['fid'] for f in files] == [str(1000 + i) for i in range(10)]
+    assert cache.hits == 3
+
+def test_cached_query_pages(metacat, tmp_path):
+    """Concurrent pages of a query share one request, and a rerun is served from the cache"""
+    def run() -> list:
+        cache = MetaCatCache(str(tmp_path / 'metacat.db'), lifetime=24.0, volatile=1.0)
+        wrapper = MetaCatWrapper(cache, connections=4, factory=metacat)
+        async def pages():
+            return await asyncio.gather(*[
+                wrapper.query(f"files where x ordered skip {skip} limit 60", provenance=False)
+                for skip in range(0, 250, 60)
+            ])
+        return asyncio.run(run_wrapper(wrapper, pages()))
+    for _ in range(2):
+        pages = run()
+        assert [f['fid'] for page in pages for f in page] == [str(1000 + i) for i in range(250)]
+        assert [len(page) for page in pages] == [60, 60, 60, 60, 10]
+        assert metacat.requests == 1
@@ -0,0 +1,30 @@
+"""Tests for the naming module"""
+
+from merge_utils import naming
+
+def test_condition_memoized():
+    """Conditions are only evaluated once per distinct combination of values"""
+    cond = naming.Condition("'{core.data_tier}' in ['raw', 'trigprim'] and {core.event_count} > 0")
+    cases = [('raw', 5, True), ('raw', 0, False), ('trigprim', 5, True), ('raw', True, True)]
+    for tier, count, expected in cases * 10:
+        formatter = naming.Formatter({'core.data_tier': tier, 'core.event_count': count})
+        assert bool(cond.evaluate(formatter)) is expected
+    assert len(cond.results) == len(cases)
+
+def test_condition_errors():
+    """Missing keys and unsafe expressions evaluate to False"""
+    text = "'{core.file_type}' == 'mc'"
+    assert naming.get_condition(text) is naming.get_condition(text)
+    assert naming.Formatter({'core.file_type': 'mc'}).eval(text)
+    assert not naming.Formatter({}).eval(text)
+    assert not naming.Formatter({'a': 1}).eval("__import__('os').getcwd() or {a}")
+    assert not naming.Formatter({'a': 'x'}).eval("'{a}'.__class__ == str")
+    assert not naming.Formatter({'a': 'x'}).eval("'{a}'.format(1) == 'x'")
+    assert naming.Formatter({'a': [1, 2]}).eval("len({a}) == 2")
+
+def test_condition_methods():
+    """Simple string methods can be called on metadata values"""
+    formatter = naming.Formatter({'dune.campaign': 'hd_test', 'a': 'X,Y'})
+    assert formatter.eval("'{dune.campaign}'.startswith('hd')")
+    assert not formatter.eval("'{dune.campaign}'.endswith('hd')")
+    assert formatter.eval("'{a}'.lower().split(',') == ['x', 'y']")
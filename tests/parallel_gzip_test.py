@@ -0,0 +1,46 @@
+"""Tests for the parallel_gzip module"""
+
+import io
+import gzip
+import tarfile
+
+from merge_utils import parallel_gzip
+
+def test_round_trip():
+    """Blocks compressed on several threads decompress to the original data, in order"""
+    data = b''.join(f"line {idx}\n".encode() for idx in range(50000))
+    out = io.BytesIO()
+    with parallel_gzip.GzipWriter(out, level=1, threads=3, block_size=10000) as writer:
+        for pos in range(0, len(data), 7777):
+            writer.write(data[pos:pos+7777])
+        assert writer.tell() == len(data)
+    assert gzip.decompress(out.getvalue()) == data
+    # Members cover the data without gaps, and each one decompresses on its own
+    assert len(writer.members) == -(-len(data) // 10000)
+    offset = compressed = 0
+    for start, size, cstart, csize in writer.members:
+        assert (start, cstart) == (offset, compressed)
+        assert gzip.decompress(out.getvalue()[cstart:cstart+csize]) == data[start:start+size]
+        offset += size
+        compressed += csize
+    assert compressed == len(out.getvalue())
+
+def test_tarfile(tmp_path):
+    """Archives written through the writer can be read by tarfile, and empty streams are valid"""
+    path = tmp_path / "test.tar.gz"
+    with open(path, 'wb') as out_file, parallel_gzip.GzipWriter(out_file, threads=2,
+                                                                block_size=4096) as writer:
+        with tarfile.open(fileobj=writer, mode="w") as tar:
+            for idx in range(5):
+                info = tarfile.TarInfo(f"file_{idx}.txt")
+                content = bytes([65 + idx]) * (3000 * idx)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+            writer.end_member()
+    with tarfile.open(path, "r:gz") as tar:
+        assert tar.getnames() == [f"file_{idx}.txt" for idx in range(5)]
+        assert tar.extractfile("file_3.txt").read() == b'D' * 9000
+
+    out = io.BytesIO()
+    parallel_gzip.GzipWriter(out).close()
+    assert gzip.decompress(out.getvalue()) == b''
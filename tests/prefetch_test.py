@@ -0,0 +1,104 @@
+"""Tests for the prefetch module"""
+
+import os
+import time
+import shutil
+import threading
+
+from merge_utils import prefetch
+
+class FakeRemote:
+    """
+    Serve 'fake://' URLs from a local directory, with a delay for each copy.
+    With a barrier, each copy also waits for the barrier before it starts.
+    """
+
+    def __init__(self, delay: float = 0.05, barrier: threading.Barrier = None):
+        self.delay = delay
+        self.barrier = barrier
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.fetched = []
+
+    def __call__(self, url: str, local_path: str) -> int:
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.fetched.append(url)
+        try:
+            if self.barrier is not None:
+                self.barrier.wait()
+            time.sleep(self.delay)
+            if 'missing' in url:
+                raise OSError("No such file")
+            shutil.copyfile(url[len('fake://'):], local_path)
+        finally:
+            with self.lock:
+                self.active -= 1
+        return os.path.getsize(local_path)
+
+def make_inputs(tmp_path, count: int, size: int = 1000) -> list[str]:
+    """Write some input files and return fake URLs for them"""
+    urls = []
+    for idx in range(count):
+        path = tmp_path / f"input_{idx}.dat"
+        path.write_bytes(bytes([idx]) * size)
+        urls.append(f"fake://{path}")
+    return urls
+
+def test_prefetch(tmp_path, monkeypatch):
+    """Inputs are fetched ahead in order, and each copy is deleted once the next is requested"""
+    remote = FakeRemote()
+    monkeypatch.setattr(prefetch, 'fetch', remote)
+    urls = make_inputs(tmp_path, 6)
+    local_input = tmp_path / "local.dat"
+    local_input.write_bytes(b"local")
+    inputs = urls[:3] + [str(local_input)] + urls[3:]
+    seen = []
+    with prefetch.Prefetcher(inputs, depth=2, tmp_dir=str(tmp_path / "tmp")) as prefetcher:
+        for path, local_path in prefetcher:
+            seen.append(path)
+            if path == str(local_input):
+                assert local_path == path
+                continue
+            assert local_path != path and os.path.basename(local_path) == os.path.basename(path)
+            with open(local_path, 'rb') as f:
+                assert f.read() == bytes([urls.index(path)]) * 1000
+            time.sleep(0.05)
+        assert len(prefetcher.copies) == 0
+    assert seen == inputs
+    assert remote.fetched == urls
+    assert remote.max_active <= 2
+    assert os.listdir(tmp_path / "tmp") == []
+
+def test_overlap(tmp_path, monkeypatch):
+    """Inputs ahead of the current one are fetched at the same time"""
+    # Neither copy can finish unless both are running at once
+    remote = FakeRemote(0, threading.Barrier(2, timeout=5))
+    monkeypatch.setattr(prefetch, 'fetch', remote)
+    urls = make_inputs(tmp_path, 2)
+    with prefetch.Prefetcher(urls, depth=2, tmp_dir=str(tmp_path / "tmp")) as prefetcher:
+        assert [path != local for path, local in prefetcher] == [True, True]
+    assert not remote.barrier.broken
+
+def test_keep(tmp_path, monkeypatch):
+    """With keep, copies last until the end and inputs beyond the budget are streamed"""
+    monkeypatch.setattr(prefetch, 'fetch', FakeRemote(0))
+    urls = make_inputs(tmp_path, 5)
+    prefetcher = prefetch.Prefetcher(urls, depth=1, tmp_dir=str(tmp_path / "tmp"),
+                                     max_bytes=2500, keep=True)
+    items = list(prefetcher)
+    assert [path for path, _ in items] == urls
+    assert [path == local for path, local in items] == [False, False, True, True, True]
+    assert all(os.path.isfile(local) for path, local in items if path != local)
+    prefetcher.close()
+    assert not any(os.path.exists(local) for path, local in items if path != local)
+
+def test_failure(tmp_path, monkeypatch):
+    """Inputs that fail to copy are streamed instead"""
+    monkeypatch.setattr(prefetch, 'fetch', FakeRemote(0))
+    urls = make_inputs(tmp_path, 3)
+    urls[1] = "fake://missing.dat"
+    with prefetch.Prefetcher(urls, depth=2, tmp_dir=str(tmp_path / "tmp")) as prefetcher:
+        assert [path == local for path, local in prefetcher] == [False, True, False]
@@ -0,0 +1,149 @@
+"""Tests for the retriever module"""
+
+import copy
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+from merge_utils import config, retriever
+from merge_utils.merge_set import MergeSet, MergeFileError
+from .merge_set_test import FILE_DEFAULTS
+from .conftest import MetaCatStandIn
+
+def records(count: int) -> list:
+    """Make file records, with every third one failing validation"""
+    files = []
+    for idx in range(count):
+        rec = copy.deepcopy(FILE_DEFAULTS)
+        rec['name'] = f"file_{idx:04}.root"
+        rec['fid'] = str(1000 + idx)
+        rec['metadata']['dune_mc.gen_fcl_filename'] = 'gen.fcl'
+        if idx % 3 == 0:
+            rec['metadata']['core.run_type'] = 'not-a-run-type'
+        files.append(rec)
+    return files
+
+def test_validation_workers():
+    """Files validated in worker processes match files validated in the main process"""
+    serial = MergeSet()
+    serial.add(0, records(12))
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=2, mp_context=context,
+                             initializer=retriever.init_validation_worker,
+                             initargs=(config.snapshot(), logging.DEBUG)) as pool:
+        results = [pool.submit(retriever.validate_records, records(12)[i:i+6]) for i in [0, 6]]
+        results = [res.result() for res in results]
+    summaries = [file for files, _ in results for file in files]
+    logs = [record for _, records in results for record in records]
+    assert [file.summary() for file in serial.all_files] == summaries
+    assert sum(1 for file in summaries if file[1] == MergeFileError.INVALID) == 4
+    assert any("Invalid value for core.run_type: not-a-run-type" in record.getMessage()
+               for record in logs)
+
+def test_cursor_query():
+    """The FID condition is added to the whole where clause, ignoring keywords in strings"""
+    query = "files from test:ds where name == 'a where b' or x == 1 ordered"
+    assert retriever.cursor_query(query, None, 10) == \
+        "files from test:ds where (name == 'a where b' or x == 1) ordered limit 10"
+    assert retriever.cursor_query(query, '1234', 10) == \
+        "files from test:ds where (name == 'a where b' or x == 1) and fid > 1234 ordered limit 10"
+    assert retriever.cursor_query("files from test:ds", 'a1b2', 10) == \
+        "files from test:ds where fid > 'a1b2' ordered limit 10"
+    for query in ["parents(files where a == 1) where b == 2", "files where a == 1 limit 5",
+                  "union(files where a == 1, files where b == 2)"]:
+        with pytest.raises(ValueError):
+            retriever.cursor_query(query, '1234', 10)
+
+def test_cursor_paging():
+    """Cursor paging returns every file once when the FIDs have different numbers of digits"""
+    metacat = MetaCatStandIn(count=250, first_fid=1)
+    fids = []
+    fid = None
+    while True:
+        query = retriever.cursor_query("files from test:ds", fid, 40)
+        page = [f['fid'] for f in metacat.query(query)]
+        fids.extend(page)
+        if len(page) < 40:
+            break
+        fid = page[-1]
+    assert fids == [str(idx) for idx in range(1, 251)]
+
+def test_has_paging():
+    """Only trailing skip and limit clauses count as the query's own paging"""
+    assert retriever.has_paging("files where a == 1 ordered skip 5 limit 10")
+    assert retriever.has_paging("files where a == 1 limit 10")
+    assert not retriever.has_paging("files where name == 'limit 10'")
+    assert not retriever.has_paging("files where dune.skip_reason == 'none'")
+
+class FailingRetriever(retriever.MetaRetriever):
+    """Retriever whose first batch fails while the later ones are still in flight"""
+    name = "failing"
+
+    def __init__(self): # pylint: disable=super-init-not-called
+        self._files = MergeSet()
+        self.cancelled = []
+
+    async def count(self) -> int:
+        return 4 * int(config.validation.batch_size)
+
+    async def get_metadata(self, batch: retriever.InputBatch, limit: int) -> list:
+        return []
+
+    async def retrieve_batch(self, batch: retriever.InputBatch, limit: int) -> tuple:
+        if batch.skip == 0:
+            await asyncio.sleep(0.01)
+            raise ValueError("Batch failed")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            self.cancelled.append(batch.skip)
+            raise
+        return batch, None
+
+def test_input_batches_failure():
+    """Batches still in flight are cancelled when an earlier batch fails"""
+    async def run(source: FailingRetriever) -> None:
+        with pytest.raises(ValueError):
+            async for _ in source.input_batches():
+                pass
+        assert not [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    source = FailingRetriever()
+    asyncio.run(run(source))
+    assert len(source.cancelled) == 3
+
+class CountingRetriever(retriever.MetaRetriever):
+    """Retriever that keeps track of how many batches are requested at once"""
+    name = "counting"
+
+    def __init__(self, total: int): # pylint: disable=super-init-not-called
+        self._files = MergeSet()
+        self.total = total
+        self.active = 0
+        self.max_active = 0
+        self.requested = []
+
+    async def count(self) -> int:
+        return self.total
+
+    async def get_metadata(self, batch: retriever.InputBatch, limit: int) -> list:
+        return []
+
+    async def retrieve_batch(self, batch: retriever.InputBatch, limit: int) -> tuple:
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        self.requested.append((batch.skip, limit))
+        await asyncio.sleep(0.001)
+        self.active -= 1
+        return batch, None
+
+def test_input_batches_window():
+    """A known input count only ends the requests, it doesn't widen the request window"""
+    step = int(config.validation.batch_size)
+    source = CountingRetriever(20 * step + 5)
+    async def run() -> list:
+        return [batch async for batch in source.input_batches()]
+    asyncio.run(run())
+    assert source.max_active == max(1, int(config.validation.prefetch))
+    assert source.requested == [(idx * step, step) for idx in range(20)] + [(20 * step, 5)]
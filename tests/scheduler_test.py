@@ -0,0 +1,36 @@
+"""Tests for the scheduler module"""
+
+import math
+
+import pytest
+from merge_utils import config
+
+pytest.importorskip("requests")  # Needed by justin_utils
+from merge_utils.scheduler import LocalScheduler # pylint: disable=wrong-import-position
+
+class SizedFile: # pylint: disable=too-few-public-methods
+    """Stand-in for a MergeFile with just a size"""
+    def __init__(self, size: float):
+        self.size = size
+
+def test_split_files_budget():
+    """Groups are split until each fits in the disk space available for merging"""
+    scheduler = LocalScheduler(None)
+    # Count the local copies of the inputs plus an output of the same total size
+    scheduler.footprint = lambda files: 2 * sum(f.size for f in files)
+    budget = config.method.chunks.max_size * 1024**3
+    files = [SizedFile(budget / 7) for _ in range(10)]
+    groups = scheduler.split_files(files)
+    assert [f for group in groups for f in group] == files
+    assert len(groups) == 4
+    assert all(scheduler.footprint(group) <= budget for group in groups)
+    # Small files are only split by count
+    files = [SizedFile(1000) for _ in range(config.method.chunks.max_count + 1)]
+    assert len(scheduler.split_files(files)) == 2
+    # Files too large to fit on their own end up alone, without splitting up the rest
+    files = [SizedFile(100 * 1024**2) for _ in range(99)] + [SizedFile(25 * 1024**3)]
+    groups = scheduler.split_files(files)
+    assert sorted(map(id, (f for group in groups for f in group))) == sorted(map(id, files))
+    assert groups[-1] == [files[-1]]
+    assert len(groups) == 1 + math.ceil(99 * 200 / (budget / 1024**2))
+    assert all(scheduler.footprint(group) <= budget for group in groups[:-1])
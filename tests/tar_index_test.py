@@ -0,0 +1,50 @@
+"""Tests for the tar_index module"""
+
+import io
+import os
+import tarfile
+
+import pytest
+
+from merge_utils import parallel_gzip, tar_index
+
+def write_archive(path: str, members: dict) -> None:
+    """Write an indexed archive with small gzip blocks, so large members span several"""
+    with open(path, 'wb') as out_file, \
+            parallel_gzip.GzipWriter(out_file, threads=2, block_size=5000) as out_gz, \
+            tar_index.IndexedTarFile(fileobj=out_gz, mode="w") as out_tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            out_tar.addfile(info, io.BytesIO(content))
+    tar_index.write_index(path, out_tar.entries, out_gz.members)
+
+def test_index(tmp_path):
+    """Members are indexed in order and can be extracted individually"""
+    members = {f"dir/file_{idx}.txt": f"{idx} ".encode() * (idx * 1500) for idx in range(6)}
+    path = str(tmp_path / "test.tar")
+    write_archive(path, members)
+    with tarfile.open(path, "r:gz") as tar:
+        assert tar.getnames() == list(members)
+
+    index = tar_index.read_index(path)
+    assert list(index) == list(members)
+    for name, content in members.items():
+        assert tar_index.extract(path, name, index) == content
+    with pytest.raises(KeyError):
+        tar_index.extract(path, "missing.txt", index)
+
+    # Corrupted index entries are detected
+    index["dir/file_3.txt"]['skip'] += 512
+    with pytest.raises(ValueError):
+        tar_index.extract(path, "dir/file_3.txt", index)
+
+def test_stale(tmp_path):
+    """The index is ignored once the archive changes"""
+    path = str(tmp_path / "test.tar")
+    write_archive(path, {"a.txt": b"a" * 100})
+    assert tar_index.extract(path, "a.txt") == b"a" * 100
+    with open(path, 'ab') as f:
+        f.write(b"\0")
+    assert tar_index.read_index(path) is None
+    assert tar_index.read_index(str(tmp_path / "missing.tar")) is None
@@ -0,0 +1,62 @@
+"""Tests for the xrootd probe module"""
+
+import asyncio
+
+from merge_utils import xrootd
+from merge_utils.replicas import BaseRSE, Replica, Status
+from .conftest import XRootDStandIn
+
+SERVER = "root://fake.host:1094"
+
+def make_files(count: int) -> dict:
+    """Make a set of remote files in two directories"""
+    return {f"{SERVER}/pnfs/dir{idx % 2}/file_{idx:04}.root": (1000 + idx, f"{idx:08x}", 'ONLINE')
+            for idx in range(count)}
+
+def test_parse_listing():
+    """Listings from different xrootd versions give the same result"""
+    for line in ["-r-- 2023-07-21 12:35:54     26731046 /pnfs/a/file.root",
+                 "-rw-r--r-- dunepro 5000 26731046 2023-07-21 12:35:54 /pnfs/a/file.root",
+                 "-r-- 2023-07-21 12:35:54 26731046 /pnfs/a/file.root"]:
+        assert xrootd.parse_listing(line) == ('/pnfs/a/file.root', 26731046, True)
+    assert xrootd.parse_listing("d--- 2023-07-21 12:35:54 0 /pnfs/a")[2] is False
+    assert xrootd.parse_listing("garbage") is None
+
+def test_run_command():
+    """Commands run as subprocesses, and are killed if they take too long"""
+    assert asyncio.run(xrootd.run_command(['echo', 'hello'], 5)) == (0, "hello\n", "")
+    assert asyncio.run(xrootd.run_command(['sleep', '5'], 0.1))[0] == xrootd.TIMEOUT
+    assert asyncio.run(xrootd.run_command(['no-such-command-xyz'], 1))[0] == xrootd.NO_SERVER
+
+def test_batched_stat():
+    """Files in the same directory are checked with a single listing"""
+    files = make_files(40)
+    fake = XRootDStandIn(files, latency=0.01)
+    probe = xrootd.CommandProbe(runner=fake, connections=4, timeout=1)
+    urls = list(files) + [f"{SERVER}/pnfs/dir0/missing.root"]
+    async def stat():
+        return await asyncio.gather(*[probe.stat(url) for url in urls])
+    results = asyncio.run(stat())
+    assert [r.size for r in results[:-1]] == [f[0] for f in files.values()]
+    assert results[-1].code == xrootd.NOT_FOUND
+    assert fake.commands == {'ls -l': 2}
+
+def test_replica_check():
+    """Replicas are checked through the probe, with a bounded number of commands per server"""
+    files = make_files(20)
+    fake = XRootDStandIn(files, latency=0.01)
+    probe = xrootd.CommandProbe(runner=fake, connections=3, timeout=1, listings=False)
+    rse = BaseRSE()
+    rse.name, rse.distance, rse.staging = 'fake', 0.0, 100.0
+    replicas = [Replica(url, rse) for url in files]
+    bad = Replica(f"{SERVER}/pnfs/dir1/file_0001.root", rse)
+    async def check():
+        await asyncio.gather(*[rse.check(r, size=files[r.path][0], probe=probe,
+                                         cksums={'adler32': files[r.path][1]})
+                               for r in replicas])
+        await rse.check(bad, size=1001, cksums={'adler32': 'deadbeef'}, probe=probe)
+    asyncio.run(check())
+    assert all(r.status == Status.ONLINE for r in replicas)
+    assert bad.status == Status.BAD_CHECKSUM
+    assert fake.commands == {'ls -l': 21, 'query checksum': 21, 'gfal-xattr': 20}
+    assert fake.max_active == 3